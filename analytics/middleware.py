@@ -65,11 +65,11 @@ class AnalyticsMiddleware:
     def __call__(self, request):
         response = self.get_response(request)
         
-        # Only track GET requests and successful responses
+        # Only track GET requests and successful responses (a 304 is a revalidation, not a visit)
         if request.method == 'GET' and response.status_code == 200:
-            # Skip admin and static files
+            # Skip admin, static files and resized images
             path = request.path
-            if not path.startswith('/admin/') and not path.startswith('/static/') and not path.startswith('/media/'):
+            if not path.startswith(('/admin/', '/static/', '/media/', '/img/', '/sitemap', '/feeds/', '/api/', '/search/suggest/')):
                 self.record_visit(request)
                 
         return response
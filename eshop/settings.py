@@ -65,7 +65,8 @@ MESSAGE_TAGS = {
 # Database Backup Settings
 STORAGES = {
     "default": {
-        "BACKEND": "django.core.files.storage.FileSystemStorage",
+        # Deduplicating, content-addressed media (see store/storage.py and `manage.py gc_media`)
+        "BACKEND": "store.storage.ContentAddressedStorage",
     },
     "staticfiles": {
         "BACKEND": "whitenoise.storage.CompressedManifestStaticFilesStorage",
@@ -144,6 +145,56 @@ DATABASES = {
 }
 
 
+# Shared between worker processes: sessions (cached_db, below), wishlists,
+# checkout hold totals and the version stamps (store/versions.py). In
+# production set REDIS_URL; every lookup is then one round trip instead of a
+# file open, and nothing scans a directory. Use a volatile-* maxmemory policy:
+# the stamps never expire, so it can't evict them.
+REDIS_URL = os.environ.get('REDIS_URL')
+if REDIS_URL:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': REDIS_URL,
+        },
+        'versions': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': REDIS_URL,
+        },
+    }
+else:
+    # Without a cache server (development, a single small box) fall back to
+    # files, which every process on the machine shares. Past MAX_ENTRIES a
+    # FileBasedCache deletes a third of its files at random, and each write
+    # lists the whole directory, so this doesn't scale to many sessions. The
+    # stamps get their own directory so that culling can never drop them.
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+            'LOCATION': BASE_DIR / 'cache' / 'django',
+            'OPTIONS': {'MAX_ENTRIES': 5000},
+        },
+        'versions': {
+            'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+            'LOCATION': BASE_DIR / 'cache' / 'versions',
+            # A few dozen stamps at most, so this never culls
+            'OPTIONS': {'MAX_ENTRIES': 1000},
+        },
+    }
+# Per-process memos that don't need to be shared (image source digests)
+CACHES['local'] = {
+    'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    'LOCATION': 'eshop-local',
+    'OPTIONS': {'MAX_ENTRIES': 10000},
+}
+
+# Sessions are read through the cache and written to both, so page views by
+# shoppers with a cart don't query django_session. Only carts, coupons,
+# checkout holds and logins are stored, so visitors who just browse never get
+# a session row. `manage.py sweep_sessions` deletes expired rows.
+SESSION_ENGINE = 'django.contrib.sessions.backends.cached_db'
+
+
 # Password validation
 # https://docs.djangoproject.com/en/5.2/ref/settings/#auth-password-validators
 
@@ -189,6 +240,19 @@ STATICFILES_STORAGE = 'whitenoise.storage.CompressedManifestStaticFilesStorage'
 MEDIA_URL = '/media/'
 MEDIA_ROOT = BASE_DIR / 'media'
 
+# Resized image variants generated by store/images.py (LRU-evicted above the size cap)
+IMAGE_DERIVATIVE_ROOT = BASE_DIR / 'cache' / 'images'
+IMAGE_DERIVATIVE_MAX_BYTES = 512 * 1024 * 1024
+
+# Download imported product image_urls into local media after each import
+# (see store/mirror.py; `manage.py mirror_product_images` does the same on demand)
+MIRROR_IMPORTED_IMAGES = True
+
+# Public base URL used in sitemaps and product feeds (store/feeds.py); required
+# by `manage.py build_feeds`, which is the only thing that writes them.
+SITE_URL = os.environ.get('SITE_URL', '')
+FEEDS_ROOT = BASE_DIR / 'cache' / 'feeds'
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/5.2/ref/settings/#default-auto-field
 
@@ -198,6 +262,8 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 STRIPE_PUBLISHABLE_KEY = os.environ.get('STRIPE_PUBLISHABLE_KEY')
 STRIPE_SECRET_KEY = os.environ.get('STRIPE_SECRET_KEY')
 STRIPE_ENABLED = bool(STRIPE_PUBLISHABLE_KEY and STRIPE_SECRET_KEY)
+# Point at a local stand-in such as stripe-mock (http://localhost:12111) for development
+STRIPE_API_BASE = os.environ.get('STRIPE_API_BASE')
 
 # Recaptcha Test Keys (Development)
 RECAPTCHA_PUBLIC_KEY = '6LeIxAcTAAAAAJcZVRqyHh71UMIEGNQ_MXjiZKhI'
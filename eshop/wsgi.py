@@ -7,6 +7,7 @@ For more information on this file, see
 https://docs.djangoproject.com/en/5.2/howto/deployment/wsgi/
 """
 
+import logging
 import os
 
 from django.core.wsgi import get_wsgi_application
@@ -14,3 +15,11 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'eshop.settings')
 
 application = get_wsgi_application()
+
+# Load the in-process catalog snapshot before the first request
+try:
+    from store import catalog
+    catalog.snapshot()
+except Exception:
+    # Not fatal: the first request builds it instead
+    logging.getLogger(__name__).exception('Catalog warm-up failed')
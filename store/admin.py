@@ -4,6 +4,10 @@ from django.contrib.auth.forms import AuthenticationForm, UserChangeForm
 from django.contrib.auth.admin import UserAdmin
 from django_recaptcha.fields import ReCaptchaField
 from django_recaptcha.widgets import ReCaptchaV2Checkbox
+from .images import derivative_url
+from .orders import change_status
+from .signals import deferred_order_totals
+from .slugs import SlugAllocator, base_slug
 from .models import Product, ProductImage, Order, OrderItem, SiteSettings, Page, Coupon, OrderNote, Category, Customer, PaymentMethod, SalesDashboard, HeroSlide, UserProfile
 from django.db.models import Sum, Count, Avg
 from django.db.models.functions import TruncDate
@@ -14,7 +18,7 @@ from datetime import timedelta
 import uuid
 from django import forms
 from django.forms import CheckboxSelectMultiple
-from django.db import models
+from django.db import models, transaction
 from import_export.admin import ImportExportModelAdmin
 from import_export import resources, fields
 from import_export.widgets import ManyToManyWidget
@@ -25,6 +29,7 @@ from openpyxl import Workbook
 from django.urls import path
 from django.shortcuts import redirect
 from django.core.files import File
+from django.core.files.storage import default_storage
 import zipfile
 import tempfile
 import os
@@ -37,20 +42,17 @@ admin.site.login_form = RecaptchaAdminLoginForm
 
 @admin.action(description='複製選取的商品')
 def duplicate_product(modeladmin, request, queryset):
-    for product in queryset:
+    products = list(queryset.prefetch_related('categories'))
+    # Allocate every "-copy" slug/SKU up front: one query each for the whole selection
+    slugs = SlugAllocator(Product).allocate_many(f"{p.slug}-copy" for p in products)
+    skus = SlugAllocator(Product, field='sku').allocate_many(f"{p.sku}-copy" for p in products)
+    for product, slug, sku in zip(products, slugs, skus):
         # Capture categories before resetting pk
         categories = list(product.categories.all())
         
         product.pk = None  # Reset primary key to create a new instance
-        product.slug = f"{product.slug}-copy" # Update slug to be unique
-        product.sku = f"{product.sku}-copy" # Update sku to be unique
-        if Product.objects.filter(slug=product.slug).exists():
-             import uuid
-             product.slug = f"{product.slug}-{uuid.uuid4().hex[:4]}"
-        if Product.objects.filter(sku=product.sku).exists():
-             import uuid
-             product.sku = f"{product.sku}-{uuid.uuid4().hex[:4]}"
-             
+        product.slug = slug
+        product.sku = sku
         product.save()
         
         # Restore categories for the new instance
@@ -166,6 +168,20 @@ class ProductResource(resources.ModelResource):
                     pass
         return ",".join(urls)
     
+    NAME_HEADERS = ('name', '名稱', '商品名稱', '品名')
+
+    def before_import(self, dataset, **kwargs):
+        super().before_import(dataset, **kwargs)
+        self._mirror_product_ids = set()
+        # Load the existing slug variants of every name in the file with one query,
+        # so rows sharing a name don't each probe the database for a free suffix
+        self._slugs = SlugAllocator(Product)
+        names = []
+        for header in self.NAME_HEADERS:
+            if header in (dataset.headers or []):
+                names.extend(dataset[header])
+        self._slugs.load(base_slug(str(name)) for name in names if name)
+
     def before_import_row(self, row, **kwargs):
         print(f"DEBUG: before_import_row called. keys: {list(row.keys())}", flush=True)
         
@@ -221,6 +237,9 @@ class ProductResource(resources.ModelResource):
             if qs.exists():
                 # This will be caught by import-export and shown as a row error
                 raise Exception(f"錯誤: SKU (貨號) '{instance.sku}' 已存在於另一個商品中，請確保 SKU 唯一。")
+
+        if not instance.slug:
+            instance.slug = self._slugs.allocate(base_slug(instance.name))
         
         super().before_save_instance(instance, row, **kwargs)
 
@@ -287,11 +306,16 @@ class ProductResource(resources.ModelResource):
         
         if urls:
             instance.images.all().delete()
-            for idx, u in enumerate(urls):
-                ProductImage.objects.create(product=instance, image_url=u, sort_order=idx)
+            ProductImage.objects.bulk_create([
+                ProductImage(product=instance, image_url=u, sort_order=idx)
+                for idx, u in enumerate(urls)
+            ])
             
             # Repopulate image_urls attribute for the preview display
             instance.image_urls = ",".join(urls)
+
+            if not kwargs.get('dry_run'):
+                self._mirror_product_ids.add(instance.pk)
             
             # Auto-set the main image_url if it's empty but we have imported URLs
             # This ensures the main product has a default image without needing extra queries
@@ -300,6 +324,17 @@ class ProductResource(resources.ModelResource):
                 instance.image_url = urls[0]
                 instance.save(update_fields=['image_url'])
 
+        # bulk_create skips the ProductImage signals, so resolve once here
+        instance.refresh_primary_image()
+
+    def after_import(self, dataset, result, **kwargs):
+        super().after_import(dataset, result, **kwargs)
+        ids = getattr(self, '_mirror_product_ids', set())
+        if ids and not kwargs.get('dry_run') and getattr(settings, 'MIRROR_IMPORTED_IMAGES', False):
+            from .mirror import mirror_in_background
+            # Download only after the import transaction has committed the ProductImage rows
+            transaction.on_commit(lambda: mirror_in_background(list(ids)))
+
 @admin.register(Product)
 class ProductAdmin(ImportExportModelAdmin):
     list_per_page = 20
@@ -340,7 +375,7 @@ class ProductAdmin(ImportExportModelAdmin):
         def preview(self, obj):
             from django.utils.html import format_html
             if obj.image:
-                return format_html('<img src="{}" style="max-height:120px;"/>', obj.image.url)
+                return format_html('<img src="{}" style="max-height:120px;"/>', derivative_url(obj.image.url, 320))
             elif obj.image_url:
                 return format_html('<img src="{}" style="max-height:120px;"/>', obj.image_url)
             return "-"
@@ -386,11 +421,13 @@ class ProductAdmin(ImportExportModelAdmin):
                         product = Product.objects.get(sku__iexact=sku)
                     except Product.DoesNotExist:
                         continue
-                    sort_order = product.images.count()
                     with open(full, 'rb') as f:
-                        django_file = File(f)
-                        pi = ProductImage(product=product, sort_order=sort_order)
-                        pi.image.save(fname, django_file, save=True)
+                        # Content-addressed storage returns the existing blob for a
+                        # file we've seen before, so re-uploading a ZIP is a no-op
+                        stored_name = default_storage.save(ProductImage.image.field.generate_filename(None, fname), File(f))
+                    pi = product.images.filter(image=stored_name).first()
+                    if pi is None:
+                        pi = ProductImage.objects.create(product=product, image=stored_name, sort_order=product.images.count())
                         created += 1
                         updated_products.add(product.pk)
                     if not product.image:
@@ -412,17 +449,8 @@ class ProductAdmin(ImportExportModelAdmin):
 
     def product_thumbnail(self, obj):
         from django.utils.html import format_html
-        if obj.image:
-            return format_html('<img src="{}" style="width: 50px; height: 50px; object-fit: cover;" />', obj.image.url)
-        elif obj.image_url:
-             return format_html('<img src="{}" style="width: 50px; height: 50px; object-fit: cover;" />', obj.image_url)
-        # Fallback to the first related image if main image is not set
-        elif obj.images.exists():
-            first_img = obj.images.first()
-            if first_img.image_url:
-                return format_html('<img src="{}" style="width: 50px; height: 50px; object-fit: cover;" />', first_img.image_url)
-            elif first_img.image:
-                return format_html('<img src="{}" style="width: 50px; height: 50px; object-fit: cover;" />', first_img.image.url)
+        if obj.primary_image:
+            return format_html('<img src="{}" style="width: 50px; height: 50px; object-fit: cover;" />', derivative_url(obj.primary_image, 160))
         return "-"
     product_thumbnail.short_description = '圖片'
 
@@ -451,9 +479,11 @@ class OrderNoteInline(admin.StackedInline):
 
 @admin.register(Coupon)
 class CouponAdmin(admin.ModelAdmin):
-    list_display = ('code', 'discount_display', 'valid_from', 'valid_to', 'active')
+    list_display = ('code', 'discount_display', 'usage_display', 'valid_from', 'valid_to', 'active')
     list_filter = ('active', 'discount_type', 'valid_from', 'valid_to')
     search_fields = ('code', 'description')
+    filter_horizontal = ('categories',)
+    readonly_fields = ('used_count',)
     
     fieldsets = (
         (None, {
@@ -462,6 +492,12 @@ class CouponAdmin(admin.ModelAdmin):
         ('折扣設定', {
             'fields': ('discount_type', 'discount')
         }),
+        ('使用條件', {
+            'fields': ('min_spend', 'categories')
+        }),
+        ('使用上限', {
+            'fields': ('max_uses', 'used_count', 'max_uses_per_customer')
+        }),
         ('有效期', {
             'fields': ('valid_from', 'valid_to')
         }),
@@ -473,6 +509,12 @@ class CouponAdmin(admin.ModelAdmin):
         return f"${obj.discount}"
     discount_display.short_description = "折扣"
 
+    def usage_display(self, obj):
+        if obj.max_uses is None:
+            return "不限"
+        return f"{obj.used_count} / {obj.max_uses}"
+    usage_display.short_description = "使用次數"
+
 
 @admin.register(PaymentMethod)
 class PaymentMethodAdmin(admin.ModelAdmin):
@@ -511,6 +553,15 @@ class OrderResource(resources.ModelResource):
     def dehydrate_created_at_display(self, order):
         return timezone.localtime(order.created_at).strftime('%Y-%m-%d %H:%M')
 
+def _order_status_action(status, label):
+    def action(modeladmin, request, queryset):
+        # One set-based update for the whole selection (stock, status and notes)
+        changed = change_status(queryset, status)
+        modeladmin.message_user(request, f"已將 {changed} 筆訂單標記為「{label}」。")
+    action.__name__ = f'mark_{status}'
+    return admin.action(action, description=f"標記為{label}")
+
+
 @admin.register(Order)
 class OrderAdmin(ImportExportModelAdmin):
     list_per_page = 20
@@ -520,6 +571,10 @@ class OrderAdmin(ImportExportModelAdmin):
     list_filter = ('status', 'payment_method')
     search_fields = ('order_number', 'customer_name', 'email', 'phone')
     inlines = [OrderItemInline]
+    actions = [
+        _order_status_action(status, label) for status, label in Order.STATUS_CHOICES
+        if status in ('fulfilling', 'shipped', 'completed', 'canceled')
+    ]
     readonly_fields = ('order_number', 'invoice_view_link', 'total_amount', 'discount_amount', 'payment_proof_preview', 'ip_address', 'shipping_address_display')
 
     fieldsets = (
@@ -541,6 +596,11 @@ class OrderAdmin(ImportExportModelAdmin):
         return obj.address
     shipping_address_display.short_description = "運送地址"
 
+    def save_related(self, request, form, formsets, change):
+        # Recompute the order total once after the whole item inline is saved, not per row
+        with deferred_order_totals():
+            super().save_related(request, form, formsets, change)
+
     def get_urls(self):
         urls = super().get_urls()
         custom_urls = [
@@ -558,7 +618,7 @@ class OrderAdmin(ImportExportModelAdmin):
             data = {
                 'price': str(product.price),
                 'discount_price': str(product.discount_price) if product.discount_price else None,
-                'effective_price': str(product.effective_price()),
+                'effective_price': str(product.effective_price),
             }
             return JsonResponse(data)
         except Product.DoesNotExist:
@@ -670,7 +730,7 @@ class OrderAdmin(ImportExportModelAdmin):
     def payment_proof_preview(self, obj):
         from django.utils.html import format_html
         if obj.payment_proof:
-             return format_html('<a href="{}" target="_blank"><img src="{}" style="max-height: 200px; max-width: 300px;" /></a>', obj.payment_proof.url, obj.payment_proof.url)
+             return format_html('<a href="{}" target="_blank"><img src="{}" style="max-height: 200px; max-width: 300px;" /></a>', obj.payment_proof.url, derivative_url(obj.payment_proof.url, 640))
         return "未上傳"
     payment_proof_preview.short_description = "付款證明預覽"
 
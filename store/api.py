@@ -0,0 +1,259 @@
+"""
+Read-only catalog JSON API for the mobile app and partner integrations.
+
+    GET /api/products/    ?fields=  ?ids=  ?cursor=  ?updated_since=  ?limit=  ?category=
+    GET /api/categories/
+    GET /api/stock/       ?ids=  ?cursor=  ?updated_since=  ?limit=
+
+Products are paged with a keyset cursor over (updated_at, id), so syncing
+with ?updated_since= and following `next` returns every change, and a page
+costs the same query however deep it is. Delta requests also return
+deactivated products (is_active=false) so clients can drop them.
+Related data (categories, gallery images) is only prefetched when the
+requested fields need it: one query for the page plus at most one per
+relation. ETags are derived from version stamps, so revalidation
+is answered with 304 before touching the database.
+"""
+import base64
+import hashlib
+from datetime import datetime
+
+from django.db.models import Prefetch, Q
+from django.http import JsonResponse
+from django.urls import reverse
+from django.utils import timezone
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.dateparse import parse_datetime
+from django.views.decorators.http import require_GET
+
+from . import versions
+from .models import Category, Product, ProductImage
+
+DEFAULT_LIMIT = 50
+MAX_LIMIT = 200
+MAX_IDS = 200
+
+# field name -> model columns it needs (None: computed from a prefetched relation)
+PRODUCT_FIELDS = {
+    'id': ('id',),
+    'sku': ('sku',),
+    'name': ('name',),
+    'slug': ('slug',),
+    'url': ('slug',),
+    'price': ('price',),
+    'discount_price': ('discount_price',),
+    'effective_price': ('effective_price',),
+    'stock': ('stock',),
+    'in_stock': ('stock',),
+    'image': ('primary_image',),
+    'description': ('description',),
+    'specs': ('specs',),
+    'is_active': ('is_active',),
+    'updated_at': ('updated_at',),
+    'categories': None,
+    'images': None,
+}
+DEFAULT_PRODUCT_FIELDS = [
+    'id', 'sku', 'name', 'url', 'price', 'discount_price', 'effective_price',
+    'in_stock', 'image', 'categories', 'updated_at',
+]
+STOCK_FIELDS = ['id', 'sku', 'stock', 'in_stock', 'updated_at']
+
+
+class ApiError(Exception):
+    pass
+
+
+def _error(message, status=400):
+    return JsonResponse({'status': 'error', 'message': message}, status=status)
+
+
+def _etag(request, *parts):
+    key = '|'.join(str(p) for p in parts) + '|' + request.get_full_path()
+    return '"%s"' % hashlib.md5(key.encode()).hexdigest()
+
+
+def _finish(request, response, etag):
+    response['ETag'] = etag
+    patch_cache_control(response, public=True, max_age=60)
+    return response
+
+
+def _not_modified(request, etag):
+    response = get_conditional_response(request, etag=etag)
+    if response is not None:
+        patch_cache_control(response, public=True, max_age=60)
+    return response
+
+
+def _absolute(request, url):
+    if not url or url.startswith(('http://', 'https://')):
+        return url
+    return request.build_absolute_uri(url)
+
+
+def encode_cursor(updated_at, pk):
+    raw = f'{updated_at.isoformat()}|{pk}'
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode()
+        stamp, pk = raw.rsplit('|', 1)
+        return datetime.fromisoformat(stamp), int(pk)
+    except (ValueError, UnicodeDecodeError):
+        raise ApiError('Invalid cursor.')
+
+
+def parse_fields(value, allowed, default):
+    if not value:
+        return list(default)
+    fields = [f.strip() for f in value.split(',') if f.strip()]
+    unknown = [f for f in fields if f not in allowed]
+    if unknown:
+        raise ApiError(f'Unknown field(s): {", ".join(unknown)}.')
+    return fields
+
+
+def parse_ids(value):
+    try:
+        ids = [int(x) for x in value.split(',') if x.strip()]
+    except ValueError:
+        raise ApiError('ids must be a comma separated list of integers.')
+    if len(ids) > MAX_IDS:
+        raise ApiError(f'At most {MAX_IDS} ids per request.')
+    return ids
+
+
+def parse_limit(value):
+    try:
+        limit = int(value) if value else DEFAULT_LIMIT
+    except ValueError:
+        raise ApiError('limit must be an integer.')
+    return max(1, min(limit, MAX_LIMIT))
+
+
+def parse_since(value):
+    since = parse_datetime(value) if value else None
+    if value and since is None:
+        raise ApiError('updated_since must be an ISO 8601 datetime.')
+    if since is not None and timezone.is_naive(since):
+        since = timezone.make_aware(since)
+    return since
+
+
+def product_queryset(params, fields):
+    """Filtered, keyset-ordered queryset for a product page plus the page limit."""
+    qs = Product.objects.all()
+    ids = parse_ids(params['ids']) if params.get('ids') else None
+    since = parse_since(params.get('updated_since'))
+    if ids is not None:
+        qs = qs.filter(pk__in=ids, is_active=True)
+    elif since is not None:
+        qs = qs.filter(updated_at__gte=since)
+    else:
+        qs = qs.filter(is_active=True)
+
+    if params.get('category'):
+        qs = qs.filter(categories__slug=params['category'])
+    if params.get('cursor'):
+        stamp, pk = decode_cursor(params['cursor'])
+        qs = qs.filter(Q(updated_at__gt=stamp) | Q(updated_at=stamp, pk__gt=pk))
+
+    columns = {'id', 'updated_at'}
+    for field in fields:
+        columns.update(PRODUCT_FIELDS[field] or ())
+    qs = qs.only(*columns).order_by('updated_at', 'pk')
+    if 'categories' in fields:
+        qs = qs.prefetch_related(Prefetch('categories', queryset=Category.objects.only('id', 'slug')))
+    if 'images' in fields:
+        qs = qs.prefetch_related(Prefetch('images', queryset=ProductImage.objects.only('product_id', 'image', 'image_url', 'sort_order')))
+
+    limit = len(ids) if ids is not None else parse_limit(params.get('limit'))
+    return qs, limit
+
+
+def serialize_product(request, product, fields):
+    data = {}
+    for field in fields:
+        if field == 'url':
+            data['url'] = _absolute(request, reverse('product_detail', args=[product.slug]))
+        elif field == 'in_stock':
+            data['in_stock'] = product.stock > 0
+        elif field == 'image':
+            data['image'] = _absolute(request, product.primary_image)
+        elif field == 'categories':
+            data['categories'] = [c.slug for c in product.categories.all()]
+        elif field == 'images':
+            data['images'] = [
+                _absolute(request, img.image.url if img.image else img.image_url)
+                for img in product.images.all() if img.image or img.image_url
+            ]
+        elif field in ('price', 'discount_price', 'effective_price'):
+            value = getattr(product, field)
+            data[field] = str(value) if value is not None else None
+        elif field == 'updated_at':
+            data['updated_at'] = product.updated_at.isoformat()
+        else:
+            data[field] = getattr(product, field)
+    return data
+
+
+def _product_page(request, fields):
+    qs, limit = product_queryset(request.GET, fields)
+    page = list(qs[:limit + 1])
+    has_more = len(page) > limit and not request.GET.get('ids')
+    page = page[:limit]
+    next_url = None
+    if has_more:
+        params = request.GET.copy()
+        params['cursor'] = encode_cursor(page[-1].updated_at, page[-1].pk)
+        next_url = request.build_absolute_uri(f'{request.path}?{params.urlencode()}')
+    return {
+        'results': [serialize_product(request, p, fields) for p in page],
+        'next': next_url,
+        # Clients store this and pass it back as ?updated_since= on their next sync
+        'synced_at': timezone.now().isoformat(),
+    }
+
+
+@require_GET
+def products(request):
+    # Category slugs are part of the payload, so the site version counts too
+    etag = _etag(request, versions.get('catalog'), versions.get('site'))
+    not_modified = _not_modified(request, etag)
+    if not_modified is not None:
+        return not_modified
+    try:
+        fields = parse_fields(request.GET.get('fields'), PRODUCT_FIELDS, DEFAULT_PRODUCT_FIELDS)
+        body = _product_page(request, fields)
+    except ApiError as e:
+        return _error(str(e))
+    return _finish(request, JsonResponse(body, json_dumps_params={'ensure_ascii': False}), etag)
+
+
+@require_GET
+def stock(request):
+    etag = _etag(request, versions.get('catalog'))
+    not_modified = _not_modified(request, etag)
+    if not_modified is not None:
+        return not_modified
+    try:
+        body = _product_page(request, STOCK_FIELDS)
+    except ApiError as e:
+        return _error(str(e))
+    return _finish(request, JsonResponse(body), etag)
+
+
+@require_GET
+def categories(request):
+    etag = _etag(request, versions.get('site'))
+    not_modified = _not_modified(request, etag)
+    if not_modified is not None:
+        return not_modified
+    results = [
+        {'id': c.id, 'name': c.name, 'slug': c.slug}
+        for c in Category.objects.order_by('name').only('id', 'name', 'slug')
+    ]
+    return _finish(request, JsonResponse({'results': results}, json_dumps_params={'ensure_ascii': False}), etag)
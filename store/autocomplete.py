@@ -0,0 +1,203 @@
+"""
+Type-ahead suggestions for the header search box.
+
+Each worker keeps a sorted list of (key, kind, id) tuples, where a key is a
+normalised product name, SKU or category name starting at a word boundary
+(every CJK character counts as a word, so "墨水" matches "補充墨水"). A prefix
+lookup is one bisect plus a short forward scan; matches are ranked by units
+sold (products) or product count (categories).
+
+The index follows the 'catalog' and 'site' version stamps. When only the
+catalog moved, products updated since the last build are patched in place;
+deletions, category changes and the hourly sales re-ranking trigger a full
+rebuild. Results are memoised per prefix until the index changes.
+"""
+import bisect
+import re
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from datetime import timedelta
+from urllib.parse import urlencode
+
+from django.db.models import Count, Sum
+from django.urls import reverse
+from django.utils import timezone
+
+from . import versions
+from .models import Category, OrderItem, Product
+
+MAX_KEY_LENGTH = 32
+SCAN_LIMIT = 5000
+PREFIX_CACHE_SIZE = 2048
+FULL_REBUILD_SECONDS = 60 * 60
+EXCLUDED_STATUSES = ['canceled', 'refunded', 'returned']
+# Same overlap as catalog.py, so a row committed while the last build ran isn't missed
+PATCH_OVERLAP = timedelta(minutes=1)
+
+_NON_WORD = re.compile(r'[\W_]+')
+
+
+def normalize(text):
+    text = unicodedata.normalize('NFKC', text or '').casefold()
+    return _NON_WORD.sub(' ', text).strip()
+
+
+def _is_cjk(ch):
+    return '\u3400' <= ch <= '\u9fff' or '\uf900' <= ch <= '\ufaff'
+
+
+def index_keys(text):
+    """Suffixes of the normalised text that start at a word boundary."""
+    text = normalize(text)
+    keys = set()
+    for i, ch in enumerate(text):
+        if ch == ' ':
+            continue
+        if i == 0 or text[i - 1] == ' ' or _is_cjk(ch) or _is_cjk(text[i - 1]):
+            keys.add(text[i:i + MAX_KEY_LENGTH])
+    return keys
+
+
+class Suggestion:
+    __slots__ = ('kind', 'id', 'label', 'url', 'image', 'score', 'keys')
+
+    def __init__(self, kind, id, label, url, image, score, keys):
+        self.kind = kind
+        self.id = id
+        self.label = label
+        self.url = url
+        self.image = image
+        self.score = score
+        self.keys = keys
+
+    def as_dict(self):
+        return {'type': self.kind, 'label': self.label, 'url': self.url, 'image': self.image}
+
+
+def _product_suggestion(row, sold):
+    keys = index_keys(row['name']) | index_keys(row['sku'])
+    return Suggestion(
+        'product', row['id'], row['name'], reverse('product_detail', args=[row['slug']]),
+        row['primary_image'], sold, keys,
+    )
+
+
+def _sales(product_ids=None):
+    qs = OrderItem.objects.exclude(order__status__in=EXCLUDED_STATUSES)
+    if product_ids is not None:
+        qs = qs.filter(product_id__in=product_ids)
+    return dict(qs.values('product_id').annotate(n=Sum('quantity')).values_list('product_id', 'n'))
+
+
+PRODUCT_COLUMNS = ('id', 'name', 'sku', 'slug', 'primary_image')
+
+
+class PrefixIndex:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.keys = []
+        self.items = {}
+        self.stamp = None
+        self.built_at = None
+        self.full_built = 0
+        self.cache = OrderedDict()
+
+    def _full_build(self, stamp):
+        started = timezone.now()
+        sales = _sales()
+        items = {}
+        for row in Product.objects.filter(is_active=True).values(*PRODUCT_COLUMNS).iterator():
+            items['product', row['id']] = _product_suggestion(row, sales.get(row['id'], 0))
+        categories = Category.objects.annotate(n=Count('products')).values('id', 'name', 'n')
+        for row in categories:
+            url = f"{reverse('shop')}?{urlencode({'category': row['name']})}"
+            items['category', row['id']] = Suggestion('category', row['id'], row['name'], url, '', row['n'], index_keys(row['name']))
+        keys = sorted((key, kind, pk) for (kind, pk), item in items.items() for key in item.keys)
+        self.keys, self.items = keys, items
+        self.stamp, self.built_at, self.full_built = stamp, started, time.monotonic()
+        self.cache = OrderedDict()
+
+    def _patch_products(self, stamp):
+        """Re-index products changed since the last build; False if a full build is needed."""
+        started = timezone.now()
+        changed = list(
+            Product.objects.filter(updated_at__gte=self.built_at - PATCH_OVERLAP)
+            .values(*PRODUCT_COLUMNS + ('is_active',))
+        )
+        sales = _sales([row['id'] for row in changed])
+        keys, items = list(self.keys), dict(self.items)
+        for row in changed:
+            old = items.pop(('product', row['id']), None)
+            if old is not None:
+                for key in old.keys:
+                    i = bisect.bisect_left(keys, (key, 'product', row['id']))
+                    if i < len(keys) and keys[i] == (key, 'product', row['id']):
+                        del keys[i]
+            if row['is_active']:
+                item = _product_suggestion(row, sales.get(row['id'], 0))
+                items['product', row['id']] = item
+                for key in item.keys:
+                    bisect.insort(keys, (key, 'product', row['id']))
+        active = sum(1 for kind, _ in items if kind == 'product')
+        if active != Product.objects.filter(is_active=True).count():
+            # A product was deleted (or changed without touching updated_at)
+            return False
+        self.keys, self.items = keys, items
+        self.stamp, self.built_at = stamp, started
+        self.cache = OrderedDict()
+        return True
+
+    def refresh(self):
+        stamp = (versions.get('catalog'), versions.get('site'))
+        if stamp == self.stamp and time.monotonic() - self.full_built < FULL_REBUILD_SECONDS:
+            return
+        with self.lock:
+            if stamp == self.stamp and time.monotonic() - self.full_built < FULL_REBUILD_SECONDS:
+                return
+            incremental = (
+                self.stamp is not None and stamp[1] == self.stamp[1]
+                and time.monotonic() - self.full_built < FULL_REBUILD_SECONDS
+            )
+            if not (incremental and self._patch_products(stamp)):
+                self._full_build(stamp)
+
+    def lookup(self, prefix, limit=8, category_limit=3):
+        # The LRU is shared by every request thread; an OrderedDict isn't safe to reorder concurrently
+        with self.lock:
+            cache, keys, items = self.cache, self.keys, self.items
+            cached = cache.get((prefix, limit))
+            if cached is not None:
+                cache.move_to_end((prefix, limit))
+                return cached
+        found = set()
+        i = bisect.bisect_left(keys, (prefix,))
+        for key, kind, pk in keys[i:i + SCAN_LIMIT]:
+            if not key.startswith(prefix):
+                break
+            found.add((kind, pk))
+        matches = sorted((items[k] for k in found), key=lambda s: (-s.score, s.label))
+        result = (
+            [s.as_dict() for s in matches if s.kind == 'category'][:category_limit]
+            + [s.as_dict() for s in matches if s.kind == 'product'][:limit]
+        )
+        with self.lock:
+            # Skip if the index was rebuilt meanwhile; the result would be stale
+            if self.cache is cache:
+                cache[prefix, limit] = result
+                if len(cache) > PREFIX_CACHE_SIZE:
+                    cache.popitem(last=False)
+        return result
+
+
+_index = PrefixIndex()
+
+
+def suggest(query, limit=8):
+    prefix = normalize(query)[:MAX_KEY_LENGTH]
+    if not prefix:
+        return []
+    _index.refresh()
+    return _index.lookup(prefix, limit)
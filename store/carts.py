@@ -0,0 +1,152 @@
+"""
+Shopping cart service.
+
+The session only stores compact records, {"<product_id>": [qty, "price"]},
+where price is the one the customer last saw. Everything displayed or
+charged (name, image, current price, stock, whether the product is still on
+sale) is revalidated against the database with a single in_bulk query the
+first time a request needs it. Cart.for_request() shares that one Cart (and
+its computed totals) between the context processor, the cart page and
+checkout, so a request costs one product query however big the cart is, and
+none when it is empty or only the item count is needed.
+
+A line whose current price differs from the recorded one has
+price_changed set; acknowledge() records the current prices once the
+customer has been shown them, so checkout never charges a price the
+customer hasn't seen.
+"""
+from decimal import Decimal
+from functools import cached_property
+
+from .models import Product
+
+SESSION_KEY = 'cart'
+LINE_COLUMNS = ('id', 'name', 'effective_price', 'stock', 'is_active', 'primary_image')
+
+
+class CartLine:
+    __slots__ = ('product_id', 'name', 'image', 'price', 'seen_price', 'qty', 'stock', 'subtotal')
+
+    def __init__(self, product, qty, seen_price):
+        self.product_id = product.pk
+        self.name = product.name
+        self.image = product.primary_image
+        self.price = product.effective_price
+        self.seen_price = seen_price
+        self.qty = qty
+        self.stock = product.stock
+        self.subtotal = self.price * qty
+
+    @property
+    def id(self):
+        return self.product_id
+
+    @property
+    def price_changed(self):
+        return self.price != self.seen_price
+
+    @property
+    def in_stock(self):
+        return self.stock >= self.qty
+
+
+def _record(value):
+    # Carts saved before the compact format: {'name', 'price', 'qty', 'image'}
+    if isinstance(value, dict):
+        return [int(value.get('qty', 0)), str(value.get('price', '0'))]
+    return [int(value[0]), str(value[1])]
+
+
+class Cart:
+
+    def __init__(self, session):
+        self.session = session
+        self.records = {pid: _record(value) for pid, value in (session.get(SESSION_KEY) or {}).items()}
+        # Names of products dropped because they are no longer sold
+        self.removed = []
+
+    @classmethod
+    def for_request(cls, request):
+        cart = getattr(request, '_cart', None)
+        if cart is None or cart.session is not request.session:
+            cart = request._cart = cls(request.session)
+        return cart
+
+    def __len__(self):
+        return len(self.records)
+
+    def __bool__(self):
+        return bool(self.records)
+
+    @property
+    def count(self):
+        """Total number of units (no query)."""
+        return sum(qty for qty, _ in self.records.values())
+
+    def quantity(self, product_id):
+        record = self.records.get(str(product_id))
+        return record[0] if record else 0
+
+    @cached_property
+    def lines(self):
+        if not self.records:
+            return []
+        products = Product.objects.only(*LINE_COLUMNS).in_bulk([int(pid) for pid in self.records])
+        lines = []
+        for pid, (qty, seen_price) in list(self.records.items()):
+            product = products.get(int(pid))
+            if product is None or not product.is_active:
+                if product is not None:
+                    self.removed.append(product.name)
+                del self.records[pid]
+                continue
+            lines.append(CartLine(product, qty, Decimal(seen_price)))
+        if len(lines) != len(self.session.get(SESSION_KEY) or {}):
+            # Drop products that were deleted or taken off sale from the session too
+            self._save(changed=False)
+        return lines
+
+    @cached_property
+    def total(self):
+        return sum((line.subtotal for line in self.lines), Decimal('0'))
+
+    @property
+    def quantities(self):
+        return {line.product_id: line.qty for line in self.lines}
+
+    @property
+    def price_changes(self):
+        return [line for line in self.lines if line.price_changed]
+
+    def add(self, product_id, qty, price):
+        record = self.records.setdefault(str(product_id), [0, str(price)])
+        record[0] += qty
+        record[1] = str(price)
+        self._save()
+
+    def remove(self, product_id):
+        if self.records.pop(str(product_id), None) is not None:
+            self._save()
+
+    def clear(self):
+        self.records = {}
+        self._save()
+
+    def acknowledge(self):
+        """Record the current prices as seen by the customer."""
+        for line in self.lines:
+            self.records[str(line.product_id)][1] = str(line.price)
+            line.seen_price = line.price
+        self._save(changed=False)
+
+    def _save(self, changed=True):
+        if self.records:
+            self.session[SESSION_KEY] = self.records
+            self.session.modified = True
+        else:
+            # An empty cart leaves nothing behind, so the session can be dropped
+            self.session.pop(SESSION_KEY, None)
+        if changed:
+            # Contents changed: lines and totals are recomputed on next use
+            self.__dict__.pop('lines', None)
+            self.__dict__.pop('total', None)
@@ -0,0 +1,180 @@
+"""
+In-process catalog read model.
+
+Every worker keeps a snapshot of the active products (compact __slots__
+records with category ids, effective price, stock and primary image) and the
+categories with their active product counts. Browsing, filtering, sorting,
+price facets and the slug/id lookups of product_detail and cart_add are
+served from it; the database is left for full product pages, writes and
+authoritative stock checks.
+
+The snapshot follows the 'catalog' and 'site' version stamps, so all workers
+converge as soon as a change is committed. Product changes are patched in
+from rows whose updated_at moved recently; category changes, deletions and a
+periodic safety-net rebuild reload everything. wsgi.py builds the snapshot at
+startup so the first request doesn't pay for it.
+"""
+import threading
+import time
+from collections import defaultdict
+from datetime import timedelta
+
+from django.utils import timezone
+
+from . import versions
+from .models import Category, Product
+
+# Re-read rows updated this long before the previous build, so a transaction
+# that committed late is still picked up
+PATCH_OVERLAP = timedelta(minutes=1)
+FULL_REBUILD_SECONDS = 10 * 60
+
+PRODUCT_COLUMNS = (
+    'id', 'name', 'slug', 'sku', 'price', 'discount_price', 'effective_price',
+    'stock', 'primary_image', 'created_at', 'updated_at',
+)
+
+
+class ProductRecord:
+    __slots__ = PRODUCT_COLUMNS + ('category_ids',)
+
+    def __init__(self, row, category_ids):
+        for name in PRODUCT_COLUMNS:
+            setattr(self, name, row[name])
+        self.category_ids = category_ids
+
+
+class CategoryRecord:
+    __slots__ = ('id', 'name', 'slug', 'count')
+
+    def __init__(self, id, name, slug, count):
+        self.id = id
+        self.name = name
+        self.slug = slug
+        self.count = count
+
+
+def _category_ids(product_ids=None):
+    through = Product.categories.through.objects.all()
+    if product_ids is not None:
+        through = through.filter(product_id__in=product_ids)
+    ids = defaultdict(set)
+    for product_id, category_id in through.values_list('product_id', 'category_id').iterator():
+        ids[product_id].add(category_id)
+    return {pid: frozenset(cids) for pid, cids in ids.items()}
+
+
+class Snapshot:
+    """One immutable view of the catalog; replaced wholesale on refresh."""
+
+    def __init__(self, records, categories, stamp, built_at):
+        self.by_id = {r.id: r for r in records}
+        self.by_slug = {r.slug: r for r in records}
+        # Default (newest first) order; other orders are derived on demand
+        self.products = sorted(records, key=lambda r: (r.created_at, r.id), reverse=True)
+        self.categories = categories
+        self.category_by_name = {c.name: c for c in categories}
+        self.stamp = stamp
+        self.built_at = built_at
+        self._sorted = {}
+
+    def sorted_products(self, sort_by):
+        if sort_by not in ('price_low', 'price_high'):
+            return self.products
+        ordered = self._sorted.get(sort_by)
+        if ordered is None:
+            ordered = sorted(self.products, key=lambda r: (r.effective_price, r.id), reverse=(sort_by == 'price_high'))
+            self._sorted[sort_by] = ordered
+        return ordered
+
+
+def _load_categories(records):
+    counts = defaultdict(int)
+    for record in records:
+        for category_id in record.category_ids:
+            counts[category_id] += 1
+    return [
+        CategoryRecord(c['id'], c['name'], c['slug'], counts[c['id']])
+        for c in Category.objects.order_by('name').values('id', 'name', 'slug')
+    ]
+
+
+def build(stamp):
+    started = timezone.now()
+    category_ids = _category_ids()
+    records = [
+        ProductRecord(row, category_ids.get(row['id'], frozenset()))
+        for row in Product.objects.filter(is_active=True).values(*PRODUCT_COLUMNS).iterator(chunk_size=2000)
+    ]
+    return Snapshot(records, _load_categories(records), stamp, started)
+
+
+def patch(snapshot, stamp):
+    """Apply recent product changes to `snapshot`; None if a full build is needed."""
+    started = timezone.now()
+    changed = list(
+        Product.objects.filter(updated_at__gte=snapshot.built_at - PATCH_OVERLAP)
+        .values(*PRODUCT_COLUMNS + ('is_active',))
+    )
+    category_ids = _category_ids([row['id'] for row in changed])
+    by_id = dict(snapshot.by_id)
+    for row in changed:
+        by_id.pop(row['id'], None)
+        if row['is_active']:
+            by_id[row['id']] = ProductRecord(row, category_ids.get(row['id'], frozenset()))
+    if len(by_id) != Product.objects.filter(is_active=True).count():
+        # A product was deleted or changed without touching updated_at
+        return None
+    records = list(by_id.values())
+    return Snapshot(records, _load_categories(records), stamp, started)
+
+
+class _Holder:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.snapshot = None
+        self.full_built = 0
+
+
+_holder = _Holder()
+
+
+def snapshot():
+    """The current catalog snapshot, refreshed if the version stamps moved."""
+    stamp = (versions.get('catalog'), versions.get('site'))
+    current = _holder.snapshot
+    fresh = time.monotonic() - _holder.full_built < FULL_REBUILD_SECONDS
+    if current is not None and current.stamp == stamp and fresh:
+        return current
+    with _holder.lock:
+        current = _holder.snapshot
+        fresh = time.monotonic() - _holder.full_built < FULL_REBUILD_SECONDS
+        if current is not None and current.stamp == stamp and fresh:
+            return current
+        new = None
+        if current is not None and fresh and current.stamp[1] == stamp[1]:
+            new = patch(current, stamp)
+        if new is None:
+            new = build(stamp)
+            _holder.full_built = time.monotonic()
+        _holder.snapshot = new
+        return new
+
+
+def search_ids(query):
+    """
+    Ids of active products whose name, category name or description contains
+    `query`. Names and categories are matched in memory; descriptions are
+    too large to keep per worker, so they cost one id-only query.
+    """
+    snap = snapshot()
+    needle = query.casefold()
+    category_ids = {c.id for c in snap.categories if needle in c.name.casefold()}
+    ids = {
+        r.id for r in snap.products
+        if needle in r.name.casefold() or (category_ids and r.category_ids & category_ids)
+    }
+    ids.update(
+        Product.objects.filter(is_active=True, description__icontains=query).values_list('id', flat=True)
+    )
+    return ids
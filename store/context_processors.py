@@ -1,43 +1,26 @@
-from .models import SiteSettings, Category
+from . import carts, siteconfig
 
 def site_settings(request):
     """
     Context processor to make SiteSettings and Categories available to all templates.
+    Served from the per-process site config snapshot (no queries while it is current).
     """
-    settings = SiteSettings.objects.first()
-    categories = Category.objects.all().order_by('name')
+    config = siteconfig.get()
     return {
-        'site_settings': settings,
-        'categories': categories
+        'site_settings': config.settings,
+        'categories': config.categories
     }
 
-from decimal import Decimal
-
 def cart_processor(request):
     """
     Context processor to make cart item count and details available to all templates.
+    Lines and total come from the request's shared Cart (one product query, and
+    only if a template actually renders them).
     """
-    cart = request.session.get('cart', {})
-    
-    cart_items = []
-    cart_total_price = Decimal('0')
-    cart_item_count = 0
-    
-    for pid, item in cart.items():
-        # Create a copy to avoid modifying the session directly if mutable
-        # and inject the ID which is the key in the cart dictionary
-        item_data = item.copy()
-        item_data['id'] = pid
-        
-        qty = int(item.get('qty', 0))
-        price = Decimal(str(item.get('price', '0')))
-        
-        cart_items.append(item_data)
-        cart_item_count += qty
-        cart_total_price += price * qty
-        
+    cart = carts.Cart.for_request(request)
     return {
-        'cart_item_count': cart_item_count,
-        'cart_items': cart_items,
-        'cart_total_price': cart_total_price
+        'cart_item_count': cart.count,
+        # Templates call these, so nothing is fetched unless they are rendered
+        'cart_items': lambda: cart.lines,
+        'cart_total_price': lambda: cart.total,
     }
@@ -0,0 +1,151 @@
+"""
+Coupon engine.
+
+Active coupons are loaded once per worker, keyed by upper-case code and by
+id, and reused until the 'coupons' version stamp moves (bumped by the Coupon
+signals), so applying a code and pricing the cart and checkout cost no
+queries. Validity dates are checked on every lookup, since the stamp doesn't
+move when a coupon starts or expires.
+
+discount() is the single place a cart is priced against a coupon: it applies
+the category scope and minimum spend and raises CouponError (whose message
+is shown to the customer) when the coupon doesn't apply.
+
+Usage limits are enforced by redeem() inside the order transaction with
+conditional counter updates (used_count < max_uses), so concurrent
+checkouts can never redeem more than the limit. Coupons without a total
+limit never write to their own row, so a campaign code shared widely
+doesn't turn it into a hot spot; per-customer limits are counted in one
+CouponUsage row per customer, which only that customer's orders touch.
+The snapshot's used_count is not kept current; only redeem() is
+authoritative.
+"""
+import threading
+from collections import defaultdict
+from decimal import ROUND_HALF_UP, Decimal
+
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+
+from . import catalog, versions
+from .models import Coupon, CouponUsage
+
+CENT = Decimal('0.01')
+
+
+class CouponError(Exception):
+    """The coupon can't be used; str(error) is the reason shown to the customer."""
+
+
+class _Snapshot:
+    __slots__ = ('stamp', 'by_code', 'by_id')
+
+    def __init__(self, stamp):
+        coupons = list(Coupon.objects.filter(active=True, valid_to__gte=timezone.now()))
+        scopes = defaultdict(set)
+        through = Coupon.categories.through.objects.filter(coupon__in=coupons)
+        for coupon_id, category_id in through.values_list('coupon_id', 'category_id'):
+            scopes[coupon_id].add(category_id)
+        for coupon in coupons:
+            coupon.category_ids = frozenset(scopes[coupon.pk])
+        self.stamp = stamp
+        self.by_code = {coupon.code.upper(): coupon for coupon in coupons}
+        self.by_id = {coupon.pk: coupon for coupon in coupons}
+
+
+_lock = threading.Lock()
+_snapshot = None
+
+
+def _get_snapshot():
+    global _snapshot
+    stamp = versions.get('coupons')
+    snapshot = _snapshot
+    if snapshot is not None and snapshot.stamp == stamp:
+        return snapshot
+    with _lock:
+        if _snapshot is None or _snapshot.stamp != stamp:
+            _snapshot = _Snapshot(stamp)
+        return _snapshot
+
+
+def _current(coupon):
+    now = timezone.now()
+    if coupon is not None and coupon.valid_from <= now <= coupon.valid_to:
+        return coupon
+    return None
+
+
+def get(code):
+    """The usable coupon with this code (any case), or None."""
+    return _current(_get_snapshot().by_code.get(code.strip().upper()))
+
+
+def by_id(coupon_id):
+    return _current(_get_snapshot().by_id.get(coupon_id))
+
+
+def customer_key(user=None, email=''):
+    if user is not None and user.is_authenticated:
+        return f'user:{user.pk}'
+    if email:
+        return f'email:{email.strip().lower()}'
+    return None
+
+
+def discount(coupon, lines):
+    """
+    Discount for cart `lines` (carts.CartLine), at most their eligible subtotal.
+    Raises CouponError if the coupon doesn't apply to them.
+    """
+    if coupon.category_ids:
+        products = catalog.snapshot().by_id
+        eligible = [
+            line for line in lines
+            if line.product_id in products and products[line.product_id].category_ids & coupon.category_ids
+        ]
+        if not eligible:
+            raise CouponError(f"Coupon '{coupon.code}' does not apply to the items in your cart.")
+    else:
+        eligible = lines
+    subtotal = sum((line.subtotal for line in eligible), Decimal('0'))
+    if subtotal < coupon.min_spend:
+        raise CouponError(f"Coupon '{coupon.code}' requires a minimum spend of ${coupon.min_spend}.")
+    amount = coupon.calculate_discount(subtotal).quantize(CENT, rounding=ROUND_HALF_UP)
+    return min(amount, subtotal)
+
+
+def check_available(coupon, customer=None):
+    """Live check of the usage limits, for feedback when a code is applied."""
+    if coupon.max_uses is not None and not Coupon.objects.filter(pk=coupon.pk, used_count__lt=F('max_uses')).exists():
+        raise CouponError(f"Coupon '{coupon.code}' has been fully redeemed.")
+    if coupon.max_uses_per_customer is not None and customer:
+        used = CouponUsage.objects.filter(coupon=coupon, customer=customer).values_list('count', flat=True).first() or 0
+        if used >= coupon.max_uses_per_customer:
+            raise CouponError(f"You have already used coupon '{coupon.code}'.")
+
+
+def redeem(coupon, customer):
+    """
+    Count one use of `coupon` by `customer` for the order being placed in
+    the surrounding transaction. Raises CouponError if a limit is reached.
+    """
+    with transaction.atomic():
+        if coupon.max_uses_per_customer is not None:
+            if not customer:
+                # Nothing to count the use against (CouponUsage.customer can't be empty)
+                raise CouponError(f"Coupon '{coupon.code}' requires an email address.")
+            # The customer's row is created on first use; the conditional UPDATE is the check
+            CouponUsage.objects.bulk_create([CouponUsage(coupon=coupon, customer=customer)], ignore_conflicts=True)
+            counted = CouponUsage.objects.filter(
+                coupon=coupon, customer=customer, count__lt=coupon.max_uses_per_customer,
+            ).update(count=F('count') + 1)
+            if not counted:
+                raise CouponError(f"You have already used coupon '{coupon.code}'.")
+        if coupon.max_uses is not None:
+            counted = Coupon.objects.filter(pk=coupon.pk, used_count__lt=F('max_uses')).update(
+                used_count=F('used_count') + 1,
+            )
+            if not counted:
+                raise CouponError(f"Coupon '{coupon.code}' has been fully redeemed.")
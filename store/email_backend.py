@@ -6,8 +6,8 @@ class DatabaseEmailBackend(EmailBackend):
     def __init__(self, fail_silently=False, **kwargs):
         super().__init__(fail_silently=fail_silently, **kwargs)
         try:
-            from .models import SiteSettings
-            config = SiteSettings.objects.first()
+            from . import siteconfig
+            config = siteconfig.get().settings
             if config and config.smtp_host:
                 self.host = config.smtp_host
                 self.port = config.smtp_port
@@ -21,8 +21,8 @@ class DatabaseEmailBackend(EmailBackend):
             pass
     def send_messages(self, email_messages):
         try:
-            from .models import SiteSettings
-            config = SiteSettings.objects.first()
+            from . import siteconfig
+            config = siteconfig.get().settings
             if config and config.smtp_from_email:
                 for message in email_messages:
                     # If from_email is default, replace it with DB config
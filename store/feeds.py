@@ -0,0 +1,288 @@
+"""
+Sitemaps and product feeds (Google Merchant XML / Facebook catalog CSV).
+
+Everything is written to FEEDS_ROOT by streaming Product.objects.iterator()
+through gzip, never holding the catalog in memory. Products are split into
+chunks of CHUNK_SIZE primary keys, which is also the sitemap protocol's
+per-file URL limit. Each chunk produces one sitemap file plus one gzip part
+per feed format; the feed files are the header, the chunk parts and the
+footer concatenated (a multi-member gzip stream is still a valid .gz file).
+
+refresh() compares a (row count, latest updated_at) signature per chunk with
+the manifest of the previous build and regenerates only the chunks that
+changed. It returns immediately while the 'catalog', 'site' and 'pages'
+versions are unchanged. It is run by `manage.py build_feeds` (cron), never
+from a request: the URLs in the files come from settings.SITE_URL, not from
+a client-supplied Host header, and a lock file keeps two builds from running
+at once. The views only serve the files that exist.
+"""
+import csv
+import fcntl
+import gzip
+import html
+import io
+import json
+import os
+import shutil
+import tempfile
+from pathlib import Path
+from xml.sax.saxutils import escape
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db.models import Count, ExpressionWrapper, F, IntegerField, Max
+from django.urls import reverse
+from django.utils.html import strip_tags
+
+from . import siteconfig, versions
+from .models import Page, Product
+
+CHUNK_SIZE = 50000
+CURRENCY = 'HKD'
+DESCRIPTION_LIMIT = 5000
+FEED_FORMATS = ('xml', 'csv')
+CSV_COLUMNS = [
+    'id', 'title', 'description', 'availability', 'condition',
+    'price', 'sale_price', 'link', 'image_link', 'brand',
+]
+SITEMAP_NS = 'http://www.sitemaps.org/schemas/sitemap/0.9'
+
+FEED_FIELDS = (
+    'pk', 'sku', 'name', 'slug', 'description', 'price', 'discount_price',
+    'stock', 'primary_image', 'updated_at',
+)
+
+
+def feeds_root():
+    return Path(getattr(settings, 'FEEDS_ROOT', settings.BASE_DIR / 'cache' / 'feeds'))
+
+
+def feed_path(name):
+    return feeds_root() / name
+
+
+def _part_path(fmt, chunk):
+    return feeds_root() / 'parts' / f'feed-{fmt}-{chunk}.gz'
+
+
+def _sitemap_name(chunk):
+    return f'sitemap-products-{chunk}.xml.gz'
+
+
+class _AtomicFile:
+    """Write to a temp file next to `path` and move it into place on success."""
+
+    def __init__(self, path, mode='wb', compress=False):
+        self.path = Path(path)
+        self.mode = mode
+        self.compress = compress
+
+    def __enter__(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        fd, self.tmp = tempfile.mkstemp(dir=self.path.parent, suffix='.tmp')
+        self.raw = os.fdopen(fd, 'wb')
+        if self.compress:
+            self.gz = gzip.GzipFile(filename='', mode='wb', fileobj=self.raw, mtime=0)
+            return self.gz if 'b' in self.mode else _text(self.gz)
+        return self.raw if 'b' in self.mode else _text(self.raw)
+
+    def __exit__(self, exc_type, exc, tb):
+        if self.compress:
+            self.gz.close()
+        self.raw.close()
+        if exc_type is None:
+            os.chmod(self.tmp, 0o644)
+            os.replace(self.tmp, self.path)
+        else:
+            os.remove(self.tmp)
+
+
+def _text(fileobj):
+    return io.TextIOWrapper(fileobj, encoding='utf-8', newline='', write_through=True)
+
+
+def chunk_signatures():
+    """{chunk: "count:latest-updated_at"} for every non-empty pk chunk."""
+    rows = (
+        Product.objects
+        .annotate(chunk=ExpressionWrapper(F('pk') / CHUNK_SIZE, output_field=IntegerField()))
+        .values('chunk').annotate(n=Count('pk'), changed=Max('updated_at')).order_by('chunk')
+    )
+    return {str(row['chunk']): f"{row['n']}:{row['changed'].isoformat()}" for row in rows}
+
+
+def chunk_products(chunk):
+    return (
+        Product.objects.filter(is_active=True, pk__gte=chunk * CHUNK_SIZE, pk__lt=(chunk + 1) * CHUNK_SIZE)
+        .only(*FEED_FIELDS).order_by('pk').iterator(chunk_size=2000)
+    )
+
+
+def absolute(base_url, url):
+    if not url or url.startswith(('http://', 'https://')):
+        return url
+    return base_url + url
+
+
+def clean_description(value):
+    text = ' '.join(html.unescape(strip_tags(value or '')).split())
+    return text[:DESCRIPTION_LIMIT]
+
+
+def feed_item(product, base_url, brand):
+    sale = product.discount_price is not None
+    return {
+        'id': product.sku,
+        'title': product.name,
+        'description': clean_description(product.description) or product.name,
+        'availability': 'in stock' if product.stock > 0 else 'out of stock',
+        'condition': 'new',
+        'price': f'{product.price} {CURRENCY}',
+        'sale_price': f'{product.discount_price} {CURRENCY}' if sale else '',
+        'link': absolute(base_url, reverse('product_detail', args=[product.slug])),
+        'image_link': absolute(base_url, product.primary_image),
+        'brand': brand,
+    }
+
+
+def _url_entry(loc, lastmod=None):
+    entry = f'<url><loc>{escape(loc)}</loc>'
+    if lastmod:
+        entry += f'<lastmod>{lastmod.date().isoformat()}</lastmod>'
+    return entry + '</url>\n'
+
+
+def _xml_item(item):
+    lines = ['<item>']
+    for key, value in item.items():
+        if value:
+            lines.append(f'<g:{key}>{escape(value)}</g:{key}>')
+    lines.append('</item>\n')
+    return ''.join(lines)
+
+
+def write_chunk(chunk, base_url, brand):
+    """Write the sitemap and feed parts for one pk chunk in a single pass."""
+    chunk = int(chunk)
+    with _AtomicFile(feed_path(_sitemap_name(chunk)), 'w', compress=True) as sitemap, \
+            _AtomicFile(_part_path('xml', chunk), 'w', compress=True) as xml_part, \
+            _AtomicFile(_part_path('csv', chunk), 'w', compress=True) as csv_part:
+        sitemap.write(f'<?xml version="1.0" encoding="UTF-8"?>\n<urlset xmlns="{SITEMAP_NS}">\n')
+        writer = csv.DictWriter(csv_part, fieldnames=CSV_COLUMNS)
+        for product in chunk_products(chunk):
+            item = feed_item(product, base_url, brand)
+            sitemap.write(_url_entry(item['link'], product.updated_at))
+            xml_part.write(_xml_item(item))
+            writer.writerow(item)
+        sitemap.write('</urlset>\n')
+
+
+def remove_chunk(chunk):
+    for path in [feed_path(_sitemap_name(chunk))] + [_part_path(fmt, chunk) for fmt in FEED_FORMATS]:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+def write_pages_sitemap(base_url):
+    with _AtomicFile(feed_path('sitemap-pages.xml.gz'), 'w', compress=True) as f:
+        f.write(f'<?xml version="1.0" encoding="UTF-8"?>\n<urlset xmlns="{SITEMAP_NS}">\n')
+        for name in ('product_list', 'shop', 'contact', 'tutorial'):
+            f.write(_url_entry(base_url + reverse(name)))
+        for slug, updated_at in Page.objects.filter(is_active=True).values_list('slug', 'updated_at').iterator():
+            f.write(_url_entry(base_url + reverse('page_detail', args=[slug]), updated_at))
+        f.write('</urlset>\n')
+
+
+def write_sitemap_index(base_url, signatures):
+    with _AtomicFile(feed_path('sitemap.xml'), 'w') as f:
+        f.write(f'<?xml version="1.0" encoding="UTF-8"?>\n<sitemapindex xmlns="{SITEMAP_NS}">\n')
+        f.write(f'<sitemap><loc>{escape(base_url + reverse("sitemap_section", args=["sitemap-pages.xml.gz"]))}</loc></sitemap>\n')
+        for chunk in sorted(signatures, key=int):
+            loc = base_url + reverse('sitemap_section', args=[_sitemap_name(chunk)])
+            lastmod = signatures[chunk].split(':', 1)[1]
+            f.write(f'<sitemap><loc>{escape(loc)}</loc><lastmod>{lastmod}</lastmod></sitemap>\n')
+        f.write('</sitemapindex>\n')
+
+
+def assemble_feed(fmt, chunks, base_url, brand):
+    """Concatenate header + per-chunk gzip members + footer into products.<fmt>.gz."""
+    with _AtomicFile(feed_path(f'products.{fmt}.gz')) as out:
+        with gzip.GzipFile(filename='', mode='wb', fileobj=out, mtime=0) as head:
+            if fmt == 'xml':
+                head.write((
+                    '<?xml version="1.0" encoding="UTF-8"?>\n'
+                    '<rss version="2.0" xmlns:g="http://base.google.com/ns/1.0">\n<channel>\n'
+                    f'<title>{escape(brand)}</title>\n<link>{escape(base_url)}/</link>\n'
+                ).encode())
+            else:
+                head.write((','.join(CSV_COLUMNS) + '\r\n').encode())
+        for chunk in chunks:
+            with open(_part_path(fmt, chunk), 'rb') as part:
+                shutil.copyfileobj(part, out)
+        if fmt == 'xml':
+            with gzip.GzipFile(filename='', mode='wb', fileobj=out, mtime=0) as tail:
+                tail.write(b'</channel>\n</rss>\n')
+
+
+def load_manifest():
+    try:
+        with open(feed_path('manifest.json')) as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+def refresh(base_url=None, force=False):
+    """
+    Bring the files under FEEDS_ROOT up to date for `base_url` (default:
+    SITE_URL). Returns the number of product chunks regenerated, or None when
+    nothing had changed or another build is already running.
+    """
+    base_url = (base_url or settings.SITE_URL).rstrip('/')
+    if not base_url:
+        raise ImproperlyConfigured('Set SITE_URL to the public site URL to build sitemaps and feeds.')
+    feeds_root().mkdir(parents=True, exist_ok=True)
+    with open(feeds_root() / '.lock', 'w') as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return None
+        return _refresh(base_url, force)
+
+
+def _refresh(base_url, force):
+    manifest = load_manifest()
+    stamp = [versions.get('catalog'), versions.get('site'), versions.get('pages')]
+    if not force and manifest.get('stamp') == stamp and manifest.get('base_url') == base_url \
+            and feed_path('sitemap.xml').exists():
+        return None
+
+    site = siteconfig.get().settings
+    brand = site.site_name if site else ''
+    # Base URL or brand changes touch every row
+    full = force or manifest.get('base_url') != base_url or manifest.get('brand') != brand
+    old = {} if full else manifest.get('chunks', {})
+    signatures = chunk_signatures()
+    chunks = sorted(signatures, key=int)
+
+    rebuilt = 0
+    for chunk in chunks:
+        stale = old.get(chunk) != signatures[chunk] or not all(
+            _part_path(fmt, chunk).exists() for fmt in FEED_FORMATS
+        )
+        if stale:
+            write_chunk(chunk, base_url, brand)
+            rebuilt += 1
+    for chunk in set(manifest.get('chunks', {})) - set(signatures):
+        remove_chunk(chunk)
+
+    write_pages_sitemap(base_url)
+    write_sitemap_index(base_url, signatures)
+    for fmt in FEED_FORMATS:
+        assemble_feed(fmt, chunks, base_url, brand)
+
+    with _AtomicFile(feed_path('manifest.json'), 'w') as f:
+        json.dump({'stamp': stamp, 'base_url': base_url, 'brand': brand, 'chunks': signatures}, f)
+    return rebuilt
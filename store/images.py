@@ -0,0 +1,237 @@
+"""
+Responsive image derivatives.
+
+Local media images (product photos, hero slides, payment proofs) are resized
+with Pillow into WebP/JPEG variants on first request, or eagerly after upload.
+Variants live in a content-addressed cache directory: the file name is derived
+from the source file's SHA-256 plus the requested width/format, so identical
+uploads share derivatives and a replaced source never serves a stale variant.
+The directory is bounded by IMAGE_DERIVATIVE_MAX_BYTES; hits bump the file
+mtime and the least recently used variants are evicted first. Each process
+keeps a running estimate of the directory size (last scan plus what it wrote
+since) and only rescans when that passes the limit, or every RESCAN_SECONDS
+to pick up what other workers wrote.
+"""
+import hashlib
+import io
+import os
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from urllib.parse import unquote
+
+from django.conf import settings
+from django.core.cache import caches
+from django.urls import reverse
+from PIL import Image, ImageOps
+
+from .storage import BLOB_PREFIX
+
+# Widths templates may ask for. Anything else is rejected so the cache cannot
+# be filled with arbitrary sizes.
+WIDTHS = (80, 160, 240, 320, 480, 640, 800, 1024, 1280, 1920)
+FORMATS = {
+    'webp': ('WEBP', 'image/webp'),
+    'jpeg': ('JPEG', 'image/jpeg'),
+}
+SOURCE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.gif', '.webp')
+QUALITY = 80
+RESCAN_SECONDS = 5 * 60
+
+# Eager resizes after uploads; bounded so an import of many images doesn't
+# decode them all at once in every worker
+_pregenerate_pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix='derivatives')
+
+
+def cache_root():
+    return Path(getattr(settings, 'IMAGE_DERIVATIVE_ROOT', settings.BASE_DIR / 'cache' / 'images'))
+
+
+def max_cache_bytes():
+    return getattr(settings, 'IMAGE_DERIVATIVE_MAX_BYTES', 512 * 1024 * 1024)
+
+
+def media_name_from_url(url):
+    """Map a /media/... URL back to its storage name; None for remote URLs."""
+    if not url:
+        return None
+    media_url = settings.MEDIA_URL
+    if not url.startswith(media_url):
+        return None
+    return unquote(url[len(media_url):])
+
+
+def source_path(name):
+    """Absolute path of a media file, refusing anything outside MEDIA_ROOT."""
+    root = Path(settings.MEDIA_ROOT).resolve()
+    path = (root / name).resolve()
+    if root not in path.parents or path.suffix.lower() not in SOURCE_EXTENSIONS:
+        return None
+    return path if path.is_file() else None
+
+
+def source_digest(path):
+    """SHA-256 of a source file, memoised on (path, size, mtime)."""
+    if path.parent.parent.parent.name == BLOB_PREFIX:
+        # Content-addressed blobs are already named by their digest
+        return path.stem
+    stat = path.stat()
+    key = 'imgsrc:' + hashlib.md5(f'{path}:{stat.st_size}:{stat.st_mtime_ns}'.encode()).hexdigest()
+    # Per process: the key already changes with the file, nothing needs invalidating
+    cache = caches['local']
+    digest = cache.get(key)
+    if digest is None:
+        h = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(64 * 1024), b''):
+                h.update(chunk)
+        digest = h.hexdigest()
+        cache.set(key, digest, 60 * 60 * 24)
+    return digest
+
+
+def derivative_path(digest, width, fmt):
+    key = hashlib.sha256(f'{digest}:{width}:{fmt}:{QUALITY}'.encode()).hexdigest()
+    return cache_root() / key[:2] / f'{key}.{fmt}'
+
+
+def render(path, width, fmt):
+    """Resize the source to at most `width` pixels wide and encode it."""
+    pil_format, _ = FORMATS[fmt]
+    with Image.open(path) as img:
+        img = ImageOps.exif_transpose(img)
+        if img.width > width:
+            img.thumbnail((width, img.height), Image.LANCZOS)
+        if fmt == 'jpeg' or img.mode not in ('RGB', 'RGBA'):
+            if img.mode in ('RGBA', 'LA', 'P'):
+                img = img.convert('RGBA')
+                if fmt == 'jpeg':
+                    background = Image.new('RGB', img.size, (255, 255, 255))
+                    background.paste(img, mask=img.split()[-1])
+                    img = background
+            else:
+                img = img.convert('RGB')
+        buf = io.BytesIO()
+        img.save(buf, pil_format, quality=QUALITY, optimize=True)
+    return buf.getvalue()
+
+
+def get_derivative(name, width, fmt='webp'):
+    """
+    Return the filesystem path of the derivative for media file `name`,
+    generating it if needed. Returns None if the source is missing/invalid.
+    """
+    if width not in WIDTHS or fmt not in FORMATS:
+        return None
+    src = source_path(name)
+    if src is None:
+        return None
+    target = derivative_path(source_digest(src), width, fmt)
+    if target.exists():
+        # Bump mtime so eviction treats the file as recently used
+        os.utime(target)
+        return target
+
+    try:
+        data = render(src, width, fmt)
+    except (OSError, ValueError, Image.DecompressionBombError):
+        # Corrupt, truncated or not really an image (UnidentifiedImageError is an
+        # OSError), or so large that decoding it is refused
+        return None
+    target.parent.mkdir(parents=True, exist_ok=True)
+    # Write to a temp file and rename so concurrent requests never see a partial file
+    fd, tmp = tempfile.mkstemp(dir=target.parent, suffix='.tmp')
+    with os.fdopen(fd, 'wb') as f:
+        f.write(data)
+    os.replace(tmp, target)
+    _account(len(data))
+    return target
+
+
+def pregenerate(name, widths, fmt='webp'):
+    """Eagerly build derivatives after an upload; failures are non-fatal."""
+    for width in widths:
+        try:
+            get_derivative(name, width, fmt)
+        except (OSError, ValueError):
+            pass
+
+
+def pregenerate_in_background(name, widths, fmt='webp'):
+    """Queue pregenerate() on the worker pool, so an upload's save isn't held up by resizing."""
+    _pregenerate_pool.submit(pregenerate, name, widths, fmt)
+
+
+_size_lock = threading.Lock()
+_size_estimate = None  # bytes as of the last scan plus this process's writes since
+_scanned_at = 0.0
+
+
+def _account(size):
+    """Add a written derivative to the size estimate; evict() once it may be over the limit."""
+    global _size_estimate
+    with _size_lock:
+        if _size_estimate is not None and time.monotonic() - _scanned_at < RESCAN_SECONDS:
+            _size_estimate += size
+            if _size_estimate <= max_cache_bytes():
+                return
+    evict()
+
+
+def _scanned(total):
+    global _size_estimate, _scanned_at
+    with _size_lock:
+        _size_estimate, _scanned_at = total, time.monotonic()
+
+
+def evict(limit=None):
+    """Delete least recently used derivatives until the cache fits in `limit` bytes."""
+    limit = max_cache_bytes() if limit is None else limit
+    root = cache_root()
+    if not root.exists():
+        _scanned(0)
+        return 0
+    entries = []
+    total = 0
+    for shard in os.scandir(root):
+        if not shard.is_dir():
+            continue
+        for entry in os.scandir(shard.path):
+            if entry.is_file() and not entry.name.endswith('.tmp'):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+                total += stat.st_size
+    if total <= limit:
+        _scanned(total)
+        return 0
+    entries.sort()
+    removed = 0
+    # Evict down to 90% so the next few writes don't trigger another scan
+    target = limit * 0.9
+    for _, size, entry_path in entries:
+        if total <= target:
+            break
+        try:
+            os.remove(entry_path)
+        except FileNotFoundError:
+            continue
+        total -= size
+        removed += 1
+    _scanned(total)
+    return removed
+
+
+def derivative_url(url, width, fmt='webp'):
+    """URL of a resized variant for local media; remote URLs are returned as-is."""
+    name = media_name_from_url(url)
+    if name is None or width not in WIDTHS:
+        return url
+    return reverse('image_derivative', kwargs={'width': width, 'fmt': fmt, 'name': name})
+
+
+def derivative_srcset(url, widths, fmt='webp'):
+    if media_name_from_url(url) is None:
+        return ''
+    return ', '.join(f'{derivative_url(url, w, fmt)} {w}w' for w in widths if w in WIDTHS)
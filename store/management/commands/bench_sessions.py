@@ -0,0 +1,63 @@
+from collections import Counter
+
+from django.conf import settings
+from django.contrib.sessions.models import Session
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test import Client
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+from store.models import Page, Product
+
+
+class Command(BaseCommand):
+    help = (
+        'Browse the storefront with the test client (anonymous, then with a cart) and '
+        'report django_session reads and writes per page view'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--views', type=int, default=20, help='Page views per scenario')
+
+    def handle(self, *args, **options):
+        products = list(Product.objects.filter(is_active=True, stock__gt=0).values_list('id', 'slug')[:5])
+        if not products:
+            self.stderr.write('No active products in stock to browse.')
+            return
+        pages = [reverse('product_list'), reverse('shop'), reverse('contact')]
+        pages += [reverse('product_detail', args=[slug]) for _, slug in products]
+        pages += [reverse('page_detail', args=[slug]) for slug in Page.objects.filter(is_active=True).values_list('slug', flat=True)[:2]]
+
+        views = options['views']
+        anonymous = Client()
+        self._measure('invalid coupon', views, lambda i: anonymous.post(reverse('coupon_apply'), {'code': 'NO-SUCH-CODE'}))
+        self._measure('anonymous, no cart', views, lambda i: anonymous.get(pages[i % len(pages)]))
+
+        shopper = Client()
+        shopper.post(reverse('cart_add', args=[products[0][0]]), {'quantity': 1})
+        pages.append(reverse('cart_view'))
+        self._measure('with cart', views, lambda i: shopper.get(pages[i % len(pages)]))
+        self._measure(
+            'adding to cart', views,
+            lambda i: shopper.post(reverse('cart_add', args=[products[i % len(products)][0]]), {'quantity': 1}),
+        )
+
+        # Don't leave the benchmark's sessions behind
+        keys = [c.cookies[settings.SESSION_COOKIE_NAME].value for c in (anonymous, shopper) if settings.SESSION_COOKIE_NAME in c.cookies]
+        Session.objects.filter(session_key__in=keys).delete()
+
+    def _measure(self, label, views, request):
+        counts = Counter()
+        for i in range(views):
+            with CaptureQueriesContext(connection) as ctx:
+                request(i)
+            for query in ctx.captured_queries:
+                sql = query['sql']
+                if '"django_session"' not in sql:
+                    continue
+                counts['reads' if sql.lstrip().upper().startswith('SELECT') else 'writes'] += 1
+        self.stdout.write(
+            f"{label:<20} {views} views: {counts['reads'] / views:.2f} session reads, "
+            f"{counts['writes'] / views:.2f} session writes per view"
+        )
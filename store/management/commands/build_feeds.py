@@ -0,0 +1,21 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from store import feeds
+
+
+class Command(BaseCommand):
+    help = 'Regenerate sitemap.xml and the product feeds for changed products (run from cron)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--base-url', default=settings.SITE_URL, help='Public site URL, e.g. https://printsmart.hk (default: SITE_URL)')
+        parser.add_argument('--full', action='store_true', help='Rebuild every chunk, not only the changed ones')
+
+    def handle(self, *args, **options):
+        if not options['base_url']:
+            raise CommandError('Set SITE_URL or pass --base-url.')
+        rebuilt = feeds.refresh(options['base_url'], force=options['full'])
+        if rebuilt is None:
+            self.stdout.write('Feeds are up to date (or another build is running).')
+        else:
+            self.stdout.write(self.style.SUCCESS(f'Regenerated {rebuilt} product chunk(s) in {feeds.feeds_root()}.'))
@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand
+from store.recommendations import METRICS, build
+
+
+class Command(BaseCommand):
+    help = 'Build "frequently bought together" recommendations from order baskets (incremental)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--full', action='store_true', help='Discard stored counts and rebuild from all orders')
+        parser.add_argument('--metric', choices=METRICS, default='cosine', help='Similarity used for ranking')
+        parser.add_argument('--top', type=int, default=8, help='Neighbours stored per product')
+        parser.add_argument('--min-support', type=int, default=1, help='Minimum number of shared orders')
+
+    def handle(self, *args, **options):
+        run = build(
+            full=options['full'],
+            metric=options['metric'],
+            top_n=options['top'],
+            min_support=options['min_support'],
+        )
+        self.stdout.write(self.style.SUCCESS(
+            f'Processed orders up to #{run.last_order_id} ({run.basket_count} baskets in total); '
+            f'updated recommendations for {run.products_updated} product(s).'
+        ))
@@ -0,0 +1,122 @@
+import os
+import re
+import time
+from collections import Counter
+from urllib.parse import unquote
+
+from django.apps import apps
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand
+from django.db import models, transaction
+
+from store.storage import BLOB_PREFIX, is_blob
+
+
+def file_fields():
+    for model in apps.get_models():
+        if model._meta.proxy or not model._meta.managed:
+            continue
+        for field in model._meta.get_fields():
+            if isinstance(field, models.FileField):
+                yield model, field
+
+
+def text_fields():
+    """TextFields (including CKEditor RichTextFields), which may embed media URLs in HTML."""
+    for model in apps.get_models():
+        if model._meta.proxy or not model._meta.managed:
+            continue
+        for field in model._meta.get_fields():
+            if isinstance(field, models.TextField):
+                yield model, field
+
+
+def reference_counts():
+    """How many rows point at each stored file name, across every FileField and text field."""
+    counts = Counter()
+    for model, field in file_fields():
+        rows = (
+            model.objects.exclude(**{field.name: ''}).exclude(**{f'{field.name}__isnull': True})
+            .values(field.name).annotate(n=models.Count('pk')).order_by()
+        )
+        for row in rows:
+            counts[row[field.name]] += row['n']
+    # Images inserted in the rich text editor are only referenced by URL
+    media_url = re.compile(re.escape(settings.MEDIA_URL) + r'([^"\'\s<>?#)]+)')
+    for model, field in text_fields():
+        texts = model.objects.filter(**{f'{field.name}__contains': settings.MEDIA_URL}).values_list(field.name, flat=True)
+        for text in texts.iterator():
+            for name in media_url.findall(text):
+                counts[unquote(name)] += 1
+    return counts
+
+
+class Command(BaseCommand):
+    help = 'Garbage-collect unreferenced media blobs (and optionally move legacy files into the blob store)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help='Report only, do not delete or move anything')
+        parser.add_argument('--adopt', action='store_true', help='Re-store legacy (non-blob) referenced files as deduplicated blobs')
+        parser.add_argument('--grace', type=int, default=3600,
+                            help='Keep unreferenced blobs younger than this many seconds (uploads not yet committed)')
+
+    def handle(self, *args, **options):
+        dry_run = options['dry_run']
+        if options['adopt']:
+            self.adopt_legacy_files(dry_run)
+
+        counts = reference_counts()
+        root = default_storage.path(BLOB_PREFIX)
+        cutoff = time.time() - options['grace']
+        removed = kept = freed = 0
+        for dirpath, dirnames, filenames in os.walk(root):
+            for fname in filenames:
+                full = os.path.join(dirpath, fname)
+                name = os.path.relpath(full, default_storage.location).replace(os.sep, '/')
+                if counts[name] or os.path.getmtime(full) > cutoff:
+                    kept += 1
+                    continue
+                size = os.path.getsize(full)
+                if not dry_run:
+                    os.remove(full)
+                removed += 1
+                freed += size
+
+        prefix = '[dry-run] ' if dry_run else ''
+        self.stdout.write(self.style.SUCCESS(
+            f'{prefix}Removed {removed} unreferenced blob(s), freed {freed / 1024 / 1024:.2f} MB; {kept} blob(s) kept.'
+        ))
+
+    def adopt_legacy_files(self, dry_run):
+        adopted = freed = 0
+        for model, field in file_fields():
+            names = (
+                model.objects.exclude(**{field.name: ''}).exclude(**{f'{field.name}__isnull': True})
+                .values_list(field.name, flat=True).distinct()
+            )
+            for old_name in list(names):
+                if is_blob(old_name) or not default_storage.exists(old_name):
+                    continue
+                size = default_storage.size(old_name)
+                if dry_run:
+                    adopted += 1
+                    continue
+                with default_storage.open(old_name, 'rb') as f:
+                    new_name = default_storage.save(old_name, f)
+                with transaction.atomic():
+                    model.objects.filter(**{field.name: old_name}).update(**{field.name: new_name})
+                adopted += 1
+                # The legacy file may still be used by another model/field; only
+                # remove it once nothing references it anymore.
+                if not any(m.objects.filter(**{f.name: old_name}).exists() for m, f in file_fields()):
+                    os.remove(default_storage.path(old_name))
+                    freed += size
+        if adopted and not dry_run:
+            # primary_image caches a resolved URL rather than a file reference
+            from store.models import Product
+            for product in Product.objects.filter(primary_image__startswith=settings.MEDIA_URL):
+                product.refresh_primary_image()
+
+        prefix = '[dry-run] ' if dry_run else ''
+        self.stdout.write(f'{prefix}Adopted {adopted} legacy file(s) into the blob store, freed {freed / 1024 / 1024:.2f} MB.')
@@ -0,0 +1,176 @@
+import random
+import re
+import threading
+import time
+import uuid
+from collections import Counter, defaultdict
+from datetime import timedelta
+
+from django.conf import settings
+from django.contrib.sessions.models import Session
+from django.core.management.base import BaseCommand, CommandError
+from django.db import OperationalError, connection
+from django.db.models import Sum
+from django.test import Client
+from django.test.utils import setup_test_environment, teardown_test_environment
+from django.urls import reverse
+from django.utils import timezone
+
+from analytics.models import PageVisit
+from store.models import Coupon, Order, OrderItem, Product
+from store.signals import deferred_order_totals
+
+PERCENTILES = (50, 90, 99)
+# response.context is collected through a global signal, so with many threads it
+# may belong to another customer's request; read the form fields from the HTML
+HIDDEN_INPUT = re.compile(r'<input type="hidden" name="(idempotency_key|grand_total)" value="([^"]*)">')
+
+
+def _percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, round(p / 100 * (len(values) - 1)))]
+
+
+class Command(BaseCommand):
+    help = (
+        'Simulate concurrent customers who browse, add to cart, apply a coupon and check out '
+        'through the test client, then report orders per second, latency percentiles, '
+        'database lock errors and stock consistency. Creates throwaway (active) products, '
+        'a coupon, orders and page visits and deletes them afterwards: run it against a staging database.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--customers', type=int, default=16, help='Concurrent customers (threads)')
+        parser.add_argument('--rounds', type=int, default=5, help='Checkouts per customer')
+        parser.add_argument('--products', type=int, default=5, help='Throwaway products to sell')
+        parser.add_argument('--stock', type=int, default=50, help='Starting stock of each product')
+        parser.add_argument('--max-qty', type=int, default=3, help='Each cart line has 1..max-qty units')
+        parser.add_argument('--coupon-limit', type=int, default=None, help='Total usage limit of the coupon')
+
+    def handle(self, *args, **options):
+        tag = uuid.uuid4().hex[:8]
+        domain = f'load-{tag}.invalid'
+        # Marks the page visits AnalyticsMiddleware records for the simulated browsing
+        user_agent = f'load_checkout/{tag}'
+        # Test client without ALLOWED_HOSTS surprises, and outgoing mail kept in memory
+        setup_test_environment()
+        products = Product.objects.bulk_create([
+            Product(name=f'Load test {tag} #{i}', slug=f'load-test-{tag}-{i}', sku=f'LOAD-{tag}-{i}', price=100, stock=options['stock'])
+            for i in range(options['products'])
+        ])
+        now = timezone.now()
+        coupon = Coupon.objects.create(
+            code=f'LOAD{tag}', discount_type='percent', discount=10, max_uses=options['coupon_limit'],
+            valid_from=now - timedelta(minutes=1), valid_to=now + timedelta(hours=1),
+        )
+        timings = defaultdict(list)
+        results = Counter()
+        lock = threading.Lock()
+        start = threading.Barrier(options['customers'])
+        session_keys = []
+
+        def customer(n):
+            client = Client(HTTP_USER_AGENT=user_agent)
+            local_timings = defaultdict(list)
+            local = Counter()
+
+            def step(name, method, path, data=None, **kwargs):
+                began = time.perf_counter()
+                response = getattr(client, method)(path, data, **kwargs)
+                local_timings[name].append(time.perf_counter() - began)
+                if response.status_code >= 500:
+                    raise RuntimeError(f'{name}: HTTP {response.status_code}')
+                return response
+
+            try:
+                start.wait()
+                for _ in range(options['rounds']):
+                    try:
+                        # A rejected checkout leaves its cart behind; start every round empty
+                        for line in list(client.session.get('cart') or {}):
+                            step('remove', 'get', reverse('cart_remove', args=[int(line)]))
+                        product = random.choice(products)
+                        step('browse', 'get', reverse('product_list'))
+                        step('product', 'get', reverse('product_detail', args=[product.slug]))
+                        step('add to cart', 'post', reverse('cart_add', args=[product.pk]), {
+                            'quantity': random.randint(1, options['max_qty']),
+                        })
+                        step('apply coupon', 'post', reverse('coupon_apply'), {'code': coupon.code})
+                        page = step('checkout page', 'get', reverse('checkout'))
+                        if page.status_code != 200:
+                            # Sold out before checkout even opened
+                            local['no_checkout'] += 1
+                            continue
+                        form = dict(HIDDEN_INPUT.findall(page.content.decode()))
+                        response = step('place order', 'post', reverse('checkout'), {
+                            'customer_name': f'Load test {n}', 'email': f'customer{n}@{domain}',
+                            'phone': '0', 'address': 'Load test', **form,
+                        })
+                        if response.status_code == 302 and '/order/success/' in response['Location']:
+                            local['placed'] += 1
+                        else:
+                            local['rejected'] += 1
+                    except OperationalError as e:
+                        local['lock_errors' if 'locked' in str(e) else 'db_errors'] += 1
+                    except Exception:
+                        local['errors'] += 1
+            finally:
+                connection.close()
+                with lock:
+                    results.update(local)
+                    for name, values in local_timings.items():
+                        timings[name].extend(values)
+                    if settings.SESSION_COOKIE_NAME in client.cookies:
+                        session_keys.append(client.cookies[settings.SESSION_COOKIE_NAME].value)
+
+        threads = [threading.Thread(target=customer, args=(n,)) for n in range(options['customers'])]
+        began = time.perf_counter()
+        try:
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            elapsed = time.perf_counter() - began
+            product_ids = [p.pk for p in products]
+            final_stock = Product.objects.filter(pk__in=product_ids).aggregate(n=Sum('stock'))['n'] or 0
+            sold = OrderItem.objects.filter(product_id__in=product_ids).aggregate(n=Sum('quantity'))['n'] or 0
+            orders_placed = Order.objects.filter(email__endswith=f'@{domain}').count()
+            coupon.refresh_from_db()
+        finally:
+            with deferred_order_totals(recompute=False):
+                Order.objects.filter(email__endswith=f'@{domain}').delete()
+            Product.objects.filter(pk__in=[p.pk for p in products]).delete()
+            coupon.delete()
+            Session.objects.filter(session_key__in=session_keys).delete()
+            PageVisit.objects.filter(user_agent=user_agent).delete()
+            teardown_test_environment()
+
+        self._report(options, results, timings, elapsed, orders_placed)
+        initial_stock = options['stock'] * options['products']
+        self.stdout.write(f'Stock {initial_stock} -> {final_stock}, {sold} units in orders')
+        if options['coupon_limit'] is not None:
+            self.stdout.write(f"Coupon redeemed {coupon.used_count} of {options['coupon_limit']} times")
+        if final_stock < 0 or final_stock != initial_stock - sold:
+            raise CommandError(f'Inconsistent: {initial_stock - final_stock} units left stock but {sold} are in orders.')
+        if options['coupon_limit'] is not None and coupon.used_count > options['coupon_limit']:
+            raise CommandError('Coupon redeemed more often than its limit.')
+        self.stdout.write(self.style.SUCCESS('Stock and orders are consistent.'))
+
+    def _report(self, options, results, timings, elapsed, orders_placed):
+        attempts = options['customers'] * options['rounds']
+        self.stdout.write(
+            f"{connection.vendor}: {options['customers']} customers x {options['rounds']} rounds in {elapsed:.2f}s, "
+            f"{orders_placed / elapsed:.1f} orders/s"
+        )
+        self.stdout.write(
+            f"{attempts} checkouts: {orders_placed} orders in the database, {results['placed']} confirmed to the customer, "
+            f"{results['rejected']} rejected, "
+            f"{results['no_checkout']} sold out before checkout, {results['lock_errors']} 'database is locked', "
+            f"{results['db_errors']} other database errors, {results['errors']} other errors"
+        )
+        header = ' '.join(f'p{p:<6}' for p in PERCENTILES)
+        self.stdout.write(f"{'latency (ms)':<16}{'n':>6}  {header}")
+        for name, values in timings.items():
+            if values:
+                cells = ' '.join(f'{_percentile(values, p) * 1000:<7.1f}' for p in PERCENTILES)
+                self.stdout.write(f'{name:<16}{len(values):>6}  {cells}')
@@ -0,0 +1,15 @@
+from dbbackup.management.commands import mediarestore
+
+from store.storage import preserving_names
+
+
+class Command(mediarestore.Command):
+    """
+    dbbackup's mediarestore, but files keep the names in the backup instead
+    of being re-stored as content-addressed blobs (the restored database
+    refers to them by those names).
+    """
+
+    def handle(self, *args, **options):
+        with preserving_names():
+            return super().handle(*args, **options)
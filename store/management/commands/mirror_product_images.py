@@ -0,0 +1,34 @@
+from django.core.management.base import BaseCommand
+from store.mirror import mirror_product_images, pending_images
+
+
+class Command(BaseCommand):
+    help = 'Download remote product image_urls into local media (incremental)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=8, help='Download threads')
+        parser.add_argument('--per-host', type=int, default=2, help='Max concurrent downloads per host')
+        parser.add_argument('--timeout', type=float, default=10, help='Per-request timeout (seconds)')
+        parser.add_argument('--retries', type=int, default=2, help='Retries for timeouts and 5xx errors')
+        parser.add_argument('--limit', type=int, default=None, help='Only process this many images')
+        parser.add_argument('--product', type=int, action='append', dest='product_ids', help='Restrict to product ID (repeatable)')
+
+    def handle(self, *args, **options):
+        pending = pending_images(options['product_ids']).count()
+        if not pending:
+            self.stdout.write(self.style.SUCCESS('All product images are already mirrored.'))
+            return
+        self.stdout.write(f'Mirroring up to {pending} image(s)...')
+
+        stats = mirror_product_images(
+            product_ids=options['product_ids'],
+            workers=options['workers'],
+            per_host=options['per_host'],
+            timeout=options['timeout'],
+            retries=options['retries'],
+            limit=options['limit'],
+            log=lambda msg: self.stdout.write(self.style.WARNING(msg)),
+        )
+        self.stdout.write(self.style.SUCCESS(
+            f"Downloaded {stats['downloaded']} file(s), updated {stats['updated']} image(s), {stats['failed']} failed."
+        ))
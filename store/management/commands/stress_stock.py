@@ -0,0 +1,77 @@
+import random
+import threading
+import time
+import uuid
+from collections import Counter
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import OperationalError, connection
+
+from store import orders
+from store.models import Product
+
+
+class Command(BaseCommand):
+    help = (
+        'Hammer the checkout stock decrement from many threads against a throwaway, '
+        'inactive product and verify that nothing was oversold'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--threads', type=int, default=32)
+        parser.add_argument('--attempts', type=int, default=20, help='Checkout attempts per thread')
+        parser.add_argument('--stock', type=int, default=200, help='Starting stock of the test product')
+        parser.add_argument('--max-qty', type=int, default=3, help='Each attempt buys 1..max-qty units')
+
+    def handle(self, *args, **options):
+        initial = options['stock']
+        tag = uuid.uuid4().hex[:8]
+        product = Product.objects.create(
+            name=f'Stock stress test {tag}', sku=f'STRESS-{tag}', price=1, stock=initial, is_active=False,
+        )
+        results = Counter()
+        lock = threading.Lock()
+        start = threading.Barrier(options['threads'])
+
+        def worker():
+            sold = placed = rejected = errors = 0
+            try:
+                start.wait()
+                for _ in range(options['attempts']):
+                    qty = random.randint(1, options['max_qty'])
+                    try:
+                        orders.decrement_stock({product.pk: qty})
+                    except orders.InsufficientStock:
+                        rejected += 1
+                    except OperationalError:
+                        # e.g. SQLite "database is locked" under heavy write contention
+                        errors += 1
+                    else:
+                        sold += qty
+                        placed += 1
+            finally:
+                connection.close()
+                with lock:
+                    results.update(sold=sold, placed=placed, rejected=rejected, errors=errors)
+
+        threads = [threading.Thread(target=worker) for _ in range(options['threads'])]
+        began = time.perf_counter()
+        try:
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            elapsed = time.perf_counter() - began
+            final = Product.objects.filter(pk=product.pk).values_list('stock', flat=True).get()
+        finally:
+            product.delete()
+
+        attempts = options['threads'] * options['attempts']
+        self.stdout.write(
+            f"{attempts} attempts in {elapsed:.2f}s: {results['placed']} placed ({results['sold']} units), "
+            f"{results['rejected']} rejected for stock, {results['errors']} database errors; "
+            f"stock {initial} -> {final}"
+        )
+        if final < 0 or results['sold'] > initial or final != initial - results['sold']:
+            raise CommandError(f"Oversold: {results['sold']} units sold from a stock of {initial}, {final} left.")
+        self.stdout.write(self.style.SUCCESS('No overselling.'))
@@ -0,0 +1,12 @@
+from django.core.management.base import BaseCommand
+
+from store import orders, reservations
+
+
+class Command(BaseCommand):
+    help = 'Delete expired checkout stock reservations and idempotency keys (run from cron)'
+
+    def handle(self, *args, **options):
+        holds = reservations.sweep()
+        keys = orders.sweep_idempotency_keys()
+        self.stdout.write(self.style.SUCCESS(f'Deleted {holds} expired reservation(s) and {keys} idempotency key(s).'))
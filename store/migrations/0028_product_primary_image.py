@@ -0,0 +1,36 @@
+# Generated by Django 5.2.9 on 2026-10-19 11:38
+
+from django.db import migrations, models
+
+
+def populate_primary_image(apps, schema_editor):
+    Product = apps.get_model('store', 'Product')
+    ProductImage = apps.get_model('store', 'ProductImage')
+    for product in Product.objects.all().iterator():
+        url = ''
+        if product.image:
+            url = product.image.url
+        elif product.image_url:
+            url = product.image_url
+        else:
+            first_img = ProductImage.objects.filter(product=product).order_by('sort_order', 'id').first()
+            if first_img:
+                url = first_img.image.url if first_img.image else first_img.image_url
+        if url:
+            Product.objects.filter(pk=product.pk).update(primary_image=url)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0027_alter_order_created_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='product',
+            name='primary_image',
+            field=models.CharField(blank=True, editable=False, max_length=500, verbose_name='主圖片'),
+        ),
+        migrations.RunPython(populate_primary_image, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,60 @@
+# Generated by Django 5.2.9 on 2026-10-19 11:44
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0028_product_primary_image'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RecommendationRun',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('last_order_id', models.BigIntegerField(default=0, verbose_name='最後處理訂單 ID')),
+                ('basket_count', models.PositiveIntegerField(default=0, verbose_name='累計訂單數')),
+                ('metric', models.CharField(max_length=20, verbose_name='計分方式')),
+                ('products_updated', models.PositiveIntegerField(default=0, verbose_name='更新商品數')),
+                ('finished_at', models.DateTimeField(auto_now_add=True, verbose_name='完成時間')),
+            ],
+            options={
+                'verbose_name': '推薦計算紀錄',
+                'verbose_name_plural': '推薦計算紀錄',
+                'ordering': ['-id'],
+            },
+        ),
+        migrations.CreateModel(
+            name='ProductCooccurrence',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('count', models.PositiveIntegerField(default=0, verbose_name='次數')),
+                ('other', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='store.product', verbose_name='相關商品')),
+                ('product', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='store.product', verbose_name='商品')),
+            ],
+            options={
+                'verbose_name': '商品共同購買次數',
+                'verbose_name_plural': '商品共同購買次數',
+                'unique_together': {('product', 'other')},
+            },
+        ),
+        migrations.CreateModel(
+            name='ProductRecommendation',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('score', models.FloatField(verbose_name='分數')),
+                ('rank', models.PositiveSmallIntegerField(verbose_name='排名')),
+                ('product', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='recommendations', to='store.product', verbose_name='商品')),
+                ('recommended', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='store.product', verbose_name='推薦商品')),
+            ],
+            options={
+                'verbose_name': '推薦商品',
+                'verbose_name_plural': '推薦商品',
+                'ordering': ['product', 'rank'],
+                'unique_together': {('product', 'rank')},
+            },
+        ),
+    ]
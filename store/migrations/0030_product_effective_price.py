@@ -0,0 +1,33 @@
+# Generated by Django 5.2.9 on 2026-10-19 11:45
+
+from django.db import migrations, models
+from django.db.models.functions import Coalesce
+
+
+def populate_effective_price(apps, schema_editor):
+    Product = apps.get_model('store', 'Product')
+    Product.objects.update(effective_price=Coalesce('discount_price', 'price'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0029_product_recommendations'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='product',
+            name='effective_price',
+            field=models.DecimalField(decimal_places=2, default=0, editable=False, max_digits=10, verbose_name='實際售價'),
+        ),
+        migrations.RunPython(populate_effective_price, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='product',
+            index=models.Index(fields=['is_active', 'effective_price'], name='product_active_price_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='product',
+            index=models.Index(fields=['is_active', '-created_at'], name='product_active_created_idx'),
+        ),
+    ]
@@ -0,0 +1,53 @@
+# Generated by Django 5.2.9 on 2026-10-19 12:11
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0033_idempotencykey'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='coupon',
+            name='categories',
+            field=models.ManyToManyField(blank=True, help_text='留空表示全店商品適用', related_name='coupons', to='store.category', verbose_name='適用分類'),
+        ),
+        migrations.AddField(
+            model_name='coupon',
+            name='max_uses',
+            field=models.PositiveIntegerField(blank=True, help_text='留空表示不限次數', null=True, verbose_name='總使用上限'),
+        ),
+        migrations.AddField(
+            model_name='coupon',
+            name='max_uses_per_customer',
+            field=models.PositiveIntegerField(blank=True, help_text='留空表示不限次數', null=True, verbose_name='每位客戶使用上限'),
+        ),
+        migrations.AddField(
+            model_name='coupon',
+            name='min_spend',
+            field=models.DecimalField(decimal_places=2, default=0, help_text='適用商品的小計需達此金額', max_digits=10, verbose_name='最低消費'),
+        ),
+        migrations.AddField(
+            model_name='coupon',
+            name='used_count',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='已使用次數'),
+        ),
+        migrations.CreateModel(
+            name='CouponUsage',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('customer', models.CharField(max_length=260, verbose_name='客戶')),
+                ('count', models.PositiveIntegerField(default=0, verbose_name='使用次數')),
+                ('coupon', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='usages', to='store.coupon', verbose_name='優惠券')),
+            ],
+            options={
+                'verbose_name': '優惠券使用紀錄',
+                'verbose_name_plural': '優惠券使用紀錄',
+                'constraints': [models.UniqueConstraint(fields=('coupon', 'customer'), name='coupon_usage_unique')],
+            },
+        ),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 5.2.9 on 2026-10-19 16:02
+
+from django.db import migrations
+
+
+def uppercase_codes(apps, schema_editor):
+    # Coupon.save() upper-cases codes and lookups are by upper-case code; bring older rows in line
+    Coupon = apps.get_model('store', 'Coupon')
+    taken = set(Coupon.objects.values_list('code', flat=True))
+    # Codes that are already upper-case keep them; of codes differing only in case, the oldest wins
+    for coupon in Coupon.objects.order_by('id').iterator():
+        code = coupon.code.strip().upper()
+        if code == coupon.code:
+            continue
+        if code in taken:
+            # Another coupon already has this code; keep both, the duplicate gets a suffix
+            suffix = f'-{coupon.pk}'
+            code = code[:50 - len(suffix)] + suffix
+        taken.discard(coupon.code)
+        taken.add(code)
+        Coupon.objects.filter(pk=coupon.pk).update(code=code)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0034_coupon_limits'),
+    ]
+
+    operations = [
+        migrations.RunPython(uppercase_codes, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,174 @@
+"""
+Mirror remote product image URLs into local media.
+
+Imported products only carry `image_url`s pointing at third-party hosts. This
+module downloads them with a bounded thread pool (with a per-host concurrency
+cap, timeouts and retries), stores each unique payload once under its SHA-256
+digest and points ProductImage.image at the local copy. Rows that already have
+a local image are skipped, so reruns only fetch what is still missing.
+
+Downloads happen in worker threads; all DB writes stay on the calling thread.
+"""
+import hashlib
+import io
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from http.client import HTTPException
+from urllib.error import HTTPError, URLError
+from urllib.parse import urlsplit
+from urllib.request import Request, urlopen
+
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import connection
+from django.db.models import Q
+from PIL import Image
+
+from .models import Product, ProductImage
+
+MAX_BYTES = 10 * 1024 * 1024
+USER_AGENT = 'PrintSmart image mirror'
+EXTENSIONS = {'JPEG': 'jpg', 'PNG': 'png', 'GIF': 'gif', 'WEBP': 'webp'}
+SCHEMES = ('http', 'https')
+
+
+class MirrorError(Exception):
+    pass
+
+
+class HostLimiter:
+    """Caps simultaneous downloads per host so one slow CDN can't starve the pool."""
+
+    def __init__(self, per_host):
+        self.per_host = per_host
+        self._lock = threading.Lock()
+        self._sems = {}
+
+    def __call__(self, host):
+        with self._lock:
+            if host not in self._sems:
+                self._sems[host] = threading.BoundedSemaphore(self.per_host)
+            return self._sems[host]
+
+
+def fetch(url, limiter, timeout=10, retries=2, backoff=0.5):
+    """Download `url`, retrying transient failures. Returns the raw bytes."""
+    # urlopen would also read file:, ftp: and data: URLs; image_url comes from imports
+    try:
+        parts = urlsplit(url)
+    except ValueError as e:
+        raise MirrorError(f'invalid URL {url!r}') from e
+    if parts.scheme.lower() not in SCHEMES or not parts.netloc:
+        raise MirrorError(f'unsupported URL {url!r}')
+    host = parts.netloc
+    attempt = 0
+    while True:
+        try:
+            with limiter(host):
+                req = Request(url, headers={'User-Agent': USER_AGENT})
+                with urlopen(req, timeout=timeout) as response:
+                    data = response.read(MAX_BYTES + 1)
+            if len(data) > MAX_BYTES:
+                raise MirrorError(f'larger than {MAX_BYTES} bytes')
+            return data
+        except HTTPError as e:
+            # Client errors won't get better on retry
+            if e.code < 500 or attempt >= retries:
+                raise MirrorError(f'HTTP {e.code}') from e
+        except (URLError, TimeoutError, ConnectionError) as e:
+            if attempt >= retries:
+                raise MirrorError(str(e)) from e
+        except (ValueError, OSError, HTTPException) as e:
+            # Malformed URLs, broken responses and other socket/SSL errors: fail this URL, not the whole pass
+            raise MirrorError(str(e) or type(e).__name__) from e
+        attempt += 1
+        time.sleep(backoff * (2 ** (attempt - 1)))
+
+
+def store_blob(data):
+    """Save image bytes under their digest; identical payloads share one file."""
+    digest = hashlib.sha256(data).hexdigest()
+    try:
+        with Image.open(io.BytesIO(data)) as img:
+            fmt = img.format
+            img.verify()
+    except Exception as e:
+        raise MirrorError(f'not a valid image ({e})') from e
+    if fmt not in EXTENSIONS:
+        raise MirrorError(f'unsupported image format {fmt}')
+    name = f'products/mirror/{digest[:2]}/{digest}.{EXTENSIONS[fmt]}'
+    if not default_storage.exists(name):
+        name = default_storage.save(name, ContentFile(data))
+    return name
+
+
+def pending_images(product_ids=None):
+    qs = ProductImage.objects.filter(Q(image='') | Q(image__isnull=True)).exclude(image_url='')
+    if product_ids is not None:
+        qs = qs.filter(product_id__in=product_ids)
+    return qs
+
+
+def mirror_product_images(product_ids=None, workers=8, per_host=2, timeout=10, retries=2, limit=None, log=None):
+    """
+    Mirror every ProductImage that only has a remote image_url.
+    Returns a dict of counters: downloaded, updated, failed.
+    """
+    log = log or (lambda msg: None)
+    qs = pending_images(product_ids).only('id', 'product_id', 'image', 'image_url')
+    if limit:
+        qs = qs[:limit]
+
+    # Each distinct URL is fetched once even if several rows point at it
+    by_url = defaultdict(list)
+    for pi in qs:
+        by_url[pi.image_url.strip()].append(pi)
+
+    stats = {'downloaded': 0, 'updated': 0, 'failed': 0}
+    if not by_url:
+        return stats
+
+    limiter = HostLimiter(per_host)
+    touched_products = set()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(fetch, url, limiter, timeout, retries): url for url in by_url}
+        for future in as_completed(futures):
+            url = futures[future]
+            try:
+                name = store_blob(future.result())
+            except MirrorError as e:
+                stats['failed'] += 1
+                log(f'FAILED {url}: {e}')
+                continue
+            stats['downloaded'] += 1
+            for pi in by_url[url]:
+                pi.image = name
+                pi.save(update_fields=['image'])
+                stats['updated'] += 1
+                touched_products.add(pi.product_id)
+
+    # Products whose main image_url was mirrored get the local file as their image
+    mirrored = dict(
+        ProductImage.objects.filter(product_id__in=touched_products)
+        .exclude(image='').values_list('image_url', 'image')
+    )
+    for product in Product.objects.filter(Q(image='') | Q(image__isnull=True), pk__in=touched_products).exclude(image_url=''):
+        name = mirrored.get(product.image_url)
+        if name:
+            product.image = name
+            product.save(update_fields=['image'])
+    return stats
+
+
+def mirror_in_background(product_ids, **kwargs):
+    """Run a mirror pass off the request thread (used by the product import hook)."""
+    def run():
+        try:
+            mirror_product_images(product_ids, **kwargs)
+        finally:
+            # Threads get their own DB connection; don't leak it
+            connection.close()
+
+    threading.Thread(target=run, daemon=True).start()
@@ -1,5 +1,6 @@
-from django.db import models
-from django.utils.text import slugify
+from django.db import models, transaction
+from django.db.models import F
+from django.db.models.functions import Coalesce
 from ckeditor.fields import RichTextField
 from django.contrib.auth.models import User
 import uuid
@@ -34,39 +35,126 @@ class Category(models.Model):
     def __str__(self):
         return self.name
 
+class ProductQuerySet(models.QuerySet):
+    """
+    Keeps the denormalised effective_price column in step with price and
+    discount_price for set-based writes that bypass Product.save() (and its
+    post_save signal, so catalog caches are invalidated here too, as they are
+    for stock and updated_at changes).
+    """
+
+    def _catalog_changed(self):
+        from . import versions
+        transaction.on_commit(lambda: versions.bump('catalog'))
+
+    def update(self, **kwargs):
+        if 'price' in kwargs or 'discount_price' in kwargs:
+            # SET expressions see the old row, so build from the new values when given
+            kwargs['effective_price'] = Coalesce(
+                kwargs.get('discount_price', F('discount_price')),
+                kwargs.get('price', F('price')),
+                output_field=models.DecimalField(max_digits=10, decimal_places=2),
+            )
+            self._catalog_changed()
+        elif 'stock' in kwargs or 'updated_at' in kwargs:
+            self._catalog_changed()
+        return super().update(**kwargs)
+
+    def bulk_update(self, objs, fields, batch_size=None):
+        fields = list(fields)
+        if {'price', 'discount_price'} & set(fields):
+            for obj in objs:
+                obj.sync_effective_price()
+            if 'effective_price' not in fields:
+                fields.append('effective_price')
+            self._catalog_changed()
+        return super().bulk_update(objs, fields, batch_size=batch_size)
+
+    def bulk_create(self, objs, *args, **kwargs):
+        objs = list(objs)
+        for obj in objs:
+            obj.sync_effective_price()
+        self._catalog_changed()
+        return super().bulk_create(objs, *args, **kwargs)
+
+
 class Product(models.Model):
     name = models.CharField(max_length=200, verbose_name="商品名稱")
     slug = models.SlugField(max_length=220, unique=True, verbose_name="網址代稱")
     sku = models.CharField(max_length=100, unique=True, verbose_name="貨號")
     price = models.DecimalField(max_digits=10, decimal_places=2, verbose_name="價格")
     discount_price = models.DecimalField(max_digits=10, decimal_places=2, null=True, blank=True, verbose_name="特價")
+    # What the customer pays (discount_price or price); stored so sorting and
+    # price filtering can use an index
+    effective_price = models.DecimalField(max_digits=10, decimal_places=2, default=0, editable=False, verbose_name="實際售價")
     stock = models.PositiveIntegerField(default=0, verbose_name="庫存")
     categories = models.ManyToManyField(Category, blank=True, related_name="products", verbose_name="分類")
     description = RichTextField(blank=True, verbose_name="商品描述")
     specs = RichTextField(blank=True, verbose_name="規格")
     image = models.ImageField(upload_to='products/', blank=True, null=True, verbose_name="商品圖片")
     image_url = models.URLField(blank=True, verbose_name="圖片連結")
+    # Resolved display URL (image -> image_url -> first gallery image), kept in sync
+    # by save() and the ProductImage signals so listings never query ProductImage.
+    primary_image = models.CharField(max_length=500, blank=True, editable=False, verbose_name="主圖片")
     is_active = models.BooleanField(default=True, verbose_name="上架")
     created_at = models.DateTimeField(auto_now_add=True, verbose_name="建立時間")
     updated_at = models.DateTimeField(auto_now=True, verbose_name="更新時間")
 
+    objects = ProductQuerySet.as_manager()
+
     class Meta:
         verbose_name = "商品"
         verbose_name_plural = "商品"
+        indexes = [
+            models.Index(fields=['is_active', 'effective_price'], name='product_active_price_idx'),
+            models.Index(fields=['is_active', '-created_at'], name='product_active_created_idx'),
+            # Keyset pagination / delta sync in the catalog API
+            models.Index(fields=['updated_at', 'id'], name='product_updated_idx'),
+        ]
 
     def save(self, *args, **kwargs):
         if not self.slug:
-            base_slug = slugify(self.name)
-            slug = base_slug
-            counter = 1
-            while Product.objects.filter(slug=slug).exclude(pk=self.pk).exists():
-                slug = f"{base_slug}-{counter}"
-                counter += 1
-            self.slug = slug
+            # One query however many "<name>-<n>" variants exist; batch callers
+            # (imports, duplicate_product) pass slugs from a shared SlugAllocator
+            from .slugs import SlugAllocator, base_slug
+            self.slug = SlugAllocator(Product, exclude_pk=self.pk).allocate(base_slug(self.name))
+        self.sync_effective_price()
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None and {'price', 'discount_price'} & set(update_fields):
+            kwargs['update_fields'] = set(update_fields) | {'effective_price'}
         super().save(*args, **kwargs)
 
-    def effective_price(self):
-        return self.discount_price if self.discount_price is not None else self.price
+        update_fields = kwargs.get('update_fields')
+        if update_fields is None or {'image', 'image_url'} & set(update_fields):
+            self.refresh_primary_image()
+
+    def resolve_primary_image(self):
+        """
+        Return the URL shown for this product: uploaded image, then image_url,
+        then the first gallery image. Only the gallery fallback hits the DB.
+        """
+        if self.image:
+            return self.image.url
+        if self.image_url:
+            return self.image_url
+        if self.pk:
+            first_img = self.images.first()
+            if first_img:
+                if first_img.image:
+                    return first_img.image.url
+                return first_img.image_url
+        return ''
+
+    def refresh_primary_image(self):
+        url = self.resolve_primary_image()
+        if url != self.primary_image:
+            self.primary_image = url
+            # Queryset update: does not touch updated_at or re-run save()
+            Product.objects.filter(pk=self.pk).update(primary_image=url)
+        return url
+
+    def sync_effective_price(self):
+        self.effective_price = self.discount_price if self.discount_price is not None else self.price
 
     def __str__(self):
         return self.name
@@ -125,6 +213,12 @@ class Coupon(models.Model):
     valid_from = models.DateTimeField(verbose_name="生效時間")
     valid_to = models.DateTimeField(verbose_name="過期時間")
     active = models.BooleanField(default=True, verbose_name="啟用")
+    min_spend = models.DecimalField(max_digits=10, decimal_places=2, default=0, verbose_name="最低消費", help_text="適用商品的小計需達此金額")
+    categories = models.ManyToManyField(Category, blank=True, related_name="coupons", verbose_name="適用分類", help_text="留空表示全店商品適用")
+    max_uses = models.PositiveIntegerField(null=True, blank=True, verbose_name="總使用上限", help_text="留空表示不限次數")
+    max_uses_per_customer = models.PositiveIntegerField(null=True, blank=True, verbose_name="每位客戶使用上限", help_text="留空表示不限次數")
+    # Only counted while max_uses is set, so unlimited campaign codes never write to this row
+    used_count = models.PositiveIntegerField(default=0, editable=False, verbose_name="已使用次數")
 
     class Meta:
         verbose_name = "優惠券"
@@ -133,6 +227,11 @@ class Coupon(models.Model):
     def __str__(self):
         return self.code
 
+    def save(self, *args, **kwargs):
+        # Codes are matched case-insensitively (see coupons.py)
+        self.code = self.code.strip().upper()
+        super().save(*args, **kwargs)
+
     def calculate_discount(self, total):
         if self.discount_type == 'percent':
              return total * (self.discount / 100)
@@ -168,6 +267,10 @@ class Order(models.Model):
     created_at = models.DateTimeField(default=timezone.now, verbose_name="訂單時間")
     updated_at = models.DateTimeField(auto_now=True, verbose_name="更新時間")
 
+    # Status as last loaded from / saved to the database (None: not known), so the
+    # status change handler in signals.py doesn't have to re-fetch the order
+    _loaded_status = None
+
     class Meta:
         verbose_name = "訂單"
         verbose_name_plural = "訂單"
@@ -175,11 +278,26 @@ class Order(models.Model):
     def __str__(self):
         return f'{self.order_number} - {self.customer_name}'
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._loaded_status = instance.__dict__.get('status')
+        return instance
+
+    def refresh_from_db(self, using=None, fields=None, from_queryset=None):
+        super().refresh_from_db(using=using, fields=fields, from_queryset=from_queryset)
+        # A partial refresh that skipped status keeps the loaded value (and any unsaved change)
+        if fields is None or 'status' in fields:
+            self._loaded_status = self.__dict__.get('status')
+
     def save(self, *args, **kwargs):
         if not self.order_number:
             dt = self.created_at or timezone.now()
             self.order_number = f"ORD-{dt.strftime('%Y%m%d')}-{uuid.uuid4().hex[:6].upper()}"
         super().save(*args, **kwargs)
+        update_fields = kwargs.get('update_fields')
+        if update_fields is None or 'status' in update_fields:
+            self._loaded_status = self.status
 
 class OrderItem(models.Model):
     order = models.ForeignKey(Order, related_name='items', on_delete=models.CASCADE, verbose_name="訂單")
@@ -201,6 +319,58 @@ class OrderItem(models.Model):
     def __str__(self):
         return f'{self.product.name} x {self.quantity}'
 
+class StockReservation(models.Model):
+    """Stock held for a session between opening checkout and placing the order."""
+    product = models.ForeignKey(Product, related_name='reservations', on_delete=models.CASCADE, verbose_name="商品")
+    # reservations.holder(): a stable id kept in the session, not the session key itself
+    session_key = models.CharField(max_length=40, db_index=True, verbose_name="Session")
+    quantity = models.PositiveIntegerField(verbose_name="數量")
+    expires_at = models.DateTimeField(verbose_name="到期時間")
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name="建立時間")
+
+    class Meta:
+        verbose_name = "庫存預留"
+        verbose_name_plural = "庫存預留"
+        indexes = [
+            # Active holds per product: SUM(quantity) WHERE product_id IN (...) AND expires_at > now
+            models.Index(fields=['product', 'expires_at'], name='reservation_product_exp_idx'),
+            models.Index(fields=['expires_at'], name='reservation_expires_idx'),
+        ]
+
+    def __str__(self):
+        return f'{self.product_id} x {self.quantity} ({self.session_key})'
+
+class IdempotencyKey(models.Model):
+    """One checkout form submission; a repeated POST with the same key gets the original order."""
+    key = models.CharField(max_length=64, unique=True, verbose_name="Key")
+    order = models.ForeignKey(Order, null=True, blank=True, on_delete=models.CASCADE, related_name='+', verbose_name="訂單")
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name="建立時間")
+    expires_at = models.DateTimeField(db_index=True, verbose_name="到期時間")
+
+    class Meta:
+        verbose_name = "重複提交保護"
+        verbose_name_plural = "重複提交保護"
+
+    def __str__(self):
+        return self.key
+
+class CouponUsage(models.Model):
+    """How many orders one customer has placed with a coupon that has a per-customer limit."""
+    coupon = models.ForeignKey(Coupon, related_name='usages', on_delete=models.CASCADE, verbose_name="優惠券")
+    # 'user:<id>' for members, 'email:<address>' for guests
+    customer = models.CharField(max_length=260, verbose_name="客戶")
+    count = models.PositiveIntegerField(default=0, verbose_name="使用次數")
+
+    class Meta:
+        verbose_name = "優惠券使用紀錄"
+        verbose_name_plural = "優惠券使用紀錄"
+        constraints = [
+            models.UniqueConstraint(fields=['coupon', 'customer'], name='coupon_usage_unique'),
+        ]
+
+    def __str__(self):
+        return f'{self.coupon_id} / {self.customer}: {self.count}'
+
 class OrderNote(models.Model):
     order = models.ForeignKey(Order, related_name='order_notes', on_delete=models.CASCADE, verbose_name="訂單")
     user = models.ForeignKey(User, null=True, blank=True, on_delete=models.SET_NULL, verbose_name="使用者")
@@ -304,6 +474,50 @@ class Wishlist(models.Model):
     def __str__(self):
         return f"{self.user.username} - {self.product.name}"
 
+class ProductCooccurrence(models.Model):
+    """
+    Sparse basket co-occurrence matrix: number of orders containing both
+    `product` and `other`. Stored in both directions; the diagonal
+    (product == other) is the number of orders containing the product.
+    """
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='+', verbose_name="商品")
+    other = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='+', verbose_name="相關商品")
+    count = models.PositiveIntegerField(default=0, verbose_name="次數")
+
+    class Meta:
+        verbose_name = "商品共同購買次數"
+        verbose_name_plural = "商品共同購買次數"
+        unique_together = ('product', 'other')
+
+
+class ProductRecommendation(models.Model):
+    """Precomputed top-N "frequently bought together" neighbours per product."""
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='recommendations', verbose_name="商品")
+    recommended = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='+', verbose_name="推薦商品")
+    score = models.FloatField(verbose_name="分數")
+    rank = models.PositiveSmallIntegerField(verbose_name="排名")
+
+    class Meta:
+        verbose_name = "推薦商品"
+        verbose_name_plural = "推薦商品"
+        ordering = ['product', 'rank']
+        unique_together = ('product', 'rank')
+
+
+class RecommendationRun(models.Model):
+    """Bookkeeping for incremental recommendation builds."""
+    last_order_id = models.BigIntegerField(default=0, verbose_name="最後處理訂單 ID")
+    basket_count = models.PositiveIntegerField(default=0, verbose_name="累計訂單數")
+    metric = models.CharField(max_length=20, verbose_name="計分方式")
+    products_updated = models.PositiveIntegerField(default=0, verbose_name="更新商品數")
+    finished_at = models.DateTimeField(auto_now_add=True, verbose_name="完成時間")
+
+    class Meta:
+        verbose_name = "推薦計算紀錄"
+        verbose_name_plural = "推薦計算紀錄"
+        ordering = ['-id']
+
+
 class SalesDashboard(models.Model):
     class Meta:
         managed = False
@@ -0,0 +1,191 @@
+"""
+Order placement helpers.
+
+Stock is taken with one conditional UPDATE per product
+(stock = stock - qty WHERE stock >= qty), so the check and the write are a
+single atomic statement and concurrent checkouts cannot oversell. Products
+are updated in primary key order, so two carts holding the same products
+lock the rows in the same order and cannot deadlock. Units other sessions
+hold through checkout reservations (see reservations.py) are left alone.
+
+create_order() computes the totals in memory and writes the order with one
+INSERT and its items with one bulk_create, instead of saving every item
+(and re-aggregating the order total from the item signal) one at a time.
+
+The checkout form carries an idempotency key. claim_submission() inserts it
+(unique) as the first write of the order transaction, so a double-click or
+retry either waits for the first submission to commit and then fails the
+insert, or finds the key already recorded; either way it is answered with
+the original order instead of creating a second one. If the first attempt
+rolls back (e.g. out of stock) the key goes with it and can be retried.
+
+Status changes into or out of CLOSED_STATUSES put stock back or take it
+again with one UPDATE over all the affected products (adjust_stock()), for
+a single order saved from the admin (signals.py) as well as for
+change_status() on a whole queryset.
+"""
+import secrets
+from datetime import timedelta
+from decimal import Decimal
+
+from django.db import IntegrityError, transaction
+from django.db.models import F, OuterRef, Subquery, Sum
+from django.utils import timezone
+
+from .models import IdempotencyKey, Order, OrderItem, OrderNote, Product
+from .signals import deferred_order_totals
+
+
+class InsufficientStock(Exception):
+    """Raised with every cart line that could not be fulfilled, not just the first."""
+
+    def __init__(self, shortages):
+        # [(product_id, requested, available), ...]
+        self.shortages = shortages
+        super().__init__(', '.join(f'#{pid}: {req} > {avail}' for pid, req, avail in shortages))
+
+
+class DuplicateSubmission(Exception):
+
+    def __init__(self, order_id):
+        self.order_id = order_id
+        super().__init__(f'Already submitted as order #{order_id}')
+
+
+IDEMPOTENCY_TTL = timedelta(hours=1)
+MAX_KEY_LENGTH = 64
+
+
+def new_idempotency_key():
+    return secrets.token_urlsafe(24)
+
+
+def claim_submission(key):
+    """
+    Record `key` for the order being placed in the surrounding transaction.
+    Raises DuplicateSubmission if it was already used. Returns the key row so
+    the caller can attach the order once it exists.
+    """
+    try:
+        with transaction.atomic():
+            return IdempotencyKey.objects.create(key=key, expires_at=timezone.now() + IDEMPOTENCY_TTL)
+    except IntegrityError:
+        order_id = IdempotencyKey.objects.filter(key=key).values_list('order_id', flat=True).first()
+        raise DuplicateSubmission(order_id)
+
+
+def submitted_order_id(key):
+    """The order an already completed submission with `key` created, if any."""
+    return IdempotencyKey.objects.filter(key=key, order__isnull=False).values_list('order_id', flat=True).first()
+
+
+def sweep_idempotency_keys(now=None):
+    deleted, _ = IdempotencyKey.objects.filter(expires_at__lte=now or timezone.now()).delete()
+    return deleted
+
+
+def decrement_stock(quantities, holder_id=None):
+    """
+    Take `quantities` ({product_id: qty}) out of stock, all or nothing.
+    Raises InsufficientStock (and rolls back the lines already taken) if any
+    product doesn't have enough left once other sessions' holds are counted;
+    the holds of `holder_id` (reservations.holder()) are what this call is converting.
+    """
+    from .reservations import held, held_by_others
+
+    now = timezone.now()
+    others = held_by_others(holder_id)
+    failed = []
+    with transaction.atomic():
+        for product_id in sorted(quantities):
+            qty = quantities[product_id]
+            # updated_at moves too, so the catalog snapshot and ETags see the new stock
+            taken = Product.objects.filter(pk=product_id, stock__gte=qty + others).update(
+                stock=F('stock') - qty, updated_at=now,
+            )
+            if not taken:
+                failed.append(product_id)
+        if failed:
+            stock = dict(Product.objects.filter(pk__in=failed).values_list('pk', 'stock'))
+            holds = held(failed, exclude_holder=holder_id)
+            raise InsufficientStock([
+                (product_id, quantities[product_id], max(0, stock.get(product_id, 0) - holds.get(product_id, 0)))
+                for product_id in failed
+            ])
+
+
+def create_order(lines, coupon=None, discount=Decimal('0'), **fields):
+    """
+    Create an order with one item per (product_id, unit_price, qty) in `lines`
+    and the `discount` coupons.discount() gave for `coupon`.
+    The remaining keyword arguments are Order fields.
+    """
+    items = [
+        OrderItem(product_id=product_id, unit_price=price, quantity=qty, subtotal=price * qty)
+        for product_id, price, qty in lines
+    ]
+    total = sum((item.subtotal for item in items), Decimal('0'))
+    discount = min(discount, total)
+    with transaction.atomic(), deferred_order_totals(recompute=False):
+        order = Order.objects.create(coupon=coupon, discount_amount=discount, total_amount=total - discount, **fields)
+        for item in items:
+            item.order = order
+        OrderItem.objects.bulk_create(items)
+    return order
+
+
+# Orders in these states no longer hold their stock
+CLOSED_STATUSES = ('canceled', 'refunded', 'returned')
+
+
+def stock_direction(old_status, new_status):
+    """+1 if the change puts the order's stock back, -1 if it takes it again, else 0."""
+    was_closed, is_closed = old_status in CLOSED_STATUSES, new_status in CLOSED_STATUSES
+    return int(is_closed) - int(was_closed)
+
+
+def adjust_stock(order_ids, direction):
+    """
+    Put the items of `order_ids` back in stock (direction=1) or take them
+    again (-1) with one UPDATE, summed per product. Re-opening an order
+    doesn't check stock: the admin decided to fulfil it.
+    """
+    items = OrderItem.objects.filter(order_id__in=order_ids)
+    per_product = Subquery(
+        items.filter(product_id=OuterRef('pk')).order_by().values('product_id')
+        .annotate(n=Sum('quantity')).values('n')
+    )
+    stock = F('stock') + per_product if direction > 0 else F('stock') - per_product
+    # updated_at moves too, so the catalog snapshot and ETags see the new stock
+    Product.objects.filter(pk__in=items.values('product_id')).update(stock=stock, updated_at=timezone.now())
+
+
+def status_note(order, old_status):
+    labels = dict(Order.STATUS_CHOICES)
+    return OrderNote(
+        order=order,
+        message=f"Order status changed from '{labels.get(old_status, old_status)}' to '{order.get_status_display()}'.",
+    )
+
+
+def change_status(queryset, status):
+    """
+    Set `status` on every order in `queryset` with a constant number of
+    queries, adjusting stock and logging a note as saving each would.
+    Returns the number of orders changed.
+    """
+    changed = list(queryset.exclude(status=status).only('pk', 'status'))
+    if not changed:
+        return 0
+    with transaction.atomic():
+        for direction in (1, -1):
+            ids = [o.pk for o in changed if stock_direction(o.status, status) == direction]
+            if ids:
+                adjust_stock(ids, direction)
+        notes = []
+        for order in changed:
+            old_status, order.status = order.status, status
+            notes.append(status_note(order, old_status))
+        Order.objects.filter(pk__in=[o.pk for o in changed]).update(status=status, updated_at=timezone.now())
+        OrderNote.objects.bulk_create(notes)
+    return len(changed)
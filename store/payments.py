@@ -0,0 +1,78 @@
+"""
+Stripe PaymentIntent handling for checkout.
+
+Intents are created lazily: the checkout page itself never calls Stripe; the
+browser asks payment_intent() for a client secret only once the customer picks
+credit card. The intent is remembered in the session together with a hash
+of the cart contents, so refreshing checkout or re-selecting the card option
+costs no network call. If the cart changed, the existing intent's amount is
+updated instead of creating a new one (which would orphan the old intent).
+
+Set STRIPE_API_BASE (e.g. http://localhost:12111 for stripe-mock) to run
+against a local Stripe stand-in instead of api.stripe.com.
+"""
+import hashlib
+import json
+
+import stripe
+from django.conf import settings
+
+SESSION_KEY = 'stripe_intent'
+CURRENCY = 'hkd'
+
+
+def enabled():
+    return getattr(settings, 'STRIPE_ENABLED', False)
+
+
+def _configure():
+    stripe.api_key = settings.STRIPE_SECRET_KEY
+    if getattr(settings, 'STRIPE_API_BASE', None):
+        stripe.api_base = settings.STRIPE_API_BASE
+
+
+def cart_signature(lines, coupon_id=None):
+    """Hash of the cart lines (carts.CartLine) and coupon being paid for."""
+    rows = sorted((line.product_id, line.qty, str(line.price)) for line in lines)
+    raw = json.dumps([rows, coupon_id])
+    return hashlib.sha256(raw.encode()).hexdigest()[:32]
+
+
+def intent_for(session, amount, signature):
+    """
+    Client secret of a PaymentIntent for `amount` (a Decimal in dollars),
+    reusing or updating the one stored in the session where possible.
+    """
+    _configure()
+    cents = int(amount * 100)
+    stored = session.get(SESSION_KEY)
+    if stored and stored['signature'] == signature and stored['amount'] == cents:
+        return stored['client_secret']
+
+    intent = None
+    if stored:
+        try:
+            intent = stripe.PaymentIntent.modify(stored['id'], amount=cents)
+        except stripe.error.StripeError:
+            # Already confirmed or canceled: it can't be reused
+            intent = None
+    if intent is None:
+        if not session.session_key:
+            session.save()
+        intent = stripe.PaymentIntent.create(
+            amount=cents,
+            currency=CURRENCY,
+            automatic_payment_methods={'enabled': True},
+            description='PrintSmart Order',
+            # Concurrent requests for the same session and cart get the same intent
+            idempotency_key=f'checkout-{session.session_key}-{signature}-{cents}',
+        )
+    session[SESSION_KEY] = {
+        'id': intent.id, 'client_secret': intent.client_secret, 'amount': cents, 'signature': signature,
+    }
+    return intent.client_secret
+
+
+def forget(session):
+    """Called once the order is placed: the intent is used up."""
+    session.pop(SESSION_KEY, None)
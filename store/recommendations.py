@@ -0,0 +1,164 @@
+"""
+"Frequently bought together" recommendations.
+
+Order baskets are turned into a sparse product co-occurrence matrix with
+vectorised NumPy counting, accumulated in ProductCooccurrence, and scored
+with lift or cosine similarity. The top-N neighbours of each product are
+stored in ProductRecommendation so product_detail needs a single indexed
+lookup.
+
+Builds are incremental: only orders newer than the last RecommendationRun
+are counted, and only products whose counts (or whose neighbours' counts)
+changed are re-ranked. Use full=True to start over, e.g. after many orders
+were cancelled.
+"""
+import numpy as np
+from django.db import transaction
+from django.db.models import F
+
+from . import versions
+from .models import Order, OrderItem, ProductCooccurrence, ProductRecommendation, RecommendationRun
+
+EXCLUDED_STATUSES = ['canceled', 'refunded', 'returned']
+METRICS = ('lift', 'cosine')
+
+
+def basket_pairs(order_ids, product_ids):
+    """
+    Given parallel arrays of (order, product) lines, return (a, b, count) for
+    every ordered product pair bought in the same order, diagonal included.
+    """
+    lines = np.unique(np.column_stack([order_ids, product_ids]), axis=0)
+    orders, products = lines[:, 0], lines[:, 1]
+    if not len(orders):
+        empty = np.empty(0, dtype=np.int64)
+        return empty, empty, empty
+
+    # Basket boundaries in the (order, product)-sorted line array
+    starts = np.flatnonzero(np.r_[True, orders[1:] != orders[:-1]])
+    sizes = np.diff(np.r_[starts, len(orders)])
+
+    # Pair every line with every line of its own basket (size**2 pairs per basket)
+    line_size = np.repeat(sizes, sizes)
+    line_start = np.repeat(starts, sizes)
+    left = np.repeat(np.arange(len(orders)), line_size)
+    offset = np.arange(len(left)) - np.repeat(np.cumsum(line_size) - line_size, line_size)
+    right = np.repeat(line_start, line_size) + offset
+
+    pairs, counts = np.unique(np.column_stack([products[left], products[right]]), axis=0, return_counts=True)
+    return pairs[:, 0], pairs[:, 1], counts
+
+
+def score(c_ab, c_a, c_b, basket_count, metric):
+    c_ab, c_a, c_b = (np.asarray(x, dtype=np.float64) for x in (c_ab, c_a, c_b))
+    if metric == 'lift':
+        return c_ab * basket_count / (c_a * c_b)
+    return c_ab / np.sqrt(c_a * c_b)
+
+
+def accumulate(a, b, counts):
+    """Add new pair counts onto the stored matrix."""
+    existing = {
+        (p, o): c for p, o, c in ProductCooccurrence.objects
+        .filter(product_id__in=set(a.tolist())).values_list('product_id', 'other_id', 'count')
+    }
+    rows = [
+        ProductCooccurrence(product_id=p, other_id=o, count=existing.get((p, o), 0) + c)
+        for p, o, c in zip(a.tolist(), b.tolist(), counts.tolist())
+    ]
+    ProductCooccurrence.objects.bulk_create(
+        rows, batch_size=500, update_conflicts=True,
+        unique_fields=['product', 'other'], update_fields=['count'],
+    )
+
+
+def rerank(product_ids, basket_count, metric, top_n, min_support):
+    """Recompute and store the top-N neighbours for `product_ids`."""
+    qs = ProductCooccurrence.objects.all()
+    if product_ids is not None:
+        qs = qs.filter(product_id__in=product_ids)
+    matrix = np.array(list(qs.values_list('product_id', 'other_id', 'count')), dtype=np.int64).reshape(-1, 3)
+    a, b, c_ab = matrix[:, 0], matrix[:, 1], matrix[:, 2]
+
+    diag = a == b
+    needed = set(b[~diag].tolist()) - set(a[diag].tolist())
+    item_counts = dict(zip(a[diag].tolist(), c_ab[diag].tolist()))
+    if needed:
+        item_counts.update(
+            ProductCooccurrence.objects.filter(product_id__in=needed, other_id=F('product_id'))
+            .values_list('product_id', 'count')
+        )
+
+    keep = ~diag & (c_ab >= min_support)
+    a, b, c_ab = a[keep], b[keep], c_ab[keep]
+    c_a = np.array([item_counts[x] for x in a.tolist()], dtype=np.int64)
+    c_b = np.array([item_counts[x] for x in b.tolist()], dtype=np.int64)
+    scores = score(c_ab, c_a, c_b, basket_count, metric)
+
+    # Sort by product, then best score first; keep the first top_n of each product
+    order = np.lexsort((-scores, a))
+    a, b, scores = a[order], b[order], scores[order]
+    starts = np.r_[0, np.flatnonzero(a[1:] != a[:-1]) + 1] if len(a) else np.empty(0, dtype=np.int64)
+    rank = np.arange(len(a)) - np.repeat(starts, np.diff(np.r_[starts, len(a)]))
+    top = rank < top_n
+
+    recs = [
+        ProductRecommendation(product_id=p, recommended_id=r, score=float(s), rank=int(k) + 1)
+        for p, r, s, k in zip(a[top].tolist(), b[top].tolist(), scores[top].tolist(), rank[top].tolist())
+    ]
+    stale = ProductRecommendation.objects.all()
+    if product_ids is not None:
+        stale = stale.filter(product_id__in=product_ids)
+    stale.delete()
+    ProductRecommendation.objects.bulk_create(recs, batch_size=500)
+    return len(set(a[top].tolist()))
+
+
+@transaction.atomic
+def build(full=False, metric='cosine', top_n=8, min_support=1):
+    if metric not in METRICS:
+        raise ValueError(f'metric must be one of {METRICS}')
+    last = None if full else RecommendationRun.objects.first()
+    if full:
+        ProductCooccurrence.objects.all().delete()
+        ProductRecommendation.objects.all().delete()
+
+    last_order_id = last.last_order_id if last else 0
+    basket_count = last.basket_count if last else 0
+
+    # Pin the upper bound first so orders placed during the build are left for the next run
+    new_last_order_id = Order.objects.order_by('-pk').values_list('pk', flat=True).first() or last_order_id
+    orders = Order.objects.filter(pk__gt=last_order_id, pk__lte=new_last_order_id).exclude(status__in=EXCLUDED_STATUSES)
+    lines = np.array(
+        list(OrderItem.objects.filter(order__in=orders).values_list('order_id', 'product_id')),
+        dtype=np.int64,
+    ).reshape(-1, 2)
+
+    affected = set()
+    if len(lines):
+        a, b, counts = basket_pairs(lines[:, 0], lines[:, 1])
+        accumulate(a, b, counts)
+        basket_count += len(np.unique(lines[:, 0]))
+        # Products in new baskets, plus their neighbours (whose scores depend on
+        # the changed item counts)
+        touched = set(a.tolist())
+        affected = touched | set(
+            ProductCooccurrence.objects.filter(product_id__in=touched).values_list('other_id', flat=True)
+        )
+
+    updated = 0
+    if last is not None and last.metric != metric:
+        # Different scoring: every product has to be re-ranked
+        updated = rerank(None, basket_count, metric, top_n, min_support)
+    elif affected:
+        # Lift's basket_count factor is shared by all pairs, so products outside
+        # `affected` keep the same ranking (only their absolute scores drift)
+        updated = rerank(affected, basket_count, metric, top_n, min_support)
+
+    if updated:
+        # Product pages embed the recommendations; invalidate their ETags
+        transaction.on_commit(lambda: versions.bump('recommendations'))
+    return RecommendationRun.objects.create(
+        last_order_id=new_last_order_id, basket_count=basket_count,
+        metric=metric, products_updated=updated,
+    )
@@ -0,0 +1,169 @@
+"""
+Time-limited stock holds for checkout.
+
+Opening the checkout page reserves the cart for HOLD_TTL. While a hold is
+active those units are not available to other sessions, so a customer who
+is filling in the form doesn't lose the last toner to someone who started
+later. Holds belong to a holder id kept in the session data rather than to
+the session key, which login() changes (cycle_key()) while the data, and so
+the holder, carries over. Placing the order converts the session's holds into the real stock
+decrement (orders.decrement_stock) and deletes them; abandoned holds simply
+expire and are deleted in bulk by `manage.py sweep_checkout`.
+
+reserve() holds the product rows (SELECT ... FOR UPDATE) only for its own
+short transaction, never for the whole checkout. Active holds per product
+are an aggregate over the (product, expires_at) index; the totals shown to
+shoppers (available()) are cached briefly and dropped whenever this
+module changes them.
+"""
+import secrets
+from datetime import timedelta
+
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import IntegerField, OuterRef, Subquery, Sum
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from .models import Product, StockReservation
+from .orders import InsufficientStock
+
+HOLD_TTL = timedelta(minutes=15)
+HELD_CACHE_SECONDS = 30
+SESSION_KEY = 'stock_holds'
+HOLDER_KEY = 'stock_holder'
+
+
+def holder(session, create=False):
+    """The id this session's holds are stored under (StockReservation.session_key), or None."""
+    key = session.get(HOLDER_KEY)
+    if key is None and create:
+        key = session[HOLDER_KEY] = secrets.token_hex(16)
+    return key
+
+
+def active(now=None):
+    return StockReservation.objects.filter(expires_at__gt=now or timezone.now())
+
+
+def held(product_ids, exclude_holder=None):
+    """{product_id: units held by active reservations}, straight from the database."""
+    qs = active().filter(product_id__in=product_ids)
+    if exclude_holder:
+        qs = qs.exclude(session_key=exclude_holder)
+    return dict(qs.values('product_id').annotate(n=Sum('quantity')).values_list('product_id', 'n'))
+
+
+def held_by_others(holder_id):
+    """Per-product subquery (OuterRef('pk')) of units held by other sessions, for use in filters."""
+    holds = (
+        active().filter(product_id=OuterRef('pk')).exclude(session_key=holder_id or '')
+        .order_by().values('product_id').annotate(n=Sum('quantity')).values('n')
+    )
+    return Coalesce(Subquery(holds), 0, output_field=IntegerField())
+
+
+def _cache_key(product_id):
+    return f'stock:held:{product_id}'
+
+
+def _invalidate(product_ids):
+    keys = [_cache_key(pid) for pid in product_ids]
+    transaction.on_commit(lambda: cache.delete_many(keys))
+
+
+def cached_held(product_ids):
+    keys = {_cache_key(pid): pid for pid in product_ids}
+    result = {keys[key]: n for key, n in cache.get_many(keys).items()}
+    missing = [pid for pid in product_ids if pid not in result]
+    if missing:
+        fresh = held(missing)
+        fresh = {pid: fresh.get(pid, 0) for pid in missing}
+        cache.set_many({_cache_key(pid): n for pid, n in fresh.items()}, HELD_CACHE_SECONDS)
+        result.update(fresh)
+    return result
+
+
+def session_holds(session):
+    """{product_id: qty} this session currently holds (empty once expired)."""
+    data = session.get(SESSION_KEY) or {}
+    if not data or data.get('expires', 0) <= timezone.now().timestamp():
+        return {}
+    return {int(pid): qty for pid, qty in data['items'].items()}
+
+
+def available(product_ids, session=None):
+    """
+    {product_id: stock minus units held by *other* sessions}. For display and
+    add-to-cart checks; order placement re-checks inside its UPDATE.
+    """
+    product_ids = list(product_ids)
+    stock = dict(Product.objects.filter(pk__in=product_ids).values_list('pk', 'stock'))
+    holds = cached_held(product_ids)
+    own = session_holds(session) if session is not None else {}
+    return {
+        pid: max(0, n - max(0, holds.get(pid, 0) - own.get(pid, 0)))
+        for pid, n in stock.items()
+    }
+
+
+def reserve(session, quantities):
+    """
+    Replace the session's holds with `quantities` ({product_id: qty}).
+    Raises InsufficientStock for every line other sessions' holds leave short.
+    """
+    holder_id = holder(session, create=True)
+    now = timezone.now()
+    expires_at = now + HOLD_TTL
+    previous = [int(pid) for pid in (session.get(SESSION_KEY) or {}).get('items', {})]
+    with transaction.atomic():
+        # A write first, so SQLite takes its write lock now instead of failing to upgrade later
+        StockReservation.objects.filter(session_key=holder_id).delete()
+        # Row locks for the rest of this (short) transaction; pk order avoids deadlocks
+        stock = dict(
+            Product.objects.select_for_update().filter(pk__in=quantities).order_by('pk').values_list('pk', 'stock')
+        )
+        others = held(list(stock), exclude_holder=holder_id)
+        shortages = [
+            (pid, qty, max(0, stock.get(pid, 0) - others.get(pid, 0)))
+            for pid, qty in sorted(quantities.items())
+            if stock.get(pid, 0) - others.get(pid, 0) < qty
+        ]
+        if shortages:
+            raise InsufficientStock(shortages)
+        StockReservation.objects.bulk_create([
+            StockReservation(product_id=pid, session_key=holder_id, quantity=qty, expires_at=expires_at)
+            for pid, qty in quantities.items()
+        ])
+        _invalidate(set(previous) | set(quantities))
+    session[SESSION_KEY] = {
+        'expires': expires_at.timestamp(),
+        'items': {str(pid): qty for pid, qty in quantities.items()},
+    }
+    return expires_at
+
+
+def release(session, product_ids=None):
+    """Drop the session's holds (all of them, or only for `product_ids`)."""
+    holder_id = holder(session)
+    if not holder_id or not session.get(SESSION_KEY):
+        return
+    qs = StockReservation.objects.filter(session_key=holder_id)
+    if product_ids is not None:
+        qs = qs.filter(product_id__in=product_ids)
+    released = list(qs.values_list('product_id', flat=True))
+    qs.delete()
+    _invalidate(released)
+    data = session[SESSION_KEY]
+    if product_ids is None:
+        del session[SESSION_KEY]
+    else:
+        for pid in product_ids:
+            data['items'].pop(str(pid), None)
+        session.modified = True
+
+
+def sweep(now=None):
+    """Delete expired holds in bulk; returns how many were removed."""
+    deleted, _ = StockReservation.objects.filter(expires_at__lte=now or timezone.now()).delete()
+    return deleted
@@ -45,53 +45,36 @@ def notify_admin_login(sender, user, request, **kwargs):
         except Exception as e:
             print(f"Failed to send login notification: {e}")
 
-from django.db.models.signals import pre_save, post_save, post_delete
+import threading
+from contextlib import contextmanager
+
+from django.db.models.signals import pre_save, post_save, post_delete, m2m_changed
+from django.db import transaction
 from django.db.models import Sum
-from .models import Order, OrderItem, UserProfile
+from django.utils import timezone
+from .models import Order, OrderItem, UserProfile, Product, ProductImage, HeroSlide, SiteSettings, Category, Page, Wishlist, PaymentMethod, Coupon
+from . import images, versions, wishlists
 
 @receiver(pre_save, sender=Order)
-def restore_stock_on_cancel(sender, instance, **kwargs):
-    if not instance.pk:
-        return
-        
-    try:
-        old_order = Order.objects.get(pk=instance.pk)
-    except Order.DoesNotExist:
-        return
-        
-    # If changing TO canceled/refunded/returned FROM valid status
-    if instance.status in ['canceled', 'refunded', 'returned'] and old_order.status not in ['canceled', 'refunded', 'returned']:
-        for item in instance.items.all():
-            product = item.product
-            product.stock += item.quantity
-            product.save()
-            
-    # If changing FROM canceled/refunded/returned TO valid status (re-opening order)
-    elif old_order.status in ['canceled', 'refunded', 'returned'] and instance.status not in ['canceled', 'refunded', 'returned']:
-        for item in instance.items.all():
-            product = item.product
-            # Allow stock to go negative if manually re-opened by admin
-            product.stock -= item.quantity
-            product.save()
+def handle_status_change(sender, instance, update_fields=None, raw=False, **kwargs):
+    """Put stock back / take it again and log a note when an order's status changes."""
+    from . import orders
 
-@receiver(pre_save, sender=Order)
-def log_status_change(sender, instance, **kwargs):
-    from .models import OrderNote
-    
-    if not instance.pk:
+    if raw or not instance.pk or (update_fields is not None and 'status' not in update_fields):
         return
-        
-    try:
-        old_order = Order.objects.get(pk=instance.pk)
-    except Order.DoesNotExist:
+    old_status = instance._loaded_status
+    if old_status is None:
+        # Not loaded through the ORM (or status was deferred): one query
+        old_status = Order.objects.filter(pk=instance.pk).values_list('status', flat=True).first()
+        if old_status is None:
+            return
+    if old_status == instance.status:
         return
-        
-    if instance.status != old_order.status:
-        message = f"Order status changed from '{old_order.get_status_display()}' to '{instance.get_status_display()}'."
-        OrderNote.objects.create(
-            order=instance,
-            message=message
-        )
+
+    direction = orders.stock_direction(old_status, instance.status)
+    if direction:
+        orders.adjust_stock([instance.pk], direction)
+    orders.status_note(instance, old_status).save()
 
 @receiver(post_save, sender=User)
 def create_user_profile(sender, instance, created, **kwargs):
@@ -103,12 +86,31 @@ def save_user_profile(sender, instance, **kwargs):
     if hasattr(instance, 'profile'):
         instance.profile.save()
 
-@receiver([post_save, post_delete], sender=OrderItem)
-def update_order_total(sender, instance, **kwargs):
+_deferred_totals = threading.local()
+
+
+@contextmanager
+def deferred_order_totals(recompute=True):
     """
-    Automatically recalculate Order total_amount when OrderItems are saved or deleted.
+    Collect the orders whose items are saved or deleted inside the block and
+    recompute each total once on exit, instead of once per item. Code that
+    writes the total itself (checkout) passes recompute=False. Nested blocks
+    defer to the outermost one.
     """
-    order = instance.order
+    if getattr(_deferred_totals, 'orders', None) is not None:
+        yield
+        return
+    _deferred_totals.orders = pending = {}
+    try:
+        yield
+    finally:
+        _deferred_totals.orders = None
+    if recompute:
+        for order in pending.values():
+            recompute_order_total(order)
+
+
+def recompute_order_total(order):
     # Calculate sum of subtotals
     items_total = order.items.aggregate(total=Sum('subtotal'))['total'] or 0
     
@@ -128,3 +130,89 @@ def update_order_total(sender, instance, **kwargs):
         # So we should include 'updated_at' if we want it updated, but Order model has auto_now=True for updated_at.
         # To be safe and simple, just save().
         order.save(update_fields=['total_amount', 'updated_at'])
+
+
+@receiver([post_save, post_delete], sender=OrderItem)
+def update_order_total(sender, instance, **kwargs):
+    """
+    Automatically recalculate Order total_amount when OrderItems are saved or deleted.
+    """
+    order = instance.order
+    pending = getattr(_deferred_totals, 'orders', None)
+    if pending is not None:
+        pending.setdefault(order.pk, order)
+        return
+    recompute_order_total(order)
+
+
+@receiver([post_save, post_delete], sender=ProductImage)
+def update_product_primary_image(sender, instance, **kwargs):
+    """
+    Keep Product.primary_image in sync when gallery images change. Products with
+    their own image/image_url never fall back to the gallery, so skip them.
+    """
+    if kwargs.get('raw'):
+        return
+    try:
+        product = instance.product
+    except Product.DoesNotExist:
+        return
+    if not product.image and not product.image_url:
+        product.refresh_primary_image()
+    # The gallery is part of the product page, so its ETag/Last-Modified must move
+    Product.objects.filter(pk=product.pk).update(updated_at=timezone.now())
+
+
+@receiver(post_save, sender=Product)
+@receiver(post_save, sender=ProductImage)
+def pregenerate_product_derivatives(sender, instance, update_fields=None, **kwargs):
+    if kwargs.get('raw') or not instance.image:
+        return
+    if update_fields is not None and 'image' not in update_fields:
+        return
+    # After commit: a rolled-back upload has nothing to resize
+    name = instance.image.name
+    transaction.on_commit(lambda: images.pregenerate_in_background(name, (160, 320, 800)))
+
+
+@receiver(post_save, sender=HeroSlide)
+def pregenerate_hero_derivatives(sender, instance, **kwargs):
+    if not kwargs.get('raw') and instance.image:
+        name = instance.image.name
+        transaction.on_commit(lambda: images.pregenerate_in_background(name, (640, 1024, 1920)))
+
+
+@receiver([post_save, post_delete], sender=SiteSettings)
+@receiver([post_save, post_delete], sender=Category)
+@receiver([post_save, post_delete], sender=HeroSlide)
+@receiver([post_save, post_delete], sender=PaymentMethod)
+def bump_site_version(sender, **kwargs):
+    """Site configuration changed: invalidate everything keyed on the site version."""
+    transaction.on_commit(lambda: versions.bump('site'))
+
+
+@receiver([post_save, post_delete], sender=Product)
+@receiver([post_save, post_delete], sender=ProductImage)
+@receiver(m2m_changed, sender=Product.categories.through)
+def bump_catalog_version(sender, **kwargs):
+    """Product data changed: invalidate catalog-derived caches and snapshots."""
+    # After commit, so other workers never refresh from data they can't see yet
+    transaction.on_commit(lambda: versions.bump('catalog'))
+
+
+@receiver([post_save, post_delete], sender=Coupon)
+@receiver(m2m_changed, sender=Coupon.categories.through)
+def bump_coupons_version(sender, **kwargs):
+    """Coupon settings changed: workers reload their active coupons."""
+    transaction.on_commit(lambda: versions.bump('coupons'))
+
+
+@receiver([post_save, post_delete], sender=Page)
+def bump_pages_version(sender, **kwargs):
+    """CMS pages changed: the pages sitemap needs regenerating."""
+    transaction.on_commit(lambda: versions.bump('pages'))
+
+
+@receiver([post_save, post_delete], sender=Wishlist)
+def invalidate_wishlist_cache(sender, instance, **kwargs):
+    wishlists.invalidate(instance.user_id)
@@ -0,0 +1,45 @@
+"""
+Per-process snapshot of the site configuration.
+
+SiteSettings, the category list, the active hero slides and the payment
+methods are read on (almost) every request but only change when an admin
+saves them. They are loaded once per worker and reused until the 'site'
+version stamp moves; the signals for these models bump it after commit, so
+every worker reloads on its next request. Rendered template fragments that
+only depend on this data (header navigation, footer) are kept on the same
+object, so they are dropped together with it.
+"""
+import threading
+
+from . import versions
+from .models import Category, HeroSlide, PaymentMethod, SiteSettings
+
+
+class SiteConfig:
+    __slots__ = ('stamp', 'settings', 'categories', 'hero_slides', 'payment_methods', 'payment_methods_by_id', 'fragments')
+
+    def __init__(self, stamp):
+        self.stamp = stamp
+        self.settings = SiteSettings.objects.first()
+        self.categories = list(Category.objects.order_by('name'))
+        self.hero_slides = list(HeroSlide.objects.filter(is_active=True))
+        methods = list(PaymentMethod.objects.order_by('id'))
+        self.payment_methods = [pm for pm in methods if pm.is_active]
+        self.payment_methods_by_id = {pm.id: pm for pm in methods}
+        self.fragments = {}
+
+
+_lock = threading.Lock()
+_config = None
+
+
+def get():
+    global _config
+    stamp = versions.get('site')
+    config = _config
+    if config is not None and config.stamp == stamp:
+        return config
+    with _lock:
+        if _config is None or _config.stamp != stamp:
+            _config = SiteConfig(stamp)
+        return _config
@@ -0,0 +1,65 @@
+"""
+Unique slug (and SKU) allocation.
+
+Finding a free "<base>-<n>" by probing the database one candidate at a time
+costs O(n) queries per save and O(n^2) for an import of n products sharing a
+name. SlugAllocator loads every existing value starting with the requested
+bases in one query, then hands out "<base>", "<base>-1", "<base>-2", ... in
+memory, remembering what it already gave out. Keep one allocator for a whole
+batch (an import, a bulk duplicate) so later rows see earlier allocations.
+"""
+import re
+
+from django.db.models import Q
+from django.utils.text import slugify
+
+LOAD_CHUNK = 100
+
+
+def base_slug(name, max_length=200):
+    # Leave room for the "-<n>" suffix
+    return slugify(name or '')[:max_length].strip('-') or 'product'
+
+
+class SlugAllocator:
+
+    def __init__(self, model, field='slug', exclude_pk=None):
+        self.model = model
+        self.field = field
+        self.exclude_pk = exclude_pk
+        self.taken = set()
+        self.next_suffix = {}
+
+    def load(self, bases):
+        """Fetch existing values for all `bases` not seen yet (one query per LOAD_CHUNK bases)."""
+        bases = sorted(set(bases) - set(self.next_suffix))
+        for i in range(0, len(bases), LOAD_CHUNK):
+            chunk = bases[i:i + LOAD_CHUNK]
+            condition = Q()
+            for base in chunk:
+                condition |= Q(**{f'{self.field}__startswith': base})
+            qs = self.model._default_manager.filter(condition)
+            if self.exclude_pk is not None:
+                qs = qs.exclude(pk=self.exclude_pk)
+            existing = set(qs.values_list(self.field, flat=True))
+            self.taken |= existing
+            for base in chunk:
+                pattern = re.compile(re.escape(base) + r'-(\d+)$')
+                suffixes = [int(m.group(1)) for m in map(pattern.match, existing) if m]
+                self.next_suffix[base] = max(suffixes, default=0) + 1
+
+    def allocate(self, base):
+        if base not in self.next_suffix:
+            self.load([base])
+        candidate = base
+        while candidate in self.taken:
+            candidate = f'{base}-{self.next_suffix[base]}'
+            self.next_suffix[base] += 1
+        self.taken.add(candidate)
+        return candidate
+
+    def allocate_many(self, bases):
+        """Allocate one unique value per entry of `bases` (duplicates get suffixes)."""
+        bases = list(bases)
+        self.load(bases)
+        return [self.allocate(base) for base in bases]
@@ -0,0 +1,102 @@
+"""
+Content-addressed media storage.
+
+Uploads are hashed while they are streamed to disk and stored as
+``blobs/<aa>/<bb>/<sha256><ext>``. Saving a file whose content already exists
+returns the existing blob instead of writing a copy, so re-uploading the same
+images (admin ZIP uploads, hero slides, imports) no longer grows MEDIA_ROOT.
+
+Blobs can be shared by many rows, so files are never deleted when a single
+reference goes away; `manage.py gc_media` removes blobs nothing points at.
+
+Restoring a media backup must put files back under the names the restored
+database refers to, so inside preserving_names() (used by this app's
+`mediarestore`) non-blob files are saved as-is, like FileSystemStorage.
+"""
+import hashlib
+import os
+import tempfile
+import threading
+from contextlib import contextmanager
+
+from django.core.files.storage import FileSystemStorage
+
+BLOB_PREFIX = 'blobs'
+
+_state = threading.local()
+
+
+@contextmanager
+def preserving_names():
+    previous = getattr(_state, 'preserve', False)
+    _state.preserve = True
+    try:
+        yield
+    finally:
+        _state.preserve = previous
+
+
+def _preserving(name):
+    # Blob names are derived from the content, so hashing reproduces them anyway
+    return getattr(_state, 'preserve', False) and not is_blob(name)
+
+
+def blob_name(digest, ext):
+    return f'{BLOB_PREFIX}/{digest[:2]}/{digest[2:4]}/{digest}{ext}'
+
+
+def is_blob(name):
+    return bool(name) and name.startswith(BLOB_PREFIX + '/')
+
+
+class ContentAddressedStorage(FileSystemStorage):
+
+    def get_available_name(self, name, max_length=None):
+        if _preserving(name):
+            return super().get_available_name(name, max_length=max_length)
+        # The final name is decided by the content hash in _save(), never by
+        # probing for a free "name_XXXXXXX.jpg" variant.
+        return name
+
+    def _save(self, name, content):
+        if _preserving(name):
+            return super()._save(name, content)
+        ext = os.path.splitext(name)[1].lower()
+        tmp_dir = os.path.join(self.location, BLOB_PREFIX, 'tmp')
+        os.makedirs(tmp_dir, exist_ok=True)
+
+        hasher = hashlib.sha256()
+        fd, tmp_path = tempfile.mkstemp(dir=tmp_dir)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                if hasattr(content, 'seek'):
+                    content.seek(0)
+                for chunk in content.chunks():
+                    if isinstance(chunk, str):
+                        chunk = chunk.encode()
+                    hasher.update(chunk)
+                    f.write(chunk)
+
+            name = blob_name(hasher.hexdigest(), ext)
+            full_path = self.path(name)
+            if os.path.exists(full_path):
+                os.remove(tmp_path)
+                return name
+
+            os.makedirs(os.path.dirname(full_path), exist_ok=True)
+            # Atomic rename: a concurrent upload of the same content just replaces
+            # an identical file
+            os.replace(tmp_path, full_path)
+            if self.file_permissions_mode is not None:
+                os.chmod(full_path, self.file_permissions_mode)
+            return name
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def delete(self, name):
+        # Other rows may reference the same blob; gc_media handles removal.
+        if is_blob(name):
+            return
+        super().delete(name)
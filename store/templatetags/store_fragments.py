@@ -0,0 +1,51 @@
+"""
+{% site_fragment 'footer' %} renders templates/store/fragments/<name>.html
+once per site configuration version and reuses the HTML on later requests.
+
+Fragments only see `site_settings`, `categories` and `active_section`
+(home / shop / contact / tutorial / ''), which is part of the cache key.
+Anything per-user (cart badge, login state, CSRF token) stays in base.html.
+"""
+from django import template
+from django.template.loader import render_to_string
+from django.utils.html import escape
+from django.utils.safestring import mark_safe
+
+from store import siteconfig
+
+register = template.Library()
+
+
+def active_section(path):
+    if path == '/':
+        return 'home'
+    for section in ('shop', 'contact', 'tutorial'):
+        if f'/{section}/' in path:
+            return section
+    return ''
+
+
+def render_fragment(name, section=''):
+    config = siteconfig.get()
+    key = (name, section)
+    html = config.fragments.get(key)
+    if html is None:
+        html = render_to_string(f'store/fragments/{name}.html', {
+            'site_settings': config.settings,
+            'categories': config.categories,
+            'active_section': section,
+        })
+        config.fragments[key] = html
+    return html
+
+
+@register.simple_tag(takes_context=True)
+def site_fragment(context, name):
+    request = context.get('request')
+    section = active_section(request.path) if request is not None else ''
+    html = render_fragment(name, section if name in ('nav_links', 'mobile_menu') else '')
+    if name == 'category_options' and context.get('current_category'):
+        # The only per-request part of the category <select>
+        option = '<option value="%s">' % escape(context['current_category'])
+        html = html.replace(option, option[:-1] + ' selected>', 1)
+    return mark_safe(html)
@@ -0,0 +1,31 @@
+from django import template
+
+from store import images
+
+register = template.Library()
+
+
+def _as_url(value):
+    # Accept both plain URLs (e.g. Product.primary_image) and ImageField files
+    if hasattr(value, 'url'):
+        try:
+            return value.url
+        except ValueError:
+            return ''
+    return value or ''
+
+
+def _widths(widths):
+    return [int(w) for w in str(widths).replace(',', ' ').split()]
+
+
+@register.simple_tag
+def derivative_url(value, width, fmt='webp'):
+    """{% derivative_url product.primary_image 320 %} -> resized variant URL"""
+    return images.derivative_url(_as_url(value), int(width), fmt)
+
+
+@register.simple_tag
+def derivative_srcset(value, widths, fmt='webp'):
+    """{% derivative_srcset slide.image "640 1024 1920" %} -> srcset attribute value"""
+    return images.derivative_srcset(_as_url(value), _widths(widths), fmt)
@@ -1,3 +1,330 @@
-from django.test import TestCase
+import json
+import socket
+import threading
+import time
+from decimal import Decimal
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from importlib import import_module
+from unittest import mock
+from urllib.parse import parse_qs
 
-# Create your tests here.
+import stripe
+from django.conf import settings
+from django.contrib.auth.models import User
+
+from django.db import OperationalError, connection, transaction
+from django.db.models import Sum
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.urls import reverse
+
+from . import mirror, payments
+from .models import Order, OrderItem, OrderNote, Product, StockReservation
+from .orders import InsufficientStock, create_order, decrement_stock
+
+
+class ConcurrentStockTests(TransactionTestCase):
+    """decrement_stock() under concurrent checkouts: no overselling, nothing lost."""
+
+    CUSTOMERS = 12
+    STOCK = 10
+
+    def setUp(self):
+        self.product = Product.objects.create(name='Toner', slug='toner', sku='TONER-1', price=Decimal('50'), stock=self.STOCK)
+
+    def _checkout(self, n, qty, outcomes):
+        # Each customer takes the stock and writes the order in one transaction, like the checkout view
+        try:
+            for _ in range(50):
+                try:
+                    with transaction.atomic():
+                        decrement_stock({self.product.pk: qty})
+                        create_order(
+                            [(self.product.pk, self.product.price, qty)],
+                            customer_name=f'Customer {n}', email=f'customer{n}@example.com', address='Test',
+                        )
+                    outcomes.append('placed')
+                    return
+                except InsufficientStock:
+                    outcomes.append('sold out')
+                    return
+                except OperationalError as e:
+                    # SQLite lets one writer in at a time; the others retry like a busy timeout would
+                    if 'locked' not in str(e):
+                        raise
+                    time.sleep(0.01)
+            outcomes.append('gave up')
+        finally:
+            connection.close()
+
+    def _run(self, quantities):
+        outcomes = []
+        threads = [threading.Thread(target=self._checkout, args=(n, qty, outcomes)) for n, qty in enumerate(quantities)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        return outcomes
+
+    def test_concurrent_checkouts_do_not_oversell(self):
+        outcomes = self._run([1] * self.CUSTOMERS)
+        self.assertNotIn('gave up', outcomes)
+        self.assertEqual(outcomes.count('placed'), self.STOCK)
+        self.assertEqual(outcomes.count('sold out'), self.CUSTOMERS - self.STOCK)
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.stock, 0)
+        self.assertEqual(Order.objects.count(), self.STOCK)
+        self.assertEqual(OrderItem.objects.aggregate(n=Sum('quantity'))['n'], self.STOCK)
+
+    def test_stock_and_order_items_add_up(self):
+        quantities = [3, 2, 4, 1, 3, 2, 1, 4]
+        outcomes = self._run(quantities)
+        self.assertNotIn('gave up', outcomes)
+        sold = OrderItem.objects.aggregate(n=Sum('quantity'))['n'] or 0
+        self.product.refresh_from_db()
+        self.assertGreaterEqual(self.product.stock, 0)
+        self.assertLessEqual(sold, self.STOCK)
+        self.assertEqual(self.product.stock + sold, self.STOCK)
+        self.assertEqual(Order.objects.count(), outcomes.count('placed'))
+        for order in Order.objects.prefetch_related('items'):
+            self.assertEqual(order.total_amount, sum(item.subtotal for item in order.items.all()))
+
+
+class StubServer:
+    """
+    Local HTTP server for tests; `routes` maps (method, path) to a
+    (status, headers, body) tuple or a callable(handler) returning one
+    (handler.body is the request body). Every request is recorded as
+    (method, path, headers, body).
+    """
+
+    def __init__(self, routes):
+        self.routes = routes
+        self.requests = []
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def _respond(self):
+                self.body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+                stub.requests.append((self.command, self.path, self.headers, self.body))
+                route = stub.routes.get((self.command, self.path.split('?')[0]), (404, {}, b'Not found'))
+                status, headers, payload = route(self) if callable(route) else route
+                self.send_response(status)
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            do_GET = do_POST = _respond
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = f'http://127.0.0.1:{self.server.server_address[1]}'
+
+    def __enter__(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class MirrorFetchTests(SimpleTestCase):
+    PNG = b'\x89PNG\r\n\x1a\n' + b'\x00' * 64
+
+    def setUp(self):
+        self.server = StubServer({
+            ('GET', '/image.png'): (200, {'Content-Type': 'image/png'}, self.PNG),
+            ('GET', '/broken.png'): (500, {}, b'Server error'),
+        }).__enter__()
+        self.addCleanup(self.server.__exit__)
+
+    def fetch(self, path, **kwargs):
+        kwargs.setdefault('backoff', 0)
+        return mirror.fetch(self.server.url + path, mirror.HostLimiter(2), timeout=5, **kwargs)
+
+    def test_success(self):
+        self.assertEqual(self.fetch('/image.png'), self.PNG)
+        method, path, headers, _ = self.server.requests[0]
+        self.assertEqual((method, path), ('GET', '/image.png'))
+        self.assertEqual(headers['User-Agent'], mirror.USER_AGENT)
+
+    def test_not_found_is_not_retried(self):
+        with self.assertRaisesMessage(mirror.MirrorError, 'HTTP 404'):
+            self.fetch('/missing.png', retries=2)
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_server_error_is_retried(self):
+        with self.assertRaisesMessage(mirror.MirrorError, 'HTTP 500'):
+            self.fetch('/broken.png', retries=2)
+        self.assertEqual(len(self.server.requests), 3)
+
+    def test_oversize(self):
+        with mock.patch.object(mirror, 'MAX_BYTES', len(self.PNG) - 1):
+            with self.assertRaisesMessage(mirror.MirrorError, 'larger than'):
+                self.fetch('/image.png')
+
+    def test_rejects_other_schemes(self):
+        for url in ('file:///etc/passwd', 'ftp://127.0.0.1/image.png', 'data:image/png;base64,AAAA', 'http://[::1/x'):
+            with self.subTest(url=url), self.assertRaises(mirror.MirrorError):
+                mirror.fetch(url, mirror.HostLimiter(1), retries=0)
+        self.assertEqual(self.server.requests, [])
+
+    def test_connection_refused(self):
+        with socket.socket() as sock:
+            sock.bind(('127.0.0.1', 0))
+            port = sock.getsockname()[1]
+        with self.assertRaises(mirror.MirrorError):
+            mirror.fetch(f'http://127.0.0.1:{port}/image.png', mirror.HostLimiter(1), retries=0)
+
+
+class PaymentIntentTests(TestCase):
+    """payments.intent_for() against a stub Stripe API (STRIPE_API_BASE)."""
+
+    def setUp(self):
+        self.created = 0
+        self.server = StubServer({
+            ('POST', '/v1/payment_intents'): self._create,
+            ('POST', '/v1/payment_intents/pi_1'): self._modify,
+            ('POST', '/v1/payment_intents/pi_used'): (400, {'Content-Type': 'application/json'}, json.dumps({
+                'error': {'type': 'invalid_request_error', 'message': 'This PaymentIntent has already succeeded.'},
+            }).encode()),
+        }).__enter__()
+        self.addCleanup(self.server.__exit__)
+        # _configure() sets these on the stripe module itself
+        for name in ('api_key', 'api_base'):
+            self.addCleanup(setattr, stripe, name, getattr(stripe, name))
+        settings_override = override_settings(STRIPE_SECRET_KEY='sk_test_stub', STRIPE_API_BASE=self.server.url)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.session = import_module(settings.SESSION_ENGINE).SessionStore()
+
+    def _intent(self, intent_id, amount):
+        return 200, {'Content-Type': 'application/json'}, json.dumps({
+            'id': intent_id, 'object': 'payment_intent', 'amount': amount, 'currency': 'hkd',
+            'client_secret': f'{intent_id}_secret_{amount}',
+        }).encode()
+
+    def _create(self, handler):
+        self.created += 1
+        form = parse_qs(handler.body.decode())
+        return self._intent(f'pi_{self.created}', int(form['amount'][0]))
+
+    def _modify(self, handler):
+        form = parse_qs(handler.body.decode())
+        return self._intent('pi_1', int(form['amount'][0]))
+
+    def calls(self):
+        return [(method, path.split('?')[0]) for method, path, _, _ in self.server.requests]
+
+    def test_creates_intent_with_idempotency_key(self):
+        secret = payments.intent_for(self.session, Decimal('123.45'), 'sig')
+        self.assertEqual(secret, 'pi_1_secret_12345')
+        self.assertEqual(self.calls(), [('POST', '/v1/payment_intents')])
+        _, _, headers, body = self.server.requests[0]
+        form = parse_qs(body.decode())
+        self.assertEqual(form['amount'], ['12345'])
+        self.assertEqual(form['currency'], ['hkd'])
+        self.assertEqual(headers['Idempotency-Key'], f'checkout-{self.session.session_key}-sig-12345')
+        self.assertEqual(self.session[payments.SESSION_KEY]['id'], 'pi_1')
+
+    def test_same_cart_reuses_intent_without_a_call(self):
+        first = payments.intent_for(self.session, Decimal('50'), 'sig')
+        second = payments.intent_for(self.session, Decimal('50'), 'sig')
+        self.assertEqual(first, second)
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_changed_cart_modifies_intent(self):
+        payments.intent_for(self.session, Decimal('50'), 'sig')
+        secret = payments.intent_for(self.session, Decimal('70'), 'other')
+        self.assertEqual(secret, 'pi_1_secret_7000')
+        self.assertEqual(self.calls(), [('POST', '/v1/payment_intents'), ('POST', '/v1/payment_intents/pi_1')])
+        self.assertEqual(parse_qs(self.server.requests[1][3].decode())['amount'], ['7000'])
+        self.assertEqual(self.session[payments.SESSION_KEY]['signature'], 'other')
+
+    def test_unusable_intent_is_replaced(self):
+        self.session[payments.SESSION_KEY] = {
+            'id': 'pi_used', 'client_secret': 'pi_used_secret', 'amount': 5000, 'signature': 'sig',
+        }
+        secret = payments.intent_for(self.session, Decimal('60'), 'sig')
+        self.assertEqual(secret, 'pi_1_secret_6000')
+        self.assertEqual(self.calls()[-1], ('POST', '/v1/payment_intents'))
+        self.assertEqual(self.session[payments.SESSION_KEY]['id'], 'pi_1')
+
+    def test_forget(self):
+        payments.intent_for(self.session, Decimal('50'), 'sig')
+        payments.forget(self.session)
+        self.assertNotIn(payments.SESSION_KEY, self.session)
+
+
+class OrderStatusChangeTests(TestCase):
+    """Stock and notes follow status changes saved on an order instance."""
+
+    def setUp(self):
+        self.product = Product.objects.create(name='Toner', slug='toner', sku='TONER-1', price=Decimal('50'), stock=3)
+        order = create_order(
+            [(self.product.pk, self.product.price, 2)],
+            customer_name='Customer', email='customer@example.com', address='Test',
+        )
+        self.order = Order.objects.get(pk=order.pk)
+
+    def test_cancel_restores_stock(self):
+        self.order.status = 'canceled'
+        self.order.save()
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.stock, 5)
+        self.assertEqual(OrderNote.objects.filter(order=self.order).count(), 1)
+
+    def test_cancel_after_partial_refresh(self):
+        self.order.status = 'canceled'
+        # Reloading other fields must not make the unsaved status look like the stored one
+        self.order.refresh_from_db(fields=['total_amount'])
+        self.order.save()
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.stock, 5)
+        self.assertEqual(OrderNote.objects.filter(order=self.order).count(), 1)
+
+    def test_full_refresh_discards_unsaved_status(self):
+        self.order.status = 'canceled'
+        self.order.refresh_from_db()
+        self.assertEqual(self.order.status, 'created')
+        self.order.save()
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.stock, 3)
+        self.assertFalse(OrderNote.objects.filter(order=self.order).exists())
+
+
+# Pages render {% static %}; the manifest only exists after collectstatic
+@override_settings(STORAGES={
+    **settings.STORAGES,
+    'staticfiles': {'BACKEND': 'django.contrib.staticfiles.storage.StaticFilesStorage'},
+})
+class CheckoutHoldTests(TestCase):
+    """Checkout holds stay the shopper's own across login (which cycles the session key)."""
+
+    def setUp(self):
+        self.product = Product.objects.create(name='Toner X', slug='toner-x', sku='TONER-X', price=Decimal('50'), stock=1)
+        self.user = User.objects.create_user('shopper', 'shopper@example.com', 'secret-pass')
+
+    def test_login_during_checkout_keeps_the_hold(self):
+        self.client.post(reverse('cart_add', args=[self.product.pk]), {'quantity': 1})
+        page = self.client.get(reverse('checkout'))
+        self.assertEqual(page.status_code, 200)
+        self.assertEqual(StockReservation.objects.filter(product=self.product).count(), 1)
+        old_key = self.client.session.session_key
+
+        self.client.force_login(self.user)
+        self.assertNotEqual(self.client.session.session_key, old_key)
+
+        response = self.client.post(reverse('checkout'), {
+            'customer_name': 'Shopper', 'email': 'shopper@example.com', 'phone': '0', 'address': 'Test',
+            'idempotency_key': page.context['idempotency_key'], 'grand_total': page.context['grand_total'],
+        })
+        self.assertEqual(response.status_code, 302)
+        self.assertIn('/order/success/', response['Location'])
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.stock, 0)
+        self.assertFalse(StockReservation.objects.exists())
@@ -1,5 +1,5 @@
 from django.urls import path
-from . import views
+from . import views, api
 
 urlpatterns = [
     path('', views.product_list, name='product_list'),
@@ -10,6 +10,7 @@ urlpatterns = [
     path('cart/remove/<int:product_id>/', views.cart_remove, name='cart_remove'),
     path('coupon/apply/', views.coupon_apply, name='coupon_apply'),
     path('checkout/', views.checkout, name='checkout'),
+    path('checkout/payment-intent/', views.checkout_payment_intent, name='checkout_payment_intent'),
     path('order/success/<int:order_id>/', views.order_success, name='order_success'),
     path('order/invoice/<int:order_id>/', views.invoice_view, name='invoice_view'),
     path('profile/', views.profile_view, name='profile'),
@@ -19,4 +20,12 @@ urlpatterns = [
     path('pages/<slug:slug>/', views.page_detail, name='page_detail'),
     path('wishlist/', views.wishlist_view, name='wishlist'),
     path('wishlist/toggle/', views.toggle_wishlist, name='toggle_wishlist'),
+    path('img/<int:width>/<str:fmt>/<path:name>', views.image_derivative, name='image_derivative'),
+    path('sitemap.xml', views.sitemap_index, name='sitemap_index'),
+    path('sitemaps/<str:name>', views.sitemap_section, name='sitemap_section'),
+    path('feeds/products.<str:fmt>.gz', views.product_feed, name='product_feed'),
+    path('search/suggest/', views.search_suggest, name='search_suggest'),
+    path('api/products/', api.products, name='api_products'),
+    path('api/categories/', api.categories, name='api_categories'),
+    path('api/stock/', api.stock, name='api_stock'),
 ]
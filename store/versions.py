@@ -0,0 +1,46 @@
+"""
+Cache version stamps.
+
+A version is the millisecond timestamp of the last change to some group of
+data (e.g. 'site' = SiteSettings, categories, hero slides and payment
+methods). Readers compare stamps instead of querying the database; writers call
+bump() from signals. Stamps live in the shared 'versions' cache (kept apart
+from the default cache so its culling can't drop them) so every worker sees
+the same value. If the cache is flushed the stamp is re-seeded with "now",
+which only invalidates more than necessary.
+"""
+import time
+from datetime import datetime, timezone
+
+from django.core.cache import caches
+
+CACHE_ALIAS = 'versions'
+KEY_PREFIX = 'store:version:'
+TIMEOUT = None  # never expire
+
+
+def _now_ms():
+    return int(time.time() * 1000)
+
+
+def get(name):
+    cache = caches[CACHE_ALIAS]
+    key = KEY_PREFIX + name
+    version = cache.get(key)
+    if version is None:
+        version = _now_ms()
+        # add() so that concurrent workers agree on a single seed value
+        if not cache.add(key, version, TIMEOUT):
+            version = cache.get(key, version)
+    return version
+
+
+def bump(name):
+    # Strictly increasing even if two bumps land in the same millisecond
+    version = max(_now_ms(), get(name) + 1)
+    caches[CACHE_ALIAS].set(KEY_PREFIX + name, version, TIMEOUT)
+    return version
+
+
+def as_datetime(version):
+    return datetime.fromtimestamp(version / 1000, tz=timezone.utc)
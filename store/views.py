@@ -1,16 +1,20 @@
 from django.shortcuts import render, get_object_or_404, redirect
 from django.urls import reverse
-from .models import Product, Order, OrderItem, Coupon, PaymentMethod, OrderNote, UserProfile, HeroSlide, Page, Wishlist
+from .models import Product, Order, OrderNote, UserProfile, Page, Wishlist, ProductRecommendation
 from decimal import Decimal
-from django.utils import timezone
 from .forms import CouponApplyForm, RegisterForm
 from django.contrib import messages
 from django.contrib.auth import login
-from django.http import JsonResponse
+from django.http import HttpResponse, JsonResponse, FileResponse, Http404
 from django.contrib.auth.decorators import login_required
 
-from django.db.models import Q, Count
 from django.conf import settings
+from django.db import transaction
+from django.utils.cache import get_conditional_response, patch_cache_control, patch_vary_headers
+from django.utils.http import http_date
+from django.views.decorators.http import require_POST
+from . import carts, catalog, coupons, orders, payments, reservations, siteconfig, versions, wishlists
+import hashlib
 import stripe
 
 def register_view(request):
@@ -32,14 +36,23 @@ def coupon_apply(request):
         form = CouponApplyForm(request.POST)
         if form.is_valid():
             code = form.cleaned_data['code']
-            now = timezone.now()
+            # Served from the per-process coupon snapshot; only usage limits are checked live
+            coupon = coupons.get(code)
             try:
-                coupon = Coupon.objects.get(code__iexact=code, valid_from__lte=now, valid_to__gte=now, active=True)
-                request.session['coupon_id'] = coupon.id
+                if coupon is None:
+                    raise coupons.CouponError("Invalid or expired coupon code.")
+                coupons.check_available(coupon, coupons.customer_key(request.user))
+                cart = carts.Cart.for_request(request)
+                if cart:
+                    coupons.discount(coupon, cart.lines)
+            except coupons.CouponError as e:
+                # Only writes the session if a coupon was actually applied
+                request.session.pop('coupon_id', None)
+                messages.error(request, str(e))
+            else:
+                if request.session.get('coupon_id') != coupon.id:
+                    request.session['coupon_id'] = coupon.id
                 messages.success(request, f"Coupon '{code}' applied successfully!")
-            except Coupon.DoesNotExist:
-                request.session['coupon_id'] = None
-                messages.error(request, "Invalid or expired coupon code.")
     
     # Redirect back to where the user came from (e.g. checkout or cart)
     next_url = request.POST.get('next')
@@ -49,44 +62,51 @@ def coupon_apply(request):
     return redirect('cart_view')
 
 def product_list(request, is_shop=False):
-    products = Product.objects.filter(is_active=True)
+    # Browsing is served from the in-process catalog snapshot (store/catalog.py)
+    snap = catalog.snapshot()
+    products = snap.sorted_products(request.GET.get('sort', 'default'))
     
     # Search functionality
     query = request.GET.get('q')
     if query:
-        products = products.filter(
-            Q(name__icontains=query) | 
-            Q(description__icontains=query) |
-            Q(categories__name__icontains=query)
-        ).distinct()
+        matches = catalog.search_ids(query)
+        products = [p for p in products if p.id in matches]
     
     # Filter by category
     category_filter = request.GET.get('category')
     if category_filter:
-        products = products.filter(categories__name=category_filter)
+        category = snap.category_by_name.get(category_filter)
+        products = [p for p in products if category and category.id in p.category_ids]
+
+    # Price facets describe the result set before the price filter is applied
+    price_facets = _price_facets(products)
+
+    # Filter by price range (effective_price = what the customer pays)
+    min_price = _parse_price(request.GET.get('min_price'))
+    max_price = _parse_price(request.GET.get('max_price'))
+    if min_price is not None:
+        products = [p for p in products if p.effective_price >= min_price]
+    if max_price is not None:
+        products = [p for p in products if p.effective_price < max_price]
+    price_params = ''
+    if min_price is not None:
+        price_params += f'&min_price={min_price}'
+    if max_price is not None:
+        price_params += f'&max_price={max_price}'
+    for facet in price_facets:
+        facet['active'] = (facet['min'] == min_price and facet['max'] == max_price)
         
-    # Sorting Logic
+    # Sorting Logic (applied above by picking the pre-sorted snapshot list)
     sort_by = request.GET.get('sort', 'default')
-    if sort_by == 'price_low':
-        products = products.order_by('price')
-    elif sort_by == 'price_high':
-        products = products.order_by('-price')
-    else:
-        products = products.order_by('-created_at')
     
     # Grid Layout (Columns)
     grid_cols = request.GET.get('cols', '3')
     
-    # Get categories with count
-    # Old: Product.objects.filter(is_active=True).values('category').annotate(count=Count('id')).order_by('category')
-    # New: Query Category model directly
-    from .models import Category
+    # Categories with active product counts (from the snapshot)
     from django.core.paginator import Paginator
-    categories = Category.objects.annotate(
-        count=Count('products', filter=Q(products__is_active=True))
-    ).filter(count__gt=0).order_by('name')
+    categories = [c for c in snap.categories if c.count > 0]
     
-    hero_slides = HeroSlide.objects.filter(is_active=True)
+    hero_slides = siteconfig.get().hero_slides
 
     # Pagination Logic
     per_page = request.GET.get('per_page', '9') # Default to 9
@@ -104,9 +124,7 @@ def product_list(request, is_shop=False):
     # Elided pagination
     custom_page_range = paginator.get_elided_page_range(page_obj.number, on_each_side=2, on_ends=1)
     
-    wishlist_product_ids = []
-    if request.user.is_authenticated:
-        wishlist_product_ids = list(Wishlist.objects.filter(user=request.user).values_list('product_id', flat=True))
+    wishlist_product_ids = wishlists.product_ids(request.user)
 
     return render(request, 'store/product_list.html', {
         'products': page_obj, 
@@ -119,13 +137,107 @@ def product_list(request, is_shop=False):
         'per_page': per_page,
         'sort_by': sort_by,
         'grid_cols': grid_cols,
-        'wishlist_product_ids': wishlist_product_ids
+        'wishlist_product_ids': wishlist_product_ids,
+        'price_facets': price_facets,
+        'price_params': price_params,
+        'min_price': min_price,
+        'max_price': max_price,
     })
 
 
+def _parse_price(value):
+    try:
+        price = Decimal(value)
+    except (TypeError, ValueError, ArithmeticError):
+        return None
+    return price if price.is_finite() and price >= 0 else None
+
+
+def _nice_step(span, buckets=5):
+    """Round span/buckets up to 1, 2 or 5 x 10^n so bucket edges read well."""
+    raw = max(span / buckets, Decimal('1'))
+    magnitude = Decimal(10) ** (len(str(int(raw))) - 1)
+    for factor in (1, 2, 5, 10):
+        if raw <= factor * magnitude:
+            return factor * magnitude
+    return 10 * magnitude
+
+
+def _price_facets(products):
+    """
+    Histogram of effective_price for the current search/category. The bucket
+    width is sized on the 90th percentile so a few very expensive items end up
+    in an open "and above" bucket instead of squashing everything else into one.
+    """
+    if not products:
+        return []
+    prices = sorted(p.effective_price for p in products)
+    low = prices[0]
+    p90 = prices[(len(prices) - 1) * 9 // 10]
+    step = _nice_step(p90 - low)
+    last = int(p90 // step) + 1
+    counts = {}
+    for price in prices:
+        bucket = min(int(price // step), last)
+        counts[bucket] = counts.get(bucket, 0) + 1
+    return [
+        {'min': bucket * step, 'max': None if bucket == last else (bucket + 1) * step, 'count': n}
+        for bucket, n in sorted(counts.items())
+    ]
+
+
+def _conditional_get(request, updated_at, *extra):
+    """
+    Build validators for a page whose content is `updated_at` plus the shared
+    header/footer (site version). Returns (response_or_None, etag, last_modified):
+    a 304 response when the client's copy is current, else the headers to set.
+
+    Visitor state rendered into base.html (login, cart, CSRF cookie) is folded
+    into the ETag. Last-Modified is only sent when there is no such state, since
+    a date alone can't express it.
+    """
+    if request.method not in ('GET', 'HEAD') or len(messages.get_messages(request)):
+        # Pending flash messages must be rendered, never answered with a 304
+        return None, None, None
+
+    site_version = versions.get('site')
+    cart = carts.Cart.for_request(request)
+    visitor = (
+        request.user.pk if request.user.is_authenticated else '',
+        sorted(cart.records.items()),
+        # The mini cart shows current names and prices
+        versions.get('catalog') if cart else '',
+        request.COOKIES.get(settings.CSRF_COOKIE_NAME, ''),
+    )
+    raw = repr((updated_at.timestamp(), site_version, visitor, extra))
+    etag = '"%s"' % hashlib.md5(raw.encode()).hexdigest()
+
+    last_modified = None
+    if not request.user.is_authenticated and not cart:
+        last_modified = int(max(updated_at, versions.as_datetime(site_version)).timestamp())
+
+    response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+    return response, etag, last_modified
+
+
+def _set_validators(response, etag, last_modified):
+    if etag:
+        response['ETag'] = etag
+        if last_modified:
+            response['Last-Modified'] = http_date(last_modified)
+        # Let browsers keep the page but always revalidate it
+        patch_cache_control(response, private=True, no_cache=True)
+        patch_vary_headers(response, ('Cookie',))
+    return response
+
+
 def page_detail(request, slug):
     page = get_object_or_404(Page, slug=slug, is_active=True)
-    return render(request, 'store/page_detail.html', {'page': page})
+    not_modified, etag, last_modified = _conditional_get(request, page.updated_at)
+    if not_modified is not None:
+        return not_modified
+    response = render(request, 'store/page_detail.html', {'page': page})
+    return _set_validators(response, etag, last_modified)
 
 def tutorial(request):
     try:
@@ -136,11 +248,26 @@ def tutorial(request):
 
 
 def product_detail(request, slug):
-    product = get_object_or_404(Product, slug=slug, is_active=True)
-    is_wishlisted = False
-    if request.user.is_authenticated:
-        is_wishlisted = Wishlist.objects.filter(user=request.user, product=product).exists()
-    return render(request, 'store/product_detail.html', {'product': product, 'is_wishlisted': is_wishlisted})
+    # Existence and freshness come from the catalog snapshot; the full row
+    # (description, specs, gallery) is only loaded when the page is rendered
+    record = catalog.snapshot().by_slug.get(slug)
+    if record is None:
+        raise Http404("Product not found")
+    is_wishlisted = record.id in wishlists.product_ids(request.user)
+    not_modified, etag, last_modified = _conditional_get(request, record.updated_at, is_wishlisted, versions.get('recommendations'))
+    if not_modified is not None:
+        return not_modified
+    product = get_object_or_404(Product, pk=record.id, is_active=True)
+    # Precomputed by `manage.py build_recommendations`: one indexed lookup
+    recommendations = ProductRecommendation.objects.filter(
+        product=product, recommended__is_active=True
+    ).select_related('recommended').order_by('rank')
+    response = render(request, 'store/product_detail.html', {
+        'product': product,
+        'is_wishlisted': is_wishlisted,
+        'recommendations': recommendations,
+    })
+    return _set_validators(response, etag, last_modified)
 
 
 @login_required
@@ -149,18 +276,11 @@ def toggle_wishlist(request):
         import json
         try:
             data = json.loads(request.body)
-            product_id = data.get('product_id')
-            product = get_object_or_404(Product, id=product_id)
-            
-            wishlist_item, created = Wishlist.objects.get_or_create(user=request.user, product=product)
-            
-            if not created:
-                wishlist_item.delete()
-                is_wishlisted = False
-            else:
-                is_wishlisted = True
-                
-            count = Wishlist.objects.filter(user=request.user).count()
+            product_id = int(data.get('product_id'))
+            # Removing always works (even for products taken off sale); adding needs an active product
+            if product_id not in wishlists.product_ids(request.user) and product_id not in catalog.snapshot().by_id:
+                raise Http404("Product not found")
+            is_wishlisted, count = wishlists.toggle(request.user, product_id)
             return JsonResponse({'status': 'ok', 'is_wishlisted': is_wishlisted, 'count': count})
         except Exception as e:
             return JsonResponse({'status': 'error', 'message': str(e)}, status=400)
@@ -169,107 +289,131 @@ def toggle_wishlist(request):
 
 @login_required
 def wishlist_view(request):
-    wishlist_items = Wishlist.objects.filter(user=request.user).select_related('product').order_by('-created_at')
+    # primary_image is denormalised onto Product, so the cards need no per-item image queries
+    wishlist_items = (
+        Wishlist.objects.filter(user=request.user).select_related('product')
+        .only('id', 'product__id', 'product__name', 'product__slug', 'product__price',
+              'product__discount_price', 'product__primary_image')
+        .order_by('-created_at')
+    )
     return render(request, 'store/wishlist.html', {'wishlist_items': wishlist_items})
 
 
-def _get_cart(session):
-    return session.setdefault('cart', {})
+def _cart_notices(request, cart):
+    """Tell the customer about products dropped from the cart and prices that changed."""
+    for name in cart.removed:
+        messages.warning(request, f"{name} 已下架，已從購物車移除。")
+    changed = cart.price_changes
+    for line in changed:
+        messages.info(request, f"{line.name} 的價格已由 ${line.seen_price} 更新為 ${line.price}。")
+    if changed:
+        cart.acknowledge()
+    return bool(cart.removed or changed)
 
 
 def cart_add(request, product_id):
-    product = get_object_or_404(Product, id=product_id, is_active=True)
+    product = catalog.snapshot().by_id.get(product_id)
+    if product is None:
+        raise Http404("Product not found")
     qty = int(request.POST.get('quantity', 1))
+    # The snapshot may lag behind orders placed by other workers; stock is read from the DB,
+    # minus what other shoppers are holding in checkout
+    stock = reservations.available([product_id], request.session).get(product_id, 0)
     
     # Check Stock
-    if product.stock < qty:
-        messages.error(request, f"抱歉，{product.name} 庫存不足 (剩餘 {product.stock})")
+    if stock < qty:
+        messages.error(request, f"抱歉，{product.name} 庫存不足 (剩餘 {stock})")
         # Redirect back to product detail or list
         return redirect(request.META.get('HTTP_REFERER', 'product_list'))
 
-    cart = _get_cart(request.session)
-    
-    # Determine image URL
-    img_url = ''
-    if product.image:
-        img_url = product.image.url
-    elif product.image_url:
-        img_url = product.image_url
-        
-    item = cart.get(str(product.id), {'name': product.name, 'price': str(product.effective_price()), 'qty': 0, 'image': img_url})
+    cart = carts.Cart.for_request(request)
     
     # Check if total quantity exceeds stock
-    new_qty = item['qty'] + qty
-    if product.stock < new_qty:
-        messages.error(request, f"抱歉，{product.name} 庫存不足 (目前購物車已有 {item['qty']}，庫存剩餘 {product.stock})")
+    in_cart = cart.quantity(product.id)
+    if stock < in_cart + qty:
+        messages.error(request, f"抱歉，{product.name} 庫存不足 (目前購物車已有 {in_cart}，庫存剩餘 {stock})")
         return redirect('cart_view')
         
-    item['qty'] = new_qty
-    item['image'] = img_url  # Ensure image is set/updated
-    cart[str(product.id)] = item
-    request.session.modified = True
+    cart.add(product.id, qty, product.effective_price)
     messages.success(request, f"已加入 {product.name} 到購物車")
     return redirect('cart_view')
 
 
 def cart_remove(request, product_id):
-    cart = _get_cart(request.session)
-    cart.pop(str(product_id), None)
-    request.session.modified = True
+    carts.Cart.for_request(request).remove(product_id)
+    reservations.release(request.session, [product_id])
     return redirect('cart_view')
 
 
 def cart_view(request):
-    cart = _get_cart(request.session)
-    items = []
-    total = Decimal('0')
-    for pid, item in cart.items():
-        price = Decimal(item['price'])
-        qty = int(item['qty'])
-        subtotal = price * qty
-        items.append({'id': int(pid), 'name': item['name'], 'price': price, 'qty': qty, 'subtotal': subtotal})
-        total += subtotal
-    
-    # Coupon logic
-    coupon_id = request.session.get('coupon_id')
-    coupon = None
-    discount = Decimal('0')
-    if coupon_id:
-        try:
-            coupon = Coupon.objects.get(id=coupon_id)
-            discount = coupon.calculate_discount(total)
-        except Coupon.DoesNotExist:
-            request.session['coupon_id'] = None
-    
-    if total < discount:
-        discount = total
-    
-    grand_total = total - discount
+    cart = carts.Cart.for_request(request)
+    _cart_notices(request, cart)
+    coupon = _session_coupon(request)
+    total, discount, grand_total, coupon_error = _cart_totals(cart, coupon)
     coupon_form = CouponApplyForm()
 
     return render(request, 'store/cart.html', {
-        'items': items, 
+        'items': cart.lines, 
         'total': total, 
         'coupon': coupon, 
         'discount': discount, 
         'grand_total': grand_total,
+        'coupon_error': coupon_error,
         'coupon_form': coupon_form
     })
 
 
+def _get_client_ip(request):
+    x_forwarded_for = request.META.get('HTTP_X_FORWARDED_FOR')
+    if x_forwarded_for:
+        return x_forwarded_for.split(',')[0].strip()
+    return request.META.get('REMOTE_ADDR')
+
+
+def _session_coupon(request):
+    coupon_id = request.session.get('coupon_id')
+    if coupon_id:
+        coupon = coupons.by_id(coupon_id)
+        if coupon is None:
+            # Deactivated or expired since it was applied
+            request.session.pop('coupon_id', None)
+        return coupon
+    return None
+
+
+def _shortage_messages(request, cart, error):
+    names = {line.product_id: line.name for line in cart.lines}
+    for product_id, requested, available in error.shortages:
+        messages.error(request, f"抱歉，{names.get(product_id, '')} 庫存不足 (僅剩 {available})，請調整數量。")
+
+
+def _cart_totals(cart, coupon):
+    """(total, discount, grand_total, coupon_error); an inapplicable coupon gives no discount."""
+    total = cart.total
+    discount = Decimal('0')
+    coupon_error = None
+    if coupon:
+        try:
+            discount = coupons.discount(coupon, cart.lines)
+        except coupons.CouponError as e:
+            coupon_error = str(e)
+    return total, discount, total - discount, coupon_error
+
+
 def checkout(request):
-    cart = _get_cart(request.session)
-    if not cart:
+    cart = carts.Cart.for_request(request)
+    idempotency_key = request.POST.get('idempotency_key', '')[:orders.MAX_KEY_LENGTH] if request.method == 'POST' else ''
+    if idempotency_key:
+        # A retry of a submission that already went through (its cart is gone by now)
+        order_id = orders.submitted_order_id(idempotency_key)
+        if order_id:
+            return redirect(reverse('order_success', kwargs={'order_id': order_id}))
+    if not cart.lines:
+        _cart_notices(request, cart)
         return redirect('product_list')
     
     # Get Coupon Object
-    coupon_id = request.session.get('coupon_id')
-    coupon = None
-    if coupon_id:
-        try:
-            coupon = Coupon.objects.get(id=coupon_id)
-        except Coupon.DoesNotExist:
-            request.session['coupon_id'] = None
+    coupon = _session_coupon(request)
 
     if request.method == 'POST':
         name = request.POST.get('customer_name', '').strip()
@@ -279,119 +423,105 @@ def checkout(request):
         notes = request.POST.get('notes', '').strip()
         payment_method_id = request.POST.get('payment_method')
         
-        # First check stock
-        for pid, item in cart.items():
-            product = get_object_or_404(Product, id=int(pid))
-            if product.stock < int(item['qty']):
-                from django.contrib import messages
-                messages.error(request, f"抱歉，{product.name} 庫存不足 (僅剩 {product.stock})，請調整數量。")
-                return redirect('cart_view')
-
-        # Create Order (initial)
-        ip_address = _get_client_ip(request)
-        order = Order.objects.create(
-            customer_name=name, email=email, phone=phone, address=address, notes=notes, status='created',
-            coupon=coupon, discount_amount=0, # Will update later
-            user=request.user if request.user.is_authenticated else None,
-            ip_address=ip_address
-        )
-        
-        # Handle Payment Method
-        if payment_method_id:
-            try:
-                pm = PaymentMethod.objects.get(id=payment_method_id)
-                order.payment_method = pm
-                
-                # If Payment Method requires proof, check for file upload
-                if pm.requires_proof and 'payment_proof' in request.FILES:
-                    order.payment_proof = request.FILES['payment_proof']
+        # Never charge a price the customer hasn't seen: show the changes and let them resubmit
+        if _cart_notices(request, cart):
+            return redirect('checkout')
+        lines = cart.lines
+        total, discount, grand_total, coupon_error = _cart_totals(cart, coupon)
+        if coupon_error:
+            # The checkout page showed the total without it
+            coupon = None
+        try:
+            shown_total = Decimal(request.POST.get('grand_total', ''))
+        except ArithmeticError:
+            shown_total = None
+        if shown_total is not None and shown_total != grand_total:
+            messages.warning(request, f"訂單金額已更新為 ${grand_total}，請確認後再提交。")
+            return redirect('checkout')
+
+        try:
+            with transaction.atomic():
+                # First write of the transaction: a concurrent duplicate waits here, then fails
+                submission = orders.claim_submission(idempotency_key) if idempotency_key else None
+
+                # Conditional F() updates: checking and taking stock is one statement per product
+                # Converts this session's checkout holds into the real decrement
+                orders.decrement_stock(cart.quantities, reservations.holder(request.session))
+                reservations.release(request.session)
+
+                # Handle Payment Method
+                pm = None
+                if payment_method_id:
+                    try:
+                        pm = siteconfig.get().payment_methods_by_id.get(int(payment_method_id))
+                    except ValueError:
+                        pass
+
+                # Status logic
+                if pm and pm.requires_proof:
+                    status = 'created' # Wait for verification
+                elif pm and pm.code == 'cod':
+                    status = 'fulfilling' # Confirmed but not yet paid
+                else:
+                    status = 'paid' # Assume instant payment for others
+
+                # One INSERT for the order (totals computed in memory) and one for all its items
+                payment_proof = request.FILES.get('payment_proof') if pm and pm.requires_proof else None
+                order = orders.create_order(
+                    [(line.product_id, line.price, line.qty) for line in lines],
+                    coupon=coupon, discount=discount,
+                    customer_name=name, email=email, phone=phone, address=address, notes=notes, status=status,
+                    payment_method=pm, payment_proof=payment_proof,
+                    user=request.user if request.user.is_authenticated else None,
+                    ip_address=_get_client_ip(request),
+                )
+                if submission:
+                    submission.order = order
+                    submission.save(update_fields=['order'])
+
+                if payment_proof:
                     # Add a note that proof was uploaded
                     OrderNote.objects.create(order=order, message=f"Customer uploaded payment proof ({pm.name} Receipt).")
                 # If Credit Card, capture masked info in order note (do not store card)
-                if pm.code == 'credit_card':
+                if pm and pm.code == 'credit_card':
                     intent_id = request.POST.get('stripe_payment_intent')
                     if intent_id:
                         OrderNote.objects.create(order=order, message=f"Stripe PaymentIntent confirmed: {intent_id}")
-                    
-            except PaymentMethod.DoesNotExist:
-                pass
-        
-        total = Decimal('0')
-        for pid, item in cart.items():
-            product = get_object_or_404(Product, id=int(pid))
-            price = Decimal(item['price'])
-            qty = int(item['qty'])
-            
-            # Deduct stock
-            product.stock -= qty
-            product.save()
-            
-            subtotal = price * qty
-            OrderItem.objects.create(order=order, product=product, unit_price=price, quantity=qty, subtotal=subtotal)
-            total += subtotal
-        
-        # Calculate Discount
-        discount = Decimal('0')
-        if coupon:
-            discount = coupon.calculate_discount(total)
-
-        # Apply discount to total
-        if total < discount:
-            discount = total
-        
-        order.discount_amount = discount
-        order.total_amount = total - discount
-        
-        # Status logic
-        if order.payment_method and order.payment_method.requires_proof:
-            order.status = 'created' # Wait for verification
-        elif order.payment_method and order.payment_method.code == 'cod':
-            order.status = 'fulfilling' # Confirmed but not yet paid
-        else:
-            order.status = 'paid' # Assume instant payment for others
-            
-        order.save()
-        request.session['cart'] = {}
-        request.session['coupon_id'] = None
-        request.session.modified = True
+
+                # Last, so a limited coupon's counter row is locked only until the commit
+                if coupon:
+                    coupons.redeem(coupon, coupons.customer_key(request.user, email))
+        except coupons.CouponError as e:
+            request.session.pop('coupon_id', None)
+            messages.error(request, str(e))
+            return redirect('checkout')
+        except orders.InsufficientStock as e:
+            # Report every short line at once, not just the first one
+            _shortage_messages(request, cart, e)
+            return redirect('cart_view')
+        except orders.DuplicateSubmission as e:
+            if e.order_id:
+                return redirect(reverse('order_success', kwargs={'order_id': e.order_id}))
+            return redirect('cart_view')
+
+        cart.clear()
+        request.session.pop('coupon_id', None)
+        payments.forget(request.session)
         return redirect(reverse('order_success', kwargs={'order_id': order.id}))
     
-    # GET Request: Calculate totals for display
-    items = []
-    total = Decimal('0')
-    for pid, item in cart.items():
-        price = Decimal(item['price'])
-        qty = int(item['qty'])
-        subtotal = price * qty
-        items.append({'id': int(pid), 'name': item['name'], 'price': price, 'qty': qty, 'subtotal': subtotal})
-        total += subtotal
-    
-    discount = Decimal('0')
-    if coupon:
-        discount = coupon.calculate_discount(total)
-        
-    if total < discount:
-        discount = total
-    grand_total = total - discount
-    
-    payment_methods = PaymentMethod.objects.filter(is_active=True)
-    
-    # Stripe PaymentIntent (for credit card)
-    stripe_public_key = None
-    client_secret = None
-    if getattr(settings, 'STRIPE_ENABLED', False) and grand_total > 0:
-        stripe.api_key = settings.STRIPE_SECRET_KEY
-        stripe_public_key = settings.STRIPE_PUBLISHABLE_KEY
-        try:
-            intent = stripe.PaymentIntent.create(
-                amount=int(grand_total * 100),  # cents
-                currency='hkd',
-                automatic_payment_methods={'enabled': True},
-                description='PrintSmart Order (Preview)',
-            )
-            client_secret = intent.client_secret
-        except Exception as e:
-            pass
+    # GET Request: the totals below are at current prices, so those count as seen
+    _cart_notices(request, cart)
+    # Hold the cart's stock while the customer fills in the form
+    try:
+        hold_expires_at = reservations.reserve(request.session, cart.quantities)
+    except orders.InsufficientStock as e:
+        _shortage_messages(request, cart, e)
+        return redirect('cart_view')
+
+    total, discount, grand_total, coupon_error = _cart_totals(cart, coupon)
+    payment_methods = siteconfig.get().payment_methods
+    # No Stripe call here: the intent is created on demand by checkout_payment_intent
+    stripe_public_key = settings.STRIPE_PUBLISHABLE_KEY if payments.enabled() and grand_total > 0 else None
 
     # Pre-fill user data if authenticated
     user_data = {}
@@ -407,18 +537,38 @@ def checkout(request):
             pass
 
     return render(request, 'store/checkout.html', {
-        'items': items, 
+        'items': cart.lines, 
         'total': total,
         'coupon': coupon,
         'discount': discount,
         'grand_total': grand_total,
+        'coupon_error': coupon_error,
         'payment_methods': payment_methods,
         'stripe_public_key': stripe_public_key,
-        'stripe_client_secret': client_secret,
-        'user_data': user_data
+        'user_data': user_data,
+        'hold_expires_at': hold_expires_at,
+        'idempotency_key': orders.new_idempotency_key(),
     })
 
 
+@require_POST
+def checkout_payment_intent(request):
+    """Client secret for the card form; called by checkout.html when credit card is selected."""
+    if not payments.enabled():
+        raise Http404
+    cart = carts.Cart.for_request(request)
+    coupon = _session_coupon(request)
+    grand_total = _cart_totals(cart, coupon)[2]
+    if grand_total <= 0:
+        return JsonResponse({'status': 'error', 'message': 'Nothing to pay.'}, status=400)
+    signature = payments.cart_signature(cart.lines, coupon.id if coupon else None)
+    try:
+        client_secret = payments.intent_for(request.session, grand_total, signature)
+    except stripe.error.StripeError:
+        return JsonResponse({'status': 'error', 'message': '暫時無法連接付款服務，請稍後再試。'}, status=502)
+    return JsonResponse({'client_secret': client_secret})
+
+
 def order_success(request, order_id):
     order = get_object_or_404(Order, id=order_id)
     return render(request, 'store/order_success.html', {'order': order})
@@ -489,3 +639,57 @@ def user_order_detail(request, order_id):
 
 def contact_view(request):
     return render(request, 'store/contact.html')
+
+
+def image_derivative(request, width, fmt, name):
+    """Serve a resized WebP/JPEG variant of a local media image (see store/images.py)."""
+    from .images import FORMATS, get_derivative
+    path = get_derivative(name, width, fmt)
+    if path is None:
+        raise Http404("Image not found")
+    response = FileResponse(open(path, 'rb'), content_type=FORMATS[fmt][1])
+    response['Cache-Control'] = 'public, max-age=2592000'
+    response['ETag'] = f'"{path.stem}"'
+    return response
+
+
+def _serve_feed_file(request, name, content_type):
+    # Built by `manage.py build_feeds`; requests never trigger a build
+    from . import feeds
+    path = feeds.feed_path(name)
+    if not path.is_file():
+        if name == 'sitemap.xml' or name.startswith('products.'):
+            # Not built yet
+            response = HttpResponse("Not generated yet", status=503, content_type='text/plain')
+            response['Retry-After'] = '3600'
+            return response
+        raise Http404("Not found")
+    response = FileResponse(open(path, 'rb'), content_type=content_type)
+    response['Cache-Control'] = 'public, max-age=3600'
+    return response
+
+
+def sitemap_index(request):
+    return _serve_feed_file(request, 'sitemap.xml', 'application/xml')
+
+
+def sitemap_section(request, name):
+    if not (name.startswith('sitemap-') and name.endswith('.xml.gz')) or '/' in name:
+        raise Http404("Not found")
+    return _serve_feed_file(request, name, 'application/gzip')
+
+
+def product_feed(request, fmt):
+    """Google Merchant (xml) / Facebook catalog (csv) product feed, gzip-compressed."""
+    if fmt not in ('xml', 'csv'):
+        raise Http404("Not found")
+    return _serve_feed_file(request, f'products.{fmt}.gz', 'application/gzip')
+
+
+def search_suggest(request):
+    """Header search type-ahead (see store/autocomplete.py)."""
+    from . import autocomplete
+    response = JsonResponse({'results': autocomplete.suggest(request.GET.get('q', ''))},
+                            json_dumps_params={'ensure_ascii': False})
+    patch_cache_control(response, public=True, max_age=60)
+    return response
@@ -0,0 +1,54 @@
+"""
+Per-user wishlist membership cache.
+
+Listing pages only need "which of these products has the user saved?", so
+each user's wishlisted product ids are kept as one set in the shared cache.
+toggle() writes the row and stores the updated set directly, so the
+response carries the new count without re-counting. Any other change
+(admin edits, products being deleted) drops the entry through the Wishlist
+signals.
+"""
+from django.core.cache import cache
+from django.db import IntegrityError, transaction
+
+from .models import Wishlist
+
+TIMEOUT = 60 * 60 * 24
+
+
+def _key(user_id):
+    return f'wishlist:ids:{user_id}'
+
+
+def product_ids(user):
+    """frozenset of the product ids `user` has wishlisted (empty for anonymous users)."""
+    if not user.is_authenticated:
+        return frozenset()
+    ids = cache.get(_key(user.pk))
+    if ids is None:
+        ids = frozenset(Wishlist.objects.filter(user=user).values_list('product_id', flat=True))
+        cache.set(_key(user.pk), ids, TIMEOUT)
+    return ids
+
+
+def toggle(user, product_id):
+    """Add or remove `product_id`; returns (is_wishlisted, new wishlist size)."""
+    ids = set(product_ids(user))
+    if product_id in ids:
+        Wishlist.objects.filter(user=user, product_id=product_id).delete()
+        ids.discard(product_id)
+    else:
+        try:
+            with transaction.atomic():
+                Wishlist.objects.create(user=user, product_id=product_id)
+        except IntegrityError:
+            # Already added from another tab/device
+            pass
+        ids.add(product_id)
+    # Runs after the Wishlist signals have dropped the old entry
+    cache.set(_key(user.pk), frozenset(ids), TIMEOUT)
+    return product_id in ids, len(ids)
+
+
+def invalidate(user_id):
+    cache.delete(_key(user_id))